@@ -5,12 +5,23 @@ Finds the top N most used words, with options to filter stop words.
 """
 
 import glob
-import re
+import multiprocessing
+import os
 import sqlite3
 import sys
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
 
+import numpy as np
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+# Shared with the archive's full-text index, so searches and word counts agree
+from tsurugi.text import tokenize_batch  # noqa: E402
+
 # Common English stop words to filter out
 STOP_WORDS = {
     "the",
@@ -142,119 +153,210 @@ STOP_WORDS = {
     "hadnt",
 }
 
+# Rows fetched and tokenized at a time
+BATCH_SIZE = 10000
+# How much of the --by breakdown to print
+BREAKDOWN_GROUPS = 15
+BREAKDOWN_WORDS = 8
+
 
 def find_latest_db() -> Optional[str]:
-    """Find the most recent database file."""
+    """Find the consolidated archive, or the most recent per-run file."""
     search_paths = [
+        "archive.db",
+        "src/tsurugi/data/archive.db",
+        "../src/tsurugi/data/archive.db",
         "*_messages.db",
         "src/*_messages.db",
         "../*_messages.db",
         "../src/*_messages.db",
     ]
 
-    db_files = []
+    # Prefer the consolidated archive over per-run files
     for pattern in search_paths:
-        db_files.extend(glob.glob(pattern))
+        db_files = glob.glob(pattern)
+        if db_files:
+            return sorted(db_files)[-1]
 
-    if not db_files:
-        return None
+    return None
 
-    return sorted(db_files)[-1]
 
-
-def tokenize(text: str) -> list[str]:
+def row_ranges(db_path: str, chunks: int) -> list[tuple[int, int]]:
     """
-    Tokenize text into words.
-    - Converts to lowercase
-    - Removes URLs, mentions, emojis
-    - Splits on word boundaries
-    - Filters short words
+    Split the messages table into contiguous rowid ranges.
+    Rowids are dense in an append-only archive, so equal-width ranges hold
+    roughly equal numbers of messages.
+    Returns:
+        (first, last) inclusive rowid pairs, in order.
     """
-    if not text:
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30.0)
+    try:
+        low, high = conn.execute(
+            "SELECT MIN(rowid), MAX(rowid) FROM messages"
+        ).fetchone()
+    finally:
+        conn.close()
+    if low is None:
         return []
+    step = max(1, -(-(high - low + 1) // chunks))
+    return [
+        (start, min(start + step - 1, high)) for start in range(low, high + 1, step)
+    ]
 
-    # Remove URLs
-    text = re.sub(r"https?://\S+", "", text)
-    text = re.sub(r"www\.\S+", "", text)
 
-    # Remove Discord mentions and channels
-    text = re.sub(r"<@!?\d+>", "", text)
-    text = re.sub(r"<#\d+>", "", text)
-    text = re.sub(r"<@&\d+>", "", text)
+def count_range(
+    db_path: str,
+    first: int,
+    last: int,
+    filter_stop_words: bool,
+    min_length: int,
+    by: Optional[str] = None,
+) -> tuple[int, Counter, dict, dict]:
+    """
+    Count the words in one rowid range. Runs in a worker process with its
+    own read-only connection.
 
-    # Remove Discord emojis
-    text = re.sub(r"<a?:\w+:\d+>", "", text)
+    Args:
+        db_path: Path to the SQLite database
+        first: First rowid of the range
+        last: Last rowid of the range (inclusive)
+        filter_stop_words: Whether to filter common stop words
+        min_length: Minimum word length to include
+        by: "author" or "month" to also count words per group
 
-    # Convert to lowercase
-    text = text.lower()
+    Returns:
+        (messages, words, groups, names): the messages read, a Counter of
+        words, a dict of group key to Counter, and author names by author id.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30.0)
+    cursor = conn.execute(
+        """SELECT content, author_id, author_name, substr(created_at, 1, 7)
+           FROM messages
+           WHERE rowid BETWEEN ? AND ? AND content IS NOT NULL""",
+        (first, last),
+    )
+
+    word_counter = Counter()
+    groups: dict[str, Counter] = {}
+    names: dict[str, str] = {}
+    messages = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            messages += len(rows)
+
+            # Tokenize the whole batch in one pass
+            words, counts = tokenize_batch([row[0] for row in rows])
+
+            if by:
+                # Give every token its message's group key, then count pairs
+                column = 1 if by == "author" else 3
+                keys = np.repeat(
+                    np.array([row[column] or "" for row in rows], dtype=object),
+                    counts,
+                ).tolist()
+                pairs = list(zip(keys, words))
+                if min_length > 2:
+                    pairs = [p for p in pairs if len(p[1]) >= min_length]
+                if filter_stop_words:
+                    pairs = [p for p in pairs if p[1] not in STOP_WORDS]
+                for (key, word), count in Counter(pairs).items():
+                    groups.setdefault(key, Counter())[word] += count
+                if by == "author":
+                    names.update((row[1] or "", row[2]) for row in rows)
+                words = [word for _, word in pairs]
+            else:
+                # Filter by length
+                if min_length > 2:
+                    words = [w for w in words if len(w) >= min_length]
+
+                # Filter stop words if requested
+                if filter_stop_words:
+                    words = [w for w in words if w not in STOP_WORDS]
+
+            word_counter.update(words)
+    finally:
+        conn.close()
+    return messages, word_counter, groups, names
 
-    # Extract words (alphanumeric + apostrophes for contractions)
-    words = re.findall(r"\b[a-z]{2,}(?:'[a-z]+)?\b", text)
 
-    return words
+def _count_range(args: tuple) -> tuple[int, Counter, dict, dict]:
+    return count_range(*args)
 
 
 def analyze_words(
-    db_path: str, top_n: int = 100, filter_stop_words: bool = True, min_length: int = 2
+    db_path: str,
+    top_n: int = 100,
+    filter_stop_words: bool = True,
+    min_length: int = 2,
+    workers: int = 1,
+    by: Optional[str] = None,
 ):
     """
     Analyze word frequency from the database.
+    The table is split into rowid ranges that are counted separately and
+    merged, in this process or across a pool of worker processes.
 
     Args:
         db_path: Path to the SQLite database
         top_n: Number of top words to return
         filter_stop_words: Whether to filter common stop words
         min_length: Minimum word length to include
+        workers: Number of worker processes (1 counts in this process)
+        by: "author" or "month" to add a per-group breakdown
     """
     print(f"📁 Analyzing: {db_path}")
     print(f"⚙️  Settings: top {top_n}, min length: {min_length}", end="")
     if filter_stop_words:
-        print(f", filtering {len(STOP_WORDS)} stop words")
+        print(f", filtering {len(STOP_WORDS)} stop words", end="")
     else:
-        print(", including all words")
+        print(", including all words", end="")
+    print(f", {workers} worker{'s' if workers != 1 else ''}")
     print("=" * 70)
 
     try:
         # Connect to database with read-only mode
         conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30.0)
-        cursor = conn.cursor()
-
-        # Get total message count
-        cursor.execute("SELECT COUNT(*) FROM messages")
-        total_messages = cursor.fetchone()[0]
+        total_messages = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        conn.close()
         print(f"📊 Total messages: {total_messages:,}")
 
-        # Fetch all message content
-        print("🔄 Loading messages...")
-        cursor.execute("SELECT content FROM messages WHERE content IS NOT NULL")
+        # A few ranges per worker keeps them all busy until the end
+        ranges = row_ranges(db_path, max(1, total_messages // 50000, workers * 4))
+        jobs = [
+            (db_path, first, last, filter_stop_words, min_length, by)
+            for first, last in ranges
+        ]
 
         word_counter = Counter()
+        groups: dict[str, Counter] = {}
+        names: dict[str, str] = {}
         messages_processed = 0
-        batch_size = 10000
 
-        print("🔍 Processing messages...")
-        while True:
-            rows = cursor.fetchmany(batch_size)
-            if not rows:
-                break
-
-            for (content,) in rows:
-                words = tokenize(content)
-
-                # Filter by length
-                words = [w for w in words if len(w) >= min_length]
-
-                # Filter stop words if requested
-                if filter_stop_words:
-                    words = [w for w in words if w not in STOP_WORDS]
+        print(f"🔍 Processing messages in {len(jobs)} ranges...")
+        if workers > 1:
+            # Spawned workers don't inherit this process's open connections
+            pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+            results = pool.map(_count_range, jobs)
+        else:
+            pool = None
+            results = map(_count_range, jobs)
 
+        try:
+            for messages, words, partial_groups, partial_names in results:
                 word_counter.update(words)
-
-            messages_processed += len(rows)
-            if messages_processed % 50000 == 0:
+                for key, counter in partial_groups.items():
+                    groups.setdefault(key, Counter()).update(counter)
+                names.update(partial_names)
+                messages_processed += messages
                 print(f"   Processed {messages_processed:,} messages...")
-
-        conn.close()
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
 
         print(f"✅ Processed {messages_processed:,} messages")
         print(f"📚 Unique words found: {len(word_counter):,}")
@@ -279,6 +381,9 @@ def analyze_words(
         print("=" * 70)
         print(f"📈 Total words analyzed: {total_words:,}")
 
+        if by:
+            print_breakdown(groups, names, by)
+
     except sqlite3.Error as e:
         print(f"❌ Database error: {e}")
         sys.exit(1)
@@ -290,28 +395,76 @@ def analyze_words(
         sys.exit(1)
 
 
+def print_breakdown(groups: dict[str, Counter], names: dict[str, str], by: str):
+    """Print the top words of each author (busiest first) or month (in order)."""
+    if by == "author":
+        keys = sorted(groups, key=lambda key: sum(groups[key].values()), reverse=True)
+        keys = keys[:BREAKDOWN_GROUPS]
+        print()
+        print(f"👥 Top words of the {len(keys)} wordiest authors:")
+    else:
+        keys = sorted(groups)
+        print()
+        print("📅 Top words by month:")
+    print("=" * 70)
+
+    for key in keys:
+        counter = groups[key]
+        label = (names.get(key) or key or "Unknown") if by == "author" else key
+        top = ", ".join(word for word, _ in counter.most_common(BREAKDOWN_WORDS))
+        print(f"{label[:20]:20s} {sum(counter.values()):9,}  {top}")
+
+    print("=" * 70)
+
+
 def main():
     """Main entry point."""
     # Parse command line arguments
     top_n = 100
     filter_stop_words = True
     min_length = 2
-
-    if len(sys.argv) > 1:
+    workers = 1
+    by = None
+
+    # Options may appear anywhere; the rest are positional
+    args = []
+    argv = iter(sys.argv[1:])
+    for arg in argv:
+        if arg in ("--workers", "-j"):
+            value = next(argv, "")
+            try:
+                workers = (
+                    len(os.sched_getaffinity(0)) if value == "auto" else int(value)
+                )
+            except ValueError:
+                print(f"❌ Invalid worker count: {value}")
+                sys.exit(1)
+            if workers < 1:
+                print(f"❌ Invalid worker count: {value}")
+                sys.exit(1)
+        elif arg == "--by":
+            by = next(argv, "")
+            if by not in ("author", "month"):
+                print(f"❌ --by must be author or month, not: {by}")
+                sys.exit(1)
+        else:
+            args.append(arg)
+
+    if len(args) > 0:
         try:
-            top_n = int(sys.argv[1])
+            top_n = int(args[0])
         except ValueError:
-            print(f"❌ Invalid number: {sys.argv[1]}")
+            print(f"❌ Invalid number: {args[0]}")
             sys.exit(1)
 
-    if len(sys.argv) > 2 and sys.argv[2] in ["all", "no-filter", "nofilter"]:
+    if len(args) > 1 and args[1] in ["all", "no-filter", "nofilter"]:
         filter_stop_words = False
 
-    if len(sys.argv) > 3:
+    if len(args) > 2:
         try:
-            min_length = int(sys.argv[3])
+            min_length = int(args[2])
         except ValueError:
-            print(f"❌ Invalid minimum length: {sys.argv[3]}")
+            print(f"❌ Invalid minimum length: {args[2]}")
             sys.exit(1)
 
     # Find database
@@ -323,13 +476,15 @@ def main():
         sys.exit(1)
 
     # Run analysis
-    analyze_words(db_path, top_n, filter_stop_words, min_length)
+    analyze_words(db_path, top_n, filter_stop_words, min_length, workers, by)
 
     print()
     print("💡 Usage tips:")
     print("   python script/analyze_words.py 50           # Top 50 words")
     print("   python script/analyze_words.py 100 all      # Include stop words")
     print("   python script/analyze_words.py 100 all 3    # Min 3 letters")
+    print("   python script/analyze_words.py 100 -j auto  # One worker per core")
+    print("   python script/analyze_words.py 20 --by month  # Top words per month")
 
 
 if __name__ == "__main__":
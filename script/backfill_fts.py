@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Build the full-text search index (messages_fts) for an existing archive.
+New archive batches index themselves; this catches up everything stored
+before the index existed. Safe to stop and rerun; it resumes where it left off.
+Run with: python script/backfill_fts.py [db_path]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from tsurugi.database import ARCHIVE_DB_PATH, backfill_fts  # noqa: E402
+
+
+def main():
+    db_path = ARCHIVE_DB_PATH
+
+    if len(sys.argv) > 1:
+        db_path = sys.argv[1]
+
+    if not os.path.exists(db_path):
+        print(f"❌ Database not found: {db_path}")
+        sys.exit(1)
+
+    print(f"📁 Indexing: {db_path}")
+    print("=" * 70)
+
+    start = time.monotonic()
+
+    def progress(indexed: int, total: int):
+        elapsed = time.monotonic() - start
+        rate = indexed / elapsed if elapsed else 0.0
+        print(
+            f"\r   Indexed {indexed:,} / {total:,} messages ({rate:,.0f} msg/s)",
+            end="",
+            flush=True,
+        )
+
+    try:
+        indexed = backfill_fts(db_path, progress=progress)
+    except KeyboardInterrupt:
+        print("\n\n👋 Stopped. Rerun to resume from the last committed batch.")
+        sys.exit(1)
+
+    print()
+    print("=" * 70)
+    print(f"✅ Indexed {indexed:,} messages in {time.monotonic() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
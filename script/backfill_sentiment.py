@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Score sentiment for every archived message that doesn't have it yet.
+Chunks of messages are scored across a process pool and written back in
+batched transactions. Safe to stop and rerun; it resumes where it left off.
+Run with: python script/backfill_sentiment.py [workers] [db_path]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from tsurugi.database import (  # noqa: E402
+    ARCHIVE_DB_PATH,
+    BACKFILL_WORKERS,
+    backfill_sentiment,
+)
+
+
+def main():
+    workers = BACKFILL_WORKERS
+    db_path = ARCHIVE_DB_PATH
+
+    if len(sys.argv) > 1:
+        try:
+            workers = int(sys.argv[1])
+        except ValueError:
+            print(f"❌ Invalid worker count: {sys.argv[1]}")
+            sys.exit(1)
+
+    if len(sys.argv) > 2:
+        db_path = sys.argv[2]
+
+    if not os.path.exists(db_path):
+        print(f"❌ Database not found: {db_path}")
+        sys.exit(1)
+
+    print(f"📁 Backfilling: {db_path}")
+    print(f"⚙️  Workers: {workers}")
+    print("=" * 70)
+
+    start = time.monotonic()
+
+    def progress(scored: int, total: int):
+        elapsed = time.monotonic() - start
+        rate = scored / elapsed if elapsed else 0.0
+        print(
+            f"\r   Scored {scored:,} / {total:,} messages ({rate:,.0f} msg/s)",
+            end="",
+            flush=True,
+        )
+
+    try:
+        scored = backfill_sentiment(db_path, workers=workers, progress=progress)
+    except KeyboardInterrupt:
+        print("\n\n👋 Stopped. Rerun to resume from the last committed batch.")
+        sys.exit(1)
+
+    print()
+    print("=" * 70)
+    print(f"✅ Scored {scored:,} messages in {time.monotonic() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
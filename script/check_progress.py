@@ -12,15 +12,21 @@ import sys
 def check_progress():
     # Search for database files in common locations
     search_paths = [
+        "archive.db",  # Consolidated archive
+        "src/tsurugi/data/archive.db",
+        "../src/tsurugi/data/archive.db",
         "*_messages.db",  # Current directory
         "src/*_messages.db",  # src directory
         "../*_messages.db",  # Parent directory
         "../src/*_messages.db",  # Parent's src directory
     ]
 
+    # Prefer the consolidated archive over per-run files
     db_files: list[str] = []
     for pattern in search_paths:
-        db_files.extend(glob.glob(pattern))
+        db_files = glob.glob(pattern)
+        if db_files:
+            break
 
     if not db_files:
         print("No database files found.")
@@ -42,32 +48,62 @@ def check_progress():
         conn = sqlite3.connect(f"file:{latest_db}?mode=ro", uri=True, timeout=30.0)
         cursor = conn.cursor()
 
-        # Get total message count
-        cursor.execute("SELECT COUNT(*) FROM messages")
-        total_count = cursor.fetchone()[0]
-
-        # Get unique author count
-        cursor.execute("SELECT COUNT(DISTINCT author_id) FROM messages")
-        author_count = cursor.fetchone()[0]
+        # Read the summary tables when the archive has them, so this stays
+        # fast however large the archive grows
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'daily_author_stats'")
+        if cursor.fetchone():
+            cursor.execute(
+                """SELECT SUM(message_count), COUNT(DISTINCT author_id)
+                   FROM daily_author_stats"""
+            )
+            total_count, author_count = cursor.fetchone()
+            total_count = total_count or 0
+
+            # Messages stored since the stats were last updated
+            cursor.execute(
+                """SELECT COUNT(*) FROM messages
+                   WHERE rowid > (SELECT last_rowid FROM stats_state)"""
+            )
+            pending = cursor.fetchone()[0]
+            total_count += pending
+
+            cursor.execute(
+                """SELECT author_name, message_count FROM author_stats
+                   ORDER BY message_count DESC
+                   LIMIT 5"""
+            )
+            top_authors = cursor.fetchall()
+        else:
+            pending = 0
+
+            # Get total message count
+            cursor.execute("SELECT COUNT(*) FROM messages")
+            total_count = cursor.fetchone()[0]
+
+            # Get unique author count
+            cursor.execute("SELECT COUNT(DISTINCT author_id) FROM messages")
+            author_count = cursor.fetchone()[0]
+
+            # Get top 5 authors
+            cursor.execute("""
+                SELECT author_name, COUNT(*) as count
+                FROM messages
+                GROUP BY author_id
+                ORDER BY count DESC
+                LIMIT 5
+            """)
+            top_authors = cursor.fetchall()
 
         # Get date range
         cursor.execute("SELECT MIN(created_at), MAX(created_at) FROM messages")
         min_date, max_date = cursor.fetchone()
 
-        # Get top 5 authors
-        cursor.execute("""
-            SELECT author_name, COUNT(*) as count
-            FROM messages
-            GROUP BY author_id
-            ORDER BY count DESC
-            LIMIT 5
-        """)
-        top_authors = cursor.fetchall()
-
         conn.close()
 
         # Display results
         print(f"📊 Messages archived: {total_count:,}")
+        if pending:
+            print(f"⏳ Not yet in the summary tables: {pending:,}")
         print(f"👥 Unique authors: {author_count:,}")
         print(
             f"📅 Date range: {min_date[:10] if min_date else 'N/A'} to {max_date[:10] if max_date else 'N/A'}"
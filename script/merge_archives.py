@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Merge per-run *_messages.db archive files into the consolidated archive.
+Guild and channel ids are taken from each file name; messages already in the
+consolidated archive are skipped. The per-run files are left untouched.
+Run with: python script/merge_archives.py [file ...]
+"""
+
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from tsurugi.database import (  # noqa: E402
+    ARCHIVE_DB_PATH,
+    find_legacy_archives,
+    merge_archives,
+)
+
+
+def main():
+    paths = sys.argv[1:] or find_legacy_archives()
+    if not paths:
+        print("No per-run archive files found.")
+        return
+
+    print(f"📁 Merging {len(paths)} file(s) into {ARCHIVE_DB_PATH}")
+    print("=" * 70)
+
+    merged = merge_archives(paths)
+    for path in sorted(merged):
+        print(f"  {os.path.basename(path)}: {merged[path]:,} new messages")
+
+    print("=" * 70)
+    print(f"✅ Added {sum(merged.values()):,} messages")
+    print("💡 Once you've checked the result, the per-run files can be deleted.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Split the comma-joined attachment urls of an existing archive into the
+attachments table. New archives fill it as they go; this is only needed
+once for messages stored before the table existed. Safe to stop and rerun.
+Run with: python script/migrate_attachments.py [db_path]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from tsurugi.database import ARCHIVE_DB_PATH, backfill_attachments  # noqa: E402
+
+
+def main():
+    db_path = ARCHIVE_DB_PATH
+
+    if len(sys.argv) > 1:
+        db_path = sys.argv[1]
+
+    if not os.path.exists(db_path):
+        print(f"❌ Database not found: {db_path}")
+        sys.exit(1)
+
+    print(f"📁 Migrating attachments: {db_path}")
+    print("=" * 70)
+
+    start = time.monotonic()
+
+    def progress(migrated: int):
+        print(f"\r   Split attachments of {migrated:,} messages", end="", flush=True)
+
+    try:
+        migrated = backfill_attachments(db_path, progress=progress)
+    except KeyboardInterrupt:
+        print("\n\n👋 Stopped. Rerun to resume from the last committed batch.")
+        sys.exit(1)
+
+    print()
+    print("=" * 70)
+    print(f"✅ Migrated {migrated:,} messages in {time.monotonic() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Copy the consolidated archive into one database file per month.
+Only messages stored since the last run are copied, so it is cheap to run
+after every archive. Query a range of months from Python with
+tsurugi.partitions.open_partitions(start="2025-01", end="2025-03").
+Run with: python script/partition_archive.py [db_path] [directory]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from tsurugi.database import ARCHIVE_DB_PATH  # noqa: E402
+from tsurugi.partitions import PARTITION_DIR, partition_archive  # noqa: E402
+
+
+def main():
+    db_path = ARCHIVE_DB_PATH
+    directory = PARTITION_DIR
+
+    if len(sys.argv) > 1:
+        db_path = sys.argv[1]
+
+    if len(sys.argv) > 2:
+        directory = sys.argv[2]
+
+    if not os.path.exists(db_path):
+        print(f"❌ Database not found: {db_path}")
+        sys.exit(1)
+
+    print(f"📁 Partitioning: {db_path}")
+    print(f"📂 Into: {directory}")
+    print("=" * 70)
+
+    start = time.monotonic()
+    try:
+        copied = partition_archive(db_path, directory)
+    except KeyboardInterrupt:
+        print("\n👋 Stopped. Rerun to pick up from the last copied batch.")
+        sys.exit(1)
+
+    for month, count in sorted(copied.items()):
+        print(f"   {month.replace('_', '-')}: {count:,} messages")
+
+    print("=" * 70)
+    print(
+        f"✅ Copied {sum(copied.values()):,} messages into {len(copied)} month(s) "
+        f"in {time.monotonic() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -22,22 +22,24 @@ def format_size(size_bytes):
 
 
 def find_latest_db():
-    """Find the most recent database file."""
+    """Find the consolidated archive, or the most recent per-run file."""
     search_paths = [
+        "archive.db",
+        "src/tsurugi/data/archive.db",
+        "../src/tsurugi/data/archive.db",
         "*_messages.db",
         "src/*_messages.db",
         "../*_messages.db",
         "../src/*_messages.db",
     ]
 
-    db_files = []
+    # Prefer the consolidated archive over per-run files
     for pattern in search_paths:
-        db_files.extend(glob.glob(pattern))
+        db_files = glob.glob(pattern)
+        if db_files:
+            return sorted(db_files)[-1]
 
-    if not db_files:
-        return None
-
-    return sorted(db_files)[-1]
+    return None
 
 
 def estimate_messages(size_bytes):
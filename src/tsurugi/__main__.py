@@ -1,11 +1,14 @@
 from .bot import bot
-from .config.config import DISCORD_TOKEN
+from .config.config import DISCORD_TOKEN, UDF_CACHE_SIZE
+from .database import configure_udf_caches
 
 
 def main():
     """Entry point for the Tsurugi Discord bot."""
     # Type narrowing - DISCORD_TOKEN is guaranteed to be str after config validation
     assert isinstance(DISCORD_TOKEN, str)
+    if UDF_CACHE_SIZE is not None:
+        configure_udf_caches(UDF_CACHE_SIZE)
     bot.run(DISCORD_TOKEN)
 
 
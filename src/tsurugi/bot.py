@@ -1,12 +1,27 @@
-import glob
+import asyncio
+import functools
+import hashlib
 import io
+import os
 import re
 
 import discord
-import matplotlib.pyplot as plt
 from discord.ext import commands
 
-from .database import store_messages
+from .charts import fetch_columns, parse_chart_spec
+from .database import (
+    ARCHIVE_DB_PATH,
+    BACKFILL_WORKERS,
+    backfill_fts,
+    backfill_sentiment,
+    backfill_stats,
+    find_legacy_archives,
+    store_guild_messages,
+    store_messages,
+    sync_authors,
+    udf_cache_stats,
+)
+from .export import export_results, resolve_format
 from .helpers.permissions import (
     get_user_permissions,
     grant_command,
@@ -21,23 +36,83 @@ from .helpers.safety import (
     RateLimitError,
     TimeoutError,
     check_code_safety,
-    get_safe_exec_globals,
+    format_size,
     rate_limit,
-    timeout,
+    refund_rate_limit,
+    safe_attribute_names,
     validate_sql_query,
 )
 from .mcserver import console_command, restart_server, start_server, stop_server
+from .plotting import (
+    PlotError,
+    parse_plot_options,
+    plot_cache,
+    plot_cache_key,
+    plot_pool,
+)
+from .query import (
+    QueryPlan,
+    QueryRejectedError,
+    QueueFullError,
+    SQLJob,
+    check_query,
+    query_pool,
+    render_text,
+    result_cache,
+)
 
 intents = discord.Intents.default()
 intents.message_content = True  # Enable access to message content
 
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+# Keep references to fire-and-forget tasks so they aren't garbage collected
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def score_new_messages(ctx):
+    """
+    Finish indexing, summarize and store sentiment for newly archived
+    messages, off the event loop. Archive batches index and count their own
+    rows, so the first two steps only have work left when an older archive
+    is being caught up for the first time.
+    """
+    try:
+        indexed = await asyncio.to_thread(backfill_fts)
+        counted = await asyncio.to_thread(backfill_stats)
+    except Exception as e:
+        await ctx.send(f"❌ Search index or stats backfill failed: {e}")
+        return
+    if indexed:
+        await ctx.send(f"🔎 Added {indexed:,} messages to the search index.")
+    if counted:
+        await ctx.send(f"📊 Added {counted:,} messages to the daily stats.")
+
+    try:
+        scored = await asyncio.to_thread(backfill_sentiment)
+    except Exception as e:
+        await ctx.send(f"❌ Sentiment backfill failed: {e}")
+        return
+    if scored:
+        await ctx.send(f"📈 Stored sentiment scores for {scored:,} messages.")
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
 
 @bot.event
 async def on_ready():
     if bot.user:
         print(f"Logged in as {bot.user.name} - {bot.user.id}")
+    # Load config/user_mappings.json into the archive's authors table
+    await asyncio.to_thread(sync_authors)
+    # Start the plot workers now rather than on the first !matplotlib,
+    # and build the attribute allowlist !matplotlib code is checked against
+    await plot_pool.warm_up()
+    await asyncio.to_thread(safe_attribute_names)
 
 
 @bot.command(name="ping")
@@ -108,11 +183,103 @@ async def unlock(ctx):
 
 @bot.command(name="archive")
 @is_anshu()
-async def archive(ctx):
-    # Goes through all messsages in the current channel and stores all data into a sqllite database
+async def archive(ctx, *options: str):
+    """
+    Archive the current channel, or every channel in the guild, into SQLite.
+    By default only messages newer than the last archive are fetched, and an
+    interrupted archive resumes from its last checkpoint.
+    Usage: !archive [guild] [full]
+    """
+    invalid = set(options) - {"guild", "full"}
+    if invalid:
+        await ctx.send("Invalid option. Usage: `!archive [guild] [full]`")
+        return
+    incremental = "full" not in options
+
     await ctx.send("Storing messages to SQLite. This may take a while...")
-    count = await store_messages(ctx)
-    await ctx.send(f"Stored {count} messages to SQLite database.")
+
+    if "guild" not in options:
+        count = await store_messages(ctx, incremental=incremental)
+        await ctx.send(f"Stored {count} messages to SQLite database.")
+        run_in_background(score_new_messages(ctx))
+        return
+
+    counts, errors = await store_guild_messages(ctx, incremental=incremental)
+    lines = [
+        f"{channel.mention}: {count:,}"
+        for channel, count in sorted(counts.items(), key=lambda item: -item[1])
+        if count
+    ]
+    lines += [f"{channel.mention}: ❌ {error}" for channel, error in errors.items()]
+    summary = "\n".join(lines) or "No new messages."
+    await ctx.send(
+        f"Stored {sum(counts.values()):,} messages from {len(counts)} channel(s).\n"
+        f"{summary}"[:2000]
+    )
+    run_in_background(score_new_messages(ctx))
+
+
+@bot.command(name="backfill")
+@is_anshu()
+async def backfill(ctx, workers: int = BACKFILL_WORKERS):
+    """
+    Score sentiment for every archived message that doesn't have it yet,
+    across a pool of worker processes (at most one per CPU). Safe to rerun;
+    it resumes.
+    Usage: !backfill [workers]
+    """
+    if not os.path.exists(ARCHIVE_DB_PATH):
+        await ctx.send("❌ No archive database found. Run `!archive` first.")
+        return
+    clamped = min(max(workers, 1), BACKFILL_WORKERS)
+    if clamped != workers:
+        await ctx.send(
+            f"⚠️ Workers must be between 1 and {BACKFILL_WORKERS}; using {clamped}."
+        )
+        workers = clamped
+
+    loop = asyncio.get_running_loop()
+    next_report = 0.1
+
+    def progress(scored: int, total: int):
+        # Called from the backfill thread; report every 10%
+        nonlocal next_report
+        if total and scored / total >= next_report:
+            next_report += 0.1
+            asyncio.run_coroutine_threadsafe(
+                ctx.send(f"Progress: {scored:,} / {total:,} messages scored..."), loop
+            )
+
+    await ctx.send(f"Scoring sentiment with {workers} worker(s)...")
+    scored = await asyncio.to_thread(
+        backfill_sentiment, workers=workers, progress=progress
+    )
+    await ctx.send(f"📈 Stored sentiment scores for {scored:,} messages.")
+
+
+@bot.command(name="cachestats")
+@is_anshu()
+async def cachestats(ctx):
+    """
+    Show hit rates for the SQL function, query result and plot caches.
+    Usage: !cachestats
+    """
+    embed = discord.Embed(title="Cache Stats", color=0x00FF00)
+    caches = {
+        **udf_cache_stats(),
+        "query results": result_cache.stats(),
+        "plots": plot_cache.stats(),
+    }
+    for name, stats in caches.items():
+        value = (
+            f"{stats.hit_rate:.1%} hit rate\n"
+            f"{stats.hits:,} hits / {stats.misses:,} misses\n"
+            f"{stats.size:,} / {stats.maxsize:,} entries"
+        )
+        if stats.max_bytes:
+            value += f"\n{format_size(stats.nbytes)} / {format_size(stats.max_bytes)}"
+        embed.add_field(name=name, value=value, inline=True)
+    await ctx.send(embed=embed)
 
 
 @bot.command(name="grant")
@@ -200,6 +367,9 @@ async def matplotlib(ctx, *, code: str = ""):
     """
     Executes matplotlib code and returns the generated plot as an image.
     Accepts Python code in text or from attached .txt/.py file.
+    Output options may come before the code: an encoding (png, png8 for a
+    smaller palette PNG, or webp), dpi=N and size=WxH in inches.
+    Usage: !matplotlib [png|png8|webp] [dpi=N] [size=WxH] <code>
 
     Example code input:
     ```python
@@ -208,6 +378,13 @@ async def matplotlib(ctx, *, code: str = ""):
     ```
 
     """
+    # Check for leading output options
+    try:
+        settings, code = parse_plot_options(code)
+    except ValueError as e:
+        await ctx.send(f"❌ {e}")
+        return
+
     # Check if there's an attachment
     if ctx.message.attachments:
         attachment = ctx.message.attachments[0]
@@ -240,51 +417,46 @@ async def matplotlib(ctx, *, code: str = ""):
         await ctx.send(f"❌ Unsafe code detected: {warning}")
         return
 
-    # Use restricted globals for safety
-    safe_globals = get_safe_exec_globals()
-    local_scope = {}
-
-    @timeout(5)  # 5 second timeout
-    def execute_code():
-        exec(code, safe_globals, local_scope)
-
     try:
-        # Execute the provided matplotlib code with timeout
-        execute_code()
-
-        # Save the current figure to a BytesIO object
-        img_bytes = io.BytesIO()
-        plt.savefig(img_bytes, format="png")
-        img_bytes.seek(0)
-
-        # Create a Discord file object
-        discord_file = discord.File(img_bytes, filename="plot.png")
-
-        # Send the image file in the channel
-        await ctx.send(file=discord_file)
+        cache_key = plot_cache_key(code, settings)
+        image = None
+        if cache_key:
+            image = await asyncio.to_thread(plot_cache.get, cache_key)
+
+        if image is not None:
+            # A cached plot costs nothing, so it doesn't use up the rate limit
+            refund_rate_limit(ctx)
+        else:
+            # Rendered in a sandboxed worker process, off the event loop
+            image, _ = await plot_pool.render(code, settings)
+            if cache_key:
+                await asyncio.to_thread(plot_cache.put, cache_key, image)
 
-        # Clear the current figure to avoid overlap in future plots
-        plt.clf()
+        await ctx.send(
+            file=discord.File(io.BytesIO(image), filename=f"plot.{settings.extension}")
+        )
 
     except TimeoutError:
         await ctx.send("❌ Code execution timed out (5 second limit)")
-        plt.clf()
+    except MemoryError:
+        await ctx.send("❌ Plot exceeded its memory limit")
+    except QueueFullError as e:
+        await ctx.send(f"⏳ {e}")
+    except PlotError as e:
+        await ctx.send(f"❌ {e}")
     except RateLimitError as e:
         await ctx.send(f"⏱️ {e}")
     except Exception as e:
         await ctx.send(f"❌ Error executing matplotlib code: {e}")
-        plt.clf()
 
 
-@bot.command(name="runsql")
-@requires_permission("runsql")
-@rate_limit(calls=10, period=60)  # 10 queries per minute
-async def runsql(ctx, *, query: str = ""):
+async def read_sql_input(ctx, query: str) -> str | None:
     """
-    Runs a SQL query on the database file in the current directory.
-    Accepts SQL in code blocks like: ```sql SELECT * FROM messages```
-    Can also read SQL from attached .txt file.
-    Returns results as a .txt file.
+    Take a !runsql or !sqlplot query from the message text, a code block or
+    an attached file, and check that the archive exists. Reports problems
+    to the channel.
+    Returns:
+        The query, or None if the command should stop
     """
     # Check if there's an attachment
     if ctx.message.attachments:
@@ -296,14 +468,14 @@ async def runsql(ctx, *, query: str = ""):
             query = content_bytes.decode("utf-8")
         except Exception as e:
             await ctx.send(f"❌ Error reading attachment: {e}")
-            return
+            return None
 
     # If no query after checking attachment, send error
     if not query or query.strip() == "":
         await ctx.send(
             "❌ No SQL query provided. Either type a query or attach a .txt file."
         )
-        return
+        return None
 
     # Extract SQL from code block if present
     code_block_pattern = r"```(?:sql)?\s*\n?(.*?)\n?```"
@@ -316,76 +488,183 @@ async def runsql(ctx, *, query: str = ""):
     is_valid, error_msg = validate_sql_query(query)
     if not is_valid:
         await ctx.send(f"❌ Query validation failed: {error_msg}")
-        return
+        return None
 
-    # Find any database file (not channel-specific)
-    pattern = "*_messages.db"
-    matching_files = glob.glob(pattern)
+    # All channels live in the consolidated archive
+    if not os.path.exists(ARCHIVE_DB_PATH):
+        if find_legacy_archives():
+            await ctx.send(
+                "❌ Only per-run archive files found. "
+                "Run `python script/merge_archives.py` to consolidate them."
+            )
+        else:
+            await ctx.send("❌ No archive database found. Run `!archive` first.")
+        return None
 
-    if not matching_files:
-        await ctx.send("❌ No database files found. Run `!archive` first.")
-        return
+    return query
 
-    # Get the most recent file (sorted by name, which includes timestamp)
-    db_path = sorted(matching_files)[-1]
 
+async def plan_sql_query(ctx, query: str) -> QueryPlan | None:
+    """
+    Compile a query read-only and check its plan before it takes a query
+    worker, sending its warnings to the channel. Only needed on a cache
+    miss: a cached result was checked when it was computed, and is dropped
+    as soon as the archive changes.
+    Returns:
+        The QueryPlan, or None if the query was rejected
+    """
     try:
-        # Run query with timeout wrapper
-        @timeout(10)  # 10 second timeout for queries
-        def execute_query():
-            import sqlite3
-
-            conn = sqlite3.connect(db_path, timeout=5.0)
-            # Register custom SQL functions
-            from .database import (
-                is_tracked,
-                real_name,
-                sentiment_label,
-                sentiment_polarity,
-                sentiment_subjectivity,
-                word_count,
-            )
+        plan = await asyncio.to_thread(check_query, ARCHIVE_DB_PATH, query)
+    except QueryRejectedError as e:
+        await ctx.send(f"❌ Query validation failed: {e}")
+        return None
+    for warning in plan.warnings:
+        await ctx.send(f"⚠️ {warning}")
+    return plan
 
-            conn.create_function("sentiment_polarity", 1, sentiment_polarity)
-            conn.create_function("sentiment_subjectivity", 1, sentiment_subjectivity)
-            conn.create_function("sentiment_label", 1, sentiment_label)
-            conn.create_function("word_count", 1, word_count)
-            conn.create_function("real_name", 1, real_name)
-            conn.create_function("is_tracked", 1, is_tracked)
 
-            c = conn.cursor()
-            c.execute(query)
-            results = c.fetchall()
-            conn.close()
-            return results
+@bot.command(name="runsql")
+@requires_permission("runsql")
+@rate_limit(calls=10, period=60)  # 10 queries per minute
+async def runsql(ctx, *, query: str = ""):
+    """
+    Runs a SQL query on the consolidated message archive.
+    Accepts SQL in code blocks like: ```sql SELECT * FROM messages```
+    Can also read SQL from attached .txt file.
+    Repeated queries are answered from a cache until the archive changes.
+    Returns results as a .txt file, or in an export format named before the
+    query: csv.gz, jsonl.gz or npz (columnar). Exports too large for one
+    upload are split into several parts.
+    Usage: !runsql [csv.gz|jsonl.gz|npz] <query>
+    """
+    # Check for a leading export format
+    fmt = None
+    first, _, rest = query.strip().partition(" ")
+    if first and resolve_format(first):
+        fmt = resolve_format(first)
+        query = rest
+
+    query = await read_sql_input(ctx, query)
+    if query is None:
+        return
+    db_path = ARCHIVE_DB_PATH
 
-        results = execute_query()
+    try:
+        # Picks up edits to config/user_mappings.json; a stat when unchanged
+        await asyncio.to_thread(sync_authors)
+        cache_key = result_cache.key(db_path, query, fmt)
+        result = result_cache.get(cache_key)
 
-        if not results:
-            response = "Query executed successfully, but no results to display."
+        if result is not None:
+            summary = f"{result.row_count:,} row(s). ⚡ Cached result"
         else:
-            result_str = "\n".join([str(row) for row in results])
-            response = f"Query Results:\n{result_str}"
-
-        # Create a text file with the results
-        file_content = f"SQL Query:\n{query}\n\n{'=' * 60}\n\nResults:\n{response}"
-        file_bytes = io.BytesIO(file_content.encode("utf-8"))
-        file_bytes.seek(0)
-
-        # Create Discord file object
-        discord_file = discord.File(file_bytes, filename="query_results.txt")
+            if await plan_sql_query(ctx, query) is None:
+                return
+            # Queue the query on the worker pool so the event loop stays free
+            if query_pool.queue_depth:
+                await ctx.send(
+                    f"⏳ {query_pool.queue_depth} queued query(s) ahead of yours..."
+                )
+            render = functools.partial(export_results, fmt=fmt) if fmt else render_text
+            result, stats = await query_pool.run(
+                SQLJob(db_path, query, timeout=10, render=render)
+            )
+            result_cache.put(cache_key, result)
+            summary = (
+                f"{result.row_count:,} row(s). Waited {stats.wait_time:.1f}s in "
+                f"queue, ran in {stats.run_time:.1f}s"
+            )
 
-        # Send only the file, no preview
-        await ctx.send(file=discord_file)
+        # Send the files, one part per message
+        if len(result.files) > 1:
+            summary += f"\n📦 Split into {len(result.files)} parts"
+        if result.truncated:
+            summary += f"\n⚠️ Results truncated to {result.row_count:,} rows"
+        for i, (filename, data) in enumerate(result.files):
+            discord_file = discord.File(data, filename=filename)
+            await ctx.send(summary if i == 0 else None, file=discord_file)
 
     except TimeoutError:
         await ctx.send("❌ Query execution timed out (10 second limit)")
+    except QueueFullError as e:
+        await ctx.send(f"⏳ {e}")
     except RateLimitError as e:
         await ctx.send(f"⏱️ {e}")
     except Exception as e:
         await ctx.send(f"❌ Error executing query: {e}")
 
 
+@bot.command(name="sqlplot")
+@requires_permission("runsql")
+@rate_limit(calls=10, period=60)  # Shares the budget size of !runsql
+async def sqlplot(ctx, *, query: str = ""):
+    """
+    Charts the results of a SQL query on the consolidated message archive.
+    line and bar charts put the first column on the x axis and plot each
+    following column as a series; hist draws a histogram of every column.
+    Options: bins=N and log (log y axis), plus the !matplotlib output
+    options. Needs permission for !runsql.
+    Usage: !sqlplot <line|bar|hist> [bins=N] [log] [png8|webp] [dpi=N] [size=WxH] <query>
+    Example: !sqlplot line SELECT date(created_at) AS day, COUNT(*) AS messages
+        FROM messages GROUP BY day
+    """
+    try:
+        spec, settings, query = parse_chart_spec(query)
+    except ValueError as e:
+        await ctx.send(f"❌ {e}")
+        return
+
+    query = await read_sql_input(ctx, query)
+    if query is None:
+        return
+    db_path = ARCHIVE_DB_PATH
+
+    try:
+        # Picks up edits to config/user_mappings.json; a stat when unchanged
+        await asyncio.to_thread(sync_authors)
+        # Charts are keyed like query results, so they expire with the archive
+        cache_key = hashlib.sha256(
+            repr((result_cache.key(db_path, query, "chart"), spec, settings)).encode()
+        ).hexdigest()
+        image = await asyncio.to_thread(plot_cache.get, cache_key)
+
+        if image is not None:
+            refund_rate_limit(ctx)
+            summary = "⚡ Cached chart"
+        else:
+            if await plan_sql_query(ctx, query) is None:
+                return
+            render = functools.partial(fetch_columns, max_rows=spec.max_rows)
+            data, stats = await query_pool.run(
+                SQLJob(db_path, query, timeout=10, render=render)
+            )
+            image, _ = await plot_pool.chart(spec, data, settings)
+            await asyncio.to_thread(plot_cache.put, cache_key, image)
+            summary = f"{data.row_count:,} row(s), queried in {stats.run_time:.1f}s"
+            if data.truncated:
+                summary += f"\n⚠️ Only the first {data.row_count:,} rows are charted"
+
+        await ctx.send(
+            summary,
+            file=discord.File(
+                io.BytesIO(image), filename=f"chart.{settings.extension}"
+            ),
+        )
+
+    except TimeoutError:
+        await ctx.send("❌ Query or chart timed out")
+    except MemoryError:
+        await ctx.send("❌ Chart exceeded its memory limit")
+    except QueueFullError as e:
+        await ctx.send(f"⏳ {e}")
+    except PlotError as e:
+        await ctx.send(f"❌ {e}")
+    except RateLimitError as e:
+        await ctx.send(f"⏱️ {e}")
+    except Exception as e:
+        await ctx.send(f"❌ Error charting query: {e}")
+
+
 @bot.event
 async def on_command_error(ctx, error):
     """Handle command errors, particularly permission errors."""
@@ -8,3 +8,8 @@ dotenv.load_dotenv()
 DISCORD_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 if not DISCORD_TOKEN:
     raise RuntimeError("DISCORD_BOT_TOKEN not set")
+
+# Optional size of the sentiment UDF cache; database.UDF_CACHE_SIZE if unset
+UDF_CACHE_SIZE = (
+    int(os.environ["UDF_CACHE_SIZE"]) if os.getenv("UDF_CACHE_SIZE") else None
+)
@@ -1,104 +1,861 @@
+import asyncio
+import collections
+import contextlib
 import datetime
+import hashlib
+import itertools
 import json
+import mimetypes
+import multiprocessing
 import os
+import re
 import sqlite3
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable
 
+import discord
 from textblob import TextBlob
 
+from .helpers.cache import LRUCache
+from .helpers.safety import sqlite_read_only
+from .text import split_tokens, tokenize_batch, word_counts
+
 # Load user mappings
 USER_MAPPINGS = {}
 USER_MAPPINGS_PATH = os.path.join(
     os.path.dirname(__file__), "config", "user_mappings.json"
 )
 
-try:
-    with open(USER_MAPPINGS_PATH, "r") as f:
-        data = json.load(f)
-        # Create a reverse mapping: user_id -> real_name
-        for real_name, user_data in data["users"].items():
-            for account in user_data["accounts"]:
-                USER_MAPPINGS[account["user_id"]] = user_data["name"]
-except FileNotFoundError:
-    print(f"Warning: User mappings file not found at {USER_MAPPINGS_PATH}")
-except Exception as e:
-    print(f"Warning: Could not load user mappings: {e}")
 
+def load_user_mappings(path: str = USER_MAPPINGS_PATH) -> list[tuple] | None:
+    """
+    Read the user mappings file into USER_MAPPINGS, replacing its contents.
+    Returns:
+        One (account_id, real_name, person, username) row per mapped account,
+        for the authors table, or None if the file couldn't be read, in which
+        case USER_MAPPINGS is left as it was.
+    """
+    authors = []
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+            # Create a reverse mapping: user_id -> real_name
+            for person, user_data in data["users"].items():
+                for account in user_data["accounts"]:
+                    authors.append(
+                        (
+                            account["user_id"],
+                            user_data["name"],
+                            person,
+                            account.get("username"),
+                        )
+                    )
+    except FileNotFoundError:
+        print(f"Warning: User mappings file not found at {path}")
+        return None
+    except Exception as e:
+        print(f"Warning: Could not load user mappings: {e}")
+        return None
 
-async def initialize_database(db_path: str):
-    conn = sqlite3.connect(db_path)
+    USER_MAPPINGS.clear()
+    USER_MAPPINGS.update((author_id, name) for author_id, name, _, _ in authors)
+    return authors
+
+
+load_user_mappings()
+
+
+# Ingestion tuning. Rows are buffered and written with executemany, and every
+# batch is committed on its own so a crash mid-archive only loses the rows
+# still sitting in the buffer.
+ARCHIVE_BATCH_SIZE = 1000
+SQLITE_JOURNAL_MODE = "WAL"
+SQLITE_SYNCHRONOUS = "NORMAL"
+SQLITE_CACHE_SIZE = -64000  # Negative values are KiB, so roughly 64 MB
+# Number of channels paged through at once by a guild-wide archive
+ARCHIVE_CONCURRENCY = 4
+# Processes used to score sentiment for a bulk backfill, and the most
+# !backfill accepts
+BACKFILL_WORKERS = os.cpu_count() or 1
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+# Every guild and channel is archived into this one file
+ARCHIVE_DB_PATH = os.path.join(DATA_DIR, "archive.db")
+# Per-run files written before the consolidated archive existed
+LEGACY_ARCHIVE_PATTERN = re.compile(r"^\d{8}_\d{6}_(\d+)_(\d+)_messages\.db$")
+
+MESSAGE_COLUMNS = (
+    "message_id",
+    "author_id",
+    "author_name",
+    "content",
+    "created_at",
+    "attachments",
+    "guild_id",
+    "channel_id",
+)
+# Discord snowflakes carry their creation time as milliseconds since this
+# epoch in the bits above 22
+DISCORD_EPOCH_MS = 1420070400000
+# Unix time in milliseconds, derived from the message id. It is a virtual
+# generated column, so it costs no storage and needs no backfill; only its
+# index stores the values.
+CREATED_MS_COLUMN = (
+    "INTEGER GENERATED ALWAYS AS "
+    f"((CAST(message_id AS INTEGER) >> 22) + {DISCORD_EPOCH_MS}) VIRTUAL"
+)
+# One row per attachment; position keeps the order Discord listed them in
+ATTACHMENT_COLUMNS = (
+    "message_id",
+    "position",
+    "url",
+    "filename",
+    "size",
+    "content_type",
+)
+# Columns added after the original schema, upgraded in place by ensure_schema.
+# polarity/subjectivity hold precomputed sentiment and stay NULL until scored.
+ADDED_COLUMNS = {
+    "guild_id": "TEXT",
+    "channel_id": "TEXT",
+    "polarity": "REAL",
+    "subjectivity": "REAL",
+    "created_ms": CREATED_MS_COLUMN,
+    "words": "INTEGER",
+}
+# Rows indexed per commit by the full-text backfill
+FTS_BATCH_SIZE = 10000
+# Messages split per commit when migrating comma-joined attachment URLs
+ATTACHMENT_BATCH_SIZE = 10000
+# Rows summarized per commit when catching up the daily stats table
+STATS_BATCH_SIZE = 50000
+# The most older rows a single archive batch brings into the search index
+# and daily stats on top of its own
+SYNC_LIMIT = 5000
+# Entries kept by the sentiment UDF cache. Chat is full of short repeats
+# ("lol", "ok", emoji), so even a modest cache absorbs most lookups. Set
+# UDF_CACHE_SIZE in .env to change it (see configure_udf_caches).
+UDF_CACHE_SIZE = 100_000
+
+# Calls on the author_id column that can be answered from the authors table.
+# "is_tracked(author_id) = 1" is matched whole so it can become an indexed IN.
+AUTHOR_CALL_PATTERN = re.compile(
+    r"\b(real_name|is_tracked)\s*\(\s*((?:\w+\.)?author_id)\s*\)(\s*=\s*1(?![\w.]))?",
+    re.IGNORECASE,
+)
+# What comes before and after "is_tracked(author_id) = 1" when the comparison
+# is a whole predicate or column, rather than part of a larger expression
+PREDICATE_START_PATTERN = re.compile(
+    r"(?:\b(?:SELECT|WHERE|AND|OR|NOT|ON|HAVING|WHEN)|[(,])\s*$", re.IGNORECASE
+)
+PREDICATE_END_PATTERN = re.compile(
+    r"\s*(?:$|[),;]|\b(?:AND|OR|THEN|AS|FROM|GROUP|ORDER|LIMIT|WINDOW|UNION"
+    r"|EXCEPT|INTERSECT)\b)",
+    re.IGNORECASE,
+)
+# word_count calls on the content column, answered from the words column
+WORD_COUNT_CALL_PATTERN = re.compile(
+    r"\bword_count\s*\(\s*((?:\w+\.)?)content\s*\)", re.IGNORECASE
+)
+# Calls on the content column that can be answered from stored scores
+SENTIMENT_CALL_PATTERN = re.compile(
+    r"\b(sentiment_polarity|sentiment_subjectivity|sentiment_label)"
+    r"\s*\(\s*((?:\w+\.)?)content\s*\)",
+    re.IGNORECASE,
+)
+# String literals and quoted identifiers, which the rewrites leave alone
+QUOTED_SQL_PATTERN = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+# A leading EXPLAIN or EXPLAIN QUERY PLAN
+EXPLAIN_PATTERN = re.compile(r"\s*EXPLAIN(?:\s+QUERY\s+PLAN)?\s+", re.IGNORECASE)
+# What those rewrites leave for rows without a stored value, such as
+# COALESCE(m.polarity, sentiment_polarity(m.content))
+UDF_FALLBACK_PATTERN = re.compile(
+    r"COALESCE\(((?:\w+\.)?)(polarity|subjectivity|words), "
+    r"(?:sentiment_polarity|sentiment_subjectivity|word_count)\(\1content\)\)"
+)
+# Rough cost of one call to each custom SQL function, in row visits
+# (about 150 ns each). TextBlob scoring dominates everything else.
+UDF_COSTS = {
+    "sentiment_polarity": 1000,
+    "sentiment_subjectivity": 1000,
+    "sentiment_label": 1000,
+    "word_count": 20,
+    "real_name": 3,
+    "is_tracked": 3,
+    "polarity_label": 3,
+}
+
+JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
 
+
+# Bumped whenever this process commits new archive data, so anything
+# derived from the archive (like cached query results) can tell it's stale
+_data_versions = itertools.count(1)
+_data_version = 0
+
+
+def data_version() -> int:
+    """Returns a number that changes every time archive data is committed."""
+    return _data_version
+
+
+def bump_data_version():
+    global _data_version
+    _data_version = next(_data_versions)
+
+
+@contextlib.contextmanager
+def write_transaction(conn: sqlite3.Connection):
+    """
+    Run the block in a transaction that takes the write lock up front
+    (BEGIN IMMEDIATE), committing it on success and rolling back on error.
+    Anything that reads a watermark and then writes past it needs this: in
+    an ordinary transaction the read happens before the lock is taken, so
+    two connections can both act on the same rows. Changes the caller has
+    left pending are committed first, as `with conn:` would have.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def apply_pragmas(
+    conn: sqlite3.Connection,
+    journal_mode: str = SQLITE_JOURNAL_MODE,
+    synchronous: str = SQLITE_SYNCHRONOUS,
+    cache_size: int = SQLITE_CACHE_SIZE,
+):
+    """
+    Apply the write-path pragmas to a connection.
+    WAL lets readers (like !runsql or the progress scripts) keep working
+    while an archive is being written, and NORMAL sync is safe under WAL.
+    """
+    journal_mode = journal_mode.upper()
+    synchronous = synchronous.upper()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"Unknown journal mode: {journal_mode}")
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(f"Unknown synchronous mode: {synchronous}")
+
+    conn.execute(f"PRAGMA journal_mode={journal_mode}")
+    conn.execute(f"PRAGMA synchronous={synchronous}")
+    conn.execute(f"PRAGMA cache_size={int(cache_size)}")
+
+
+def ensure_schema(conn: sqlite3.Connection):
+    """
+    Create the archive tables and indexes if they don't exist yet.
+    Older archives without guild/channel columns are upgraded in place.
+    """
     c = conn.cursor()
-    # store message id, author id, author name, content, created at, attachments (as a comma separated list of urls)
+    # store message id, author id, author name, content, created at, attachments
+    # (as a comma separated list of urls), where the message was posted, its
+    # precomputed sentiment scores and word count, and its creation time as a
+    # unix timestamp
     c.execute(
-        """CREATE TABLE IF NOT EXISTS messages
+        f"""CREATE TABLE IF NOT EXISTS messages
                  (message_id TEXT PRIMARY KEY,
                  author_id TEXT, author_name TEXT,
                  content TEXT,
                  created_at TEXT,
-                 attachments TEXT)"""
+                 attachments TEXT,
+                 guild_id TEXT,
+                 channel_id TEXT,
+                 polarity REAL,
+                 subjectivity REAL,
+                 created_ms {CREATED_MS_COLUMN},
+                 words INTEGER)"""
+    )
+    # table_xinfo, unlike table_info, lists generated columns
+    columns = {row[1] for row in c.execute("PRAGMA table_xinfo(messages)")}
+    for column, column_type in ADDED_COLUMNS.items():
+        if column not in columns:
+            c.execute(f"ALTER TABLE messages ADD COLUMN {column} {column_type}")
+
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_author_id ON messages (author_id)"
+    )
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at)"
+    )
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_created_ms ON messages (created_ms)"
+    )
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_messages_channel_created
+           ON messages (channel_id, created_at)"""
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_polarity ON messages (polarity)")
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_messages_subjectivity
+           ON messages (subjectivity)"""
+    )
+    # only rows still waiting for a word count, so finding one is cheap
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_messages_words_missing
+           ON messages (words) WHERE words IS NULL"""
     )
-    return conn, c
 
+    # one row per archived channel, recording the newest committed message
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS archive_state
+                 (guild_id TEXT,
+                 channel_id TEXT,
+                 last_message_id TEXT,
+                 last_created_at TEXT,
+                 completed INTEGER DEFAULT 0,
+                 updated_at TEXT,
+                 PRIMARY KEY (guild_id, channel_id))"""
+    )
+
+    # full-text index over message content, keyed by messages.rowid. The
+    # table is contentless: it stores only the index, filled with the same
+    # tokens analyze_words counts, so apostrophes are kept inside words
+    c.execute(
+        """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5
+                 (content, content='', tokenize="unicode61 tokenchars ''''")"""
+    )
 
-async def store_messages(ctx):
+    # attachments of each message. Archived messages have their filename,
+    # size and content type; ones split out of an older archive's
+    # comma-joined urls only have a type guessed from the file name
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS attachments
+                 (message_id TEXT,
+                 position INTEGER,
+                 url TEXT,
+                 filename TEXT,
+                 size INTEGER,
+                 content_type TEXT,
+                 PRIMARY KEY (message_id, position))"""
+    )
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_attachments_content_type
+           ON attachments (content_type)"""
+    )
+
+    # mapped accounts from config/user_mappings.json, kept in sync by
+    # sync_authors. account_id joins to messages.author_id (it is named
+    # differently so lookups on author_id can't resolve to this table) and
+    # person is the key of the user in the mappings file
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS authors
+                 (account_id TEXT PRIMARY KEY,
+                 real_name TEXT,
+                 person TEXT,
+                 username TEXT)"""
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_authors_real_name ON authors (real_name)")
+
+    # message, word and attachment counts per author, channel and UTC day,
+    # kept up to date as messages are stored. stats_state records the last
+    # messages rowid that has been counted
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS daily_author_stats
+                 (day TEXT,
+                 guild_id TEXT,
+                 channel_id TEXT,
+                 author_id TEXT,
+                 author_name TEXT,
+                 message_count INTEGER DEFAULT 0,
+                 word_count INTEGER DEFAULT 0,
+                 attachment_count INTEGER DEFAULT 0,
+                 PRIMARY KEY (day, channel_id, author_id))"""
+    )
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_daily_author_stats_author
+           ON daily_author_stats (author_id)"""
+    )
+    c.execute(
+        """CREATE VIEW IF NOT EXISTS author_stats AS
+           SELECT author_id, MAX(author_name) AS author_name,
+                  SUM(message_count) AS message_count,
+                  SUM(word_count) AS word_count,
+                  SUM(attachment_count) AS attachment_count,
+                  MIN(day) AS first_day, MAX(day) AS last_day
+           FROM daily_author_stats GROUP BY author_id"""
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS stats_state
+                 (id INTEGER PRIMARY KEY CHECK (id = 1),
+                 last_rowid INTEGER NOT NULL)"""
+    )
+    c.execute("INSERT OR IGNORE INTO stats_state VALUES (1, 0)")
+    conn.commit()
+
+
+async def initialize_database(
+    db_path: str = ARCHIVE_DB_PATH,
+    journal_mode: str = SQLITE_JOURNAL_MODE,
+    synchronous: str = SQLITE_SYNCHRONOUS,
+    cache_size: int = SQLITE_CACHE_SIZE,
+):
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    apply_pragmas(conn, journal_mode, synchronous, cache_size)
+    ensure_schema(conn)
+    return conn, conn.cursor()
+
+
+def find_legacy_archives(directory: str = DATA_DIR) -> list[str]:
+    """
+    Returns the per-run *_messages.db files in a directory, oldest first.
     """
-    Stores all messages from the current channel into a SQLite database.
-    The database file is named with the current datetime, guild id, and channel id.
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if LEGACY_ARCHIVE_PATTERN.match(name)
+    )
+
+
+def merge_archives(paths: list[str], db_path: str = ARCHIVE_DB_PATH) -> dict:
+    """
+    Merge per-run archive files into the consolidated archive.
+    Files are merged newest first so the most recent snapshot of a message
+    wins; duplicates across runs are skipped by the primary key. The guild
+    and channel ids are taken from each file name.
     Args:
-        ctx: The context of the command.
+        paths: Legacy *_messages.db files to merge.
+        db_path: The consolidated archive to merge into.
     Returns:
-        The number of messages stored."""
+        A dict mapping each merged path to the number of new rows it added.
+    """
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    apply_pragmas(conn)
+    ensure_schema(conn)
+
+    merged = {}
+    try:
+        for path in sorted(paths, reverse=True):
+            match = LEGACY_ARCHIVE_PATTERN.match(os.path.basename(path))
+            if not match:
+                raise ValueError(f"Not a per-run archive file: {path}")
+            guild_id, channel_id = match.groups()
 
-    now = datetime.datetime.now()
-    datetime_str = now.strftime("%Y%m%d_%H%M%S")
-    db_filename = f"{datetime_str}_{ctx.guild.id}_{ctx.channel.id}_messages.db"
-    db_path = os.path.join(os.path.dirname(__file__), "data", db_filename)
+            conn.execute("ATTACH DATABASE ? AS legacy", (path,))
+            try:
+                with conn:
+                    before = conn.total_changes
+                    conn.execute(
+                        f"""INSERT OR IGNORE INTO messages ({", ".join(MESSAGE_COLUMNS)})
+                            SELECT message_id, author_id, author_name, content,
+                                   created_at, attachments, ?, ?
+                            FROM legacy.messages""",
+                        (guild_id, channel_id),
+                    )
+                    merged[path] = conn.total_changes - before
+                bump_data_version()
+            finally:
+                conn.execute("DETACH DATABASE legacy")
+        index_all_messages(conn)
+        update_all_stats(conn)
+        fill_word_counts(conn)
+        migrate_attachments(conn)
+    finally:
+        conn.close()
+    return merged
 
-    conn, c = await initialize_database(db_path)
 
-    count = 0
-    milestones = {100, 1000, 10000, 100000}
-    last_100k_milestone = 0
+def get_checkpoint(conn: sqlite3.Connection, guild_id, channel_id):
+    """
+    Returns (last_message_id, last_created_at, completed) for a channel.
+    Falls back to the newest stored message for archives written before
+    checkpoints were recorded. Returns None if nothing is stored.
+    """
+    row = conn.execute(
+        """SELECT last_message_id, last_created_at, completed
+           FROM archive_state WHERE guild_id = ? AND channel_id = ?""",
+        (str(guild_id), str(channel_id)),
+    ).fetchone()
+    if row and row[0]:
+        return row[0], row[1], bool(row[2])
+
+    row = conn.execute(
+        """SELECT message_id, created_at FROM messages WHERE channel_id = ?
+           ORDER BY CAST(message_id AS INTEGER) DESC LIMIT 1""",
+        (str(channel_id),),
+    ).fetchone()
+    if row:
+        return row[0], row[1], True
+    return None
 
-    async for message in ctx.channel.history(limit=None, oldest_first=True):
-        attachments = ",".join([attachment.url for attachment in message.attachments])
-        c.execute(
-            "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+
+def mark_archive_complete(conn: sqlite3.Connection, guild_id, channel_id):
+    """Flag a channel's checkpoint as belonging to a finished archive run."""
+    with conn:
+        conn.execute(
+            """UPDATE archive_state SET completed = 1, updated_at = ?
+               WHERE guild_id = ? AND channel_id = ?""",
             (
-                str(message.id),
-                str(message.author.id),
-                message.author.name,
-                message.content,
-                message.created_at.isoformat(),
-                attachments,
+                datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                str(guild_id),
+                str(channel_id),
             ),
         )
-        count += 1
 
+
+def message_to_row(message) -> tuple:
+    """
+    Convert a discord.Message into a row for the messages table,
+    in MESSAGE_COLUMNS order.
+    """
+    attachments = ",".join([attachment.url for attachment in message.attachments])
+    return (
+        str(message.id),
+        str(message.author.id),
+        message.author.name,
+        message.content,
+        message.created_at.isoformat(),
+        attachments,
+        str(message.guild.id) if message.guild else None,
+        str(message.channel.id),
+    )
+
+
+def message_to_attachment_rows(message) -> list[tuple]:
+    """
+    Convert a discord.Message's attachments into rows for the attachments
+    table, in ATTACHMENT_COLUMNS order.
+    """
+    return [
+        (
+            str(message.id),
+            position,
+            attachment.url,
+            attachment.filename,
+            attachment.size,
+            attachment.content_type,
+        )
+        for position, attachment in enumerate(message.attachments)
+    ]
+
+
+def split_attachment_urls(message_id: str, attachments: str) -> list[tuple]:
+    """
+    Rows for the attachments table from a comma-joined url string. The size
+    is unknown and the content type is guessed from the file name.
+    """
+    if not attachments:
+        return []
+    rows = []
+    for position, url in enumerate(attachments.split(",")):
+        filename = urllib.parse.unquote(
+            os.path.basename(urllib.parse.urlparse(url).path)
+        )
+        content_type = mimetypes.guess_type(filename)[0]
+        rows.append((message_id, position, url, filename, None, content_type))
+    return rows
+
+
+class MessageWriter:
+    """
+    Buffered writer for the messages table.
+    Rows are collected with add() and written with executemany once the
+    buffer reaches batch_size. Each batch is its own transaction.
+    With checkpoint enabled, archive_state is updated for every channel in
+    the batch within the same transaction, so an interrupted run can resume
+    from the last committed batch. Rows from several channels can share one
+    writer. Attachment rows, the full-text index and the daily stats are
+    written in the same transaction.
+    """
+
+    INSERT_SQL = (
+        f"INSERT OR IGNORE INTO messages ({', '.join(MESSAGE_COLUMNS)}, words) "
+        f"VALUES ({', '.join('?' for _ in MESSAGE_COLUMNS)}, ?)"
+    )
+    ATTACHMENT_SQL = (
+        f"INSERT OR IGNORE INTO attachments ({', '.join(ATTACHMENT_COLUMNS)}) "
+        f"VALUES ({', '.join('?' for _ in ATTACHMENT_COLUMNS)})"
+    )
+    CHECKPOINT_SQL = """INSERT INTO archive_state
+        (guild_id, channel_id, last_message_id, last_created_at, completed, updated_at)
+        VALUES (?, ?, ?, ?, 0, ?)
+        ON CONFLICT (guild_id, channel_id) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_created_at = excluded.last_created_at,
+            completed = 0,
+            updated_at = excluded.updated_at"""
+
+    def __init__(
+        self,
+        conn: sqlite3.Connection,
+        batch_size: int = ARCHIVE_BATCH_SIZE,
+        checkpoint: bool = True,
+    ):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        self.conn = conn
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.buffer: list[tuple] = []
+        self.attachments: list[tuple] = []
+        self.rows_written = 0
+        self.batches_committed = 0
+
+    def add(self, row: tuple, attachments: list[tuple] | None = None):
+        """
+        Queue a row, flushing if the batch is full.
+        Args:
+            row: A messages row, in MESSAGE_COLUMNS order.
+            attachments: Its attachments rows. Defaults to splitting the
+                row's comma-joined urls.
+        """
+        self.buffer.append(row)
+        if attachments is None:
+            attachments = split_attachment_urls(row[0], row[5])
+        self.attachments.extend(attachments)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write and commit everything currently buffered."""
+        if not self.buffer:
+            return
+        with write_transaction(self.conn):
+            words = word_counts([row[3] for row in self.buffer]).tolist()
+            self.conn.executemany(
+                self.INSERT_SQL,
+                [(*row, count) for row, count in zip(self.buffer, words)],
+            )
+            self.conn.executemany(self.ATTACHMENT_SQL, self.attachments)
+            if self.checkpoint:
+                self.conn.executemany(self.CHECKPOINT_SQL, self._checkpoints())
+            # Oldest unindexed rows first: the new rows are only indexed
+            # here once any backlog is within SYNC_LIMIT of caught up.
+            index_messages(self.conn, len(self.buffer) + SYNC_LIMIT)
+            update_stats(self.conn, len(self.buffer) + SYNC_LIMIT)
+        bump_data_version()
+        self.rows_written += len(self.buffer)
+        self.batches_committed += 1
+        self.buffer.clear()
+        self.attachments.clear()
+
+    def _checkpoints(self) -> list[tuple]:
+        """Newest buffered row per (guild_id, channel_id), as CHECKPOINT_SQL params."""
+        newest = {}
+        for row in self.buffer:
+            key = (row[6], row[7])
+            if key not in newest or int(row[0]) > int(newest[key][0]):
+                newest[key] = row
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        return [
+            (guild_id, channel_id, row[0], row[4], now)
+            for (guild_id, channel_id), row in newest.items()
+        ]
+
+    def close(self):
+        """Flush remaining rows and close the connection."""
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ArchiveProgress:
+    """Counts stored messages across channels and posts milestone updates."""
+
+    MILESTONES = {100, 1000, 10000, 100000}
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.count = 0
+
+    async def advance(self):
+        self.count += 1
         # Send progress updates at specified milestones
-        if count in milestones:
-            await ctx.send(f"Progress: {count:,} messages stored...")
-        elif count > 100000 and count % 100000 == 0 and count != last_100k_milestone:
-            await ctx.send(f"Progress: {count:,} messages stored...")
-            last_100k_milestone = count
+        if self.count in self.MILESTONES or (
+            self.count > 100000 and self.count % 100000 == 0
+        ):
+            await self.ctx.send(f"Progress: {self.count:,} messages stored...")
 
-    conn.commit()
-    conn.close()
+
+async def archive_channel(
+    ctx,
+    channel,
+    writer: MessageWriter,
+    progress: ArchiveProgress,
+    incremental: bool = True,
+    announce: bool = True,
+) -> int:
+    """
+    Page through one channel's history into a shared writer.
+    Returns the number of messages fetched from the channel.
+    """
+    guild_id = str(channel.guild.id)
+    channel_id = str(channel.id)
+
+    after = None
+    checkpoint = (
+        get_checkpoint(writer.conn, guild_id, channel_id) if incremental else None
+    )
+    if checkpoint:
+        last_message_id, last_created_at, completed = checkpoint
+        after = discord.Object(id=int(last_message_id))
+        if announce and completed:
+            await ctx.send(f"Fetching messages newer than {last_created_at}...")
+        elif announce:
+            await ctx.send(
+                f"Resuming interrupted archive from message {last_message_id}..."
+            )
+
+    count = 0
+    async for message in channel.history(limit=None, after=after, oldest_first=True):
+        writer.add(message_to_row(message), message_to_attachment_rows(message))
+        count += 1
+        await progress.advance()
+
+    # Only mark the channel complete once all of its rows are committed
+    writer.flush()
+    mark_archive_complete(writer.conn, guild_id, channel_id)
     return count
 
 
+async def store_messages(
+    ctx, batch_size: int = ARCHIVE_BATCH_SIZE, incremental: bool = True
+):
+    """
+    Stores messages from the current channel into the consolidated archive.
+    In incremental mode only messages after the channel's last committed
+    checkpoint are fetched, which also resumes an interrupted run. A full
+    archive walks the whole history again; messages already stored are
+    skipped.
+    Messages are written in batches of batch_size, each committed separately.
+    Args:
+        ctx: The context of the command.
+        batch_size: Number of messages per executemany/commit.
+        incremental: Whether to continue from the last checkpoint.
+    Returns:
+        The number of messages stored."""
+
+    conn, _ = await initialize_database()
+    with MessageWriter(conn, batch_size=batch_size) as writer:
+        return await archive_channel(
+            ctx, ctx.channel, writer, ArchiveProgress(ctx), incremental
+        )
+
+
+async def store_guild_messages(
+    ctx,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+    incremental: bool = True,
+    concurrency: int = ARCHIVE_CONCURRENCY,
+):
+    """
+    Stores messages from every readable text channel in the guild.
+    Up to `concurrency` channel histories are paged through at once, each
+    as its own task. Different channels use separate Discord rate-limit
+    buckets, and discord.py already waits out 429s per bucket, so the cap
+    mainly keeps us under the global request limit. All tasks feed a single
+    MessageWriter, so SQLite still only ever has one writer.
+    Args:
+        ctx: The context of the command.
+        batch_size: Number of messages per executemany/commit.
+        incremental: Whether to continue from each channel's checkpoint.
+        concurrency: Maximum number of channels fetched at once.
+    Returns:
+        A tuple of ({channel: count}, {channel: exception}).
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+
+    me = ctx.guild.me
+    channels = [
+        channel
+        for channel in ctx.guild.text_channels
+        if channel.permissions_for(me).read_message_history
+    ]
+
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = ArchiveProgress(ctx)
+    conn, _ = await initialize_database()
+
+    with MessageWriter(conn, batch_size=batch_size) as writer:
+
+        async def archive_one(channel):
+            async with semaphore:
+                return await archive_channel(
+                    ctx, channel, writer, progress, incremental, announce=False
+                )
+
+        results = await asyncio.gather(
+            *(archive_one(channel) for channel in channels), return_exceptions=True
+        )
+
+    counts = {}
+    errors = {}
+    for channel, result in zip(channels, results):
+        if isinstance(result, BaseException):
+            errors[channel] = result
+        else:
+            counts[channel] = result
+    return counts, errors
+
+
+# Only TextBlob is worth caching: hashing a text costs more than splitting it
+_sentiment_cache = LRUCache(UDF_CACHE_SIZE)
+
+
+def _content_key(text: str) -> bytes:
+    """Fixed-size cache key for a message, so long texts don't bloat the cache."""
+    return hashlib.blake2b(
+        text.encode("utf-8", "surrogatepass"), digest_size=16
+    ).digest()
+
+
+def configure_udf_caches(maxsize: int):
+    """Resize the sentiment cache."""
+    _sentiment_cache.resize(maxsize)
+
+
+def udf_cache_stats() -> dict:
+    """Hit/miss counters for each UDF cache, keyed by cache name."""
+    return {"sentiment": _sentiment_cache.stats()}
+
+
+def score_sentiment(text: str) -> tuple[float, float]:
+    """
+    Returns (polarity, subjectivity) for a text from a single analysis.
+    Results are memoized by content hash. Numbers and blobs, which SQL
+    callers can pass too, score neutral.
+    """
+    if not text or not isinstance(text, str):
+        return 0.0, 0.0
+    key = _content_key(text)
+    scores = _sentiment_cache.get(key)
+    if scores is not None:
+        return scores
+    try:
+        sentiment = TextBlob(text).sentiment
+        scores = (sentiment.polarity, sentiment.subjectivity)  # type: ignore
+    except Exception:
+        scores = (0.0, 0.0)
+    _sentiment_cache.put(key, scores)
+    return scores
+
+
 def sentiment_polarity(text: str) -> float:
     """
     Custom SQL function: Returns sentiment polarity score.
     Range: -1.0 (negative) to +1.0 (positive)
     """
-    if not text:
-        return 0.0
-    try:
-        blob = TextBlob(text)
-        return blob.sentiment.polarity  # type: ignore
-    except Exception:
-        return 0.0
+    return score_sentiment(text)[0]
 
 
 def sentiment_subjectivity(text: str) -> float:
@@ -106,20 +863,15 @@ def sentiment_subjectivity(text: str) -> float:
     Custom SQL function: Returns sentiment subjectivity score.
     Range: 0.0 (objective) to 1.0 (subjective)
     """
-    if not text:
-        return 0.0
-    try:
-        blob = TextBlob(text)
-        return blob.sentiment.subjectivity  # type: ignore
-    except Exception:
-        return 0.0
+    return score_sentiment(text)[1]
 
 
-def sentiment_label(text: str) -> str:
+def polarity_label(polarity: float) -> str:
     """
-    Custom SQL function: Returns sentiment label (positive/neutral/negative).
+    Custom SQL function: Returns the sentiment label for a polarity score.
     """
-    polarity = sentiment_polarity(text)
+    if polarity is None:
+        return "neutral"
     if polarity > 0.1:
         return "positive"
     elif polarity < -0.1:
@@ -128,6 +880,440 @@ def sentiment_label(text: str) -> str:
         return "neutral"
 
 
+def sentiment_label(text: str) -> str:
+    """
+    Custom SQL function: Returns sentiment label (positive/neutral/negative).
+    """
+    return polarity_label(sentiment_polarity(text))
+
+
+def message_columns(conn: sqlite3.Connection) -> set[str]:
+    """The columns of the messages table, including generated ones."""
+    return {row[1] for row in conn.execute("PRAGMA table_xinfo(messages)")}
+
+
+def has_sentiment_columns(conn: sqlite3.Connection) -> bool:
+    """Whether the messages table has the precomputed sentiment columns."""
+    return {"polarity", "subjectivity"} <= message_columns(conn)
+
+
+def sub_unquoted(
+    pattern: re.Pattern, replacement: str | Callable[[re.Match], str], query: str
+) -> str:
+    """pattern.sub on a query, outside its string literals and quoted names."""
+    parts = QUOTED_SQL_PATTERN.split(query)
+    return "".join(
+        part if i % 2 else pattern.sub(replacement, part)
+        for i, part in enumerate(parts)
+    )
+
+
+def rewrite_sentiment_calls(query: str) -> str:
+    """
+    Rewrite sentiment UDF calls on the content column to read the stored
+    scores, falling back to the UDF for rows that haven't been scored yet.
+    COALESCE short-circuits, so TextBlob only runs for NULL rows.
+    Example: sentiment_polarity(m.content)
+          -> COALESCE(m.polarity, sentiment_polarity(m.content))
+    """
+
+    def replace(match: re.Match) -> str:
+        function = match.group(1).lower()
+        prefix = match.group(2)
+        content = f"{prefix}content"
+        if function == "sentiment_subjectivity":
+            return f"COALESCE({prefix}subjectivity, sentiment_subjectivity({content}))"
+        polarity = f"COALESCE({prefix}polarity, sentiment_polarity({content}))"
+        if function == "sentiment_label":
+            return f"polarity_label({polarity})"
+        return polarity
+
+    return sub_unquoted(SENTIMENT_CALL_PATTERN, replace, query)
+
+
+def rewrite_word_count_calls(query: str) -> str:
+    """
+    Rewrite word_count calls on the content column to read the stored
+    count, falling back to the UDF for rows without one.
+    Example: word_count(m.content) -> COALESCE(m.words, word_count(m.content))
+    """
+    return sub_unquoted(
+        WORD_COUNT_CALL_PATTERN,
+        lambda match: (
+            f"COALESCE({match.group(1)}words, word_count({match.group(1)}content))"
+        ),
+        query,
+    )
+
+
+def score_sentiment_batch(texts: list[str]) -> list[tuple[float, float]]:
+    """
+    Score a chunk of messages. Top-level so it can run in worker processes.
+    """
+    return [score_sentiment(text) for text in texts]
+
+
+def backfill_sentiment(
+    db_path: str = ARCHIVE_DB_PATH,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+    workers: int = 1,
+    progress: Callable[[int, int], None] | None = None,
+) -> int:
+    """
+    Score every message that doesn't have stored sentiment yet.
+    Unscored rows are streamed in rowid order in chunks of batch_size. With
+    workers > 1 the chunks are scored across a process pool (TextBlob is
+    pure Python, so threads wouldn't help) while this process writes the
+    results back. Each chunk is committed on its own, so the job can be
+    stopped and rerun at any time; it picks up wherever polarity is still
+    NULL.
+    Args:
+        db_path: The archive to backfill.
+        batch_size: Number of messages scored per chunk and commit.
+        workers: Number of scoring processes. 1 scores in this process.
+        progress: Called as progress(scored, total) after every commit.
+    Returns:
+        The number of messages scored.
+    """
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    apply_pragmas(conn)
+    ensure_schema(conn)
+
+    total = conn.execute(
+        "SELECT COUNT(*) FROM messages WHERE polarity IS NULL"
+    ).fetchone()[0]
+    scored = 0
+
+    def chunks():
+        last_rowid = 0
+        while True:
+            rows = conn.execute(
+                """SELECT rowid, content FROM messages
+                   WHERE polarity IS NULL AND rowid > ?
+                   ORDER BY rowid LIMIT ?""",
+                (last_rowid, batch_size),
+            ).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            yield [rowid for rowid, _ in rows], [content for _, content in rows]
+
+    def write(rowids, scores):
+        nonlocal scored
+        with conn:
+            conn.executemany(
+                "UPDATE messages SET polarity = ?, subjectivity = ? WHERE rowid = ?",
+                [(*score, rowid) for rowid, score in zip(rowids, scores)],
+            )
+        bump_data_version()
+        scored += len(rowids)
+        if progress:
+            progress(scored, total)
+
+    try:
+        if workers <= 1:
+            for rowids, texts in chunks():
+                write(rowids, score_sentiment_batch(texts))
+            return scored
+
+        # spawn rather than fork: the bot process has live threads and sockets
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            in_flight = collections.deque()
+            for rowids, texts in chunks():
+                in_flight.append((rowids, pool.submit(score_sentiment_batch, texts)))
+                # Keep every worker busy without reading the whole table ahead
+                if len(in_flight) >= workers * 2:
+                    rowids, future = in_flight.popleft()
+                    write(rowids, future.result())
+            while in_flight:
+                rowids, future = in_flight.popleft()
+                write(rowids, future.result())
+        return scored
+    finally:
+        conn.close()
+
+
+def last_indexed_rowid(conn: sqlite3.Connection) -> int:
+    """Returns the highest rowid in messages_fts, or 0 if it is empty."""
+    row = conn.execute(
+        "SELECT rowid FROM messages_fts ORDER BY rowid DESC LIMIT 1"
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def index_messages(conn: sqlite3.Connection, limit: int = FTS_BATCH_SIZE) -> int:
+    """
+    Add up to limit messages that aren't in messages_fts yet to the index.
+    Messages are only ever appended, so everything above the highest
+    indexed rowid is unindexed, and the oldest of those go first. Call it
+    inside write_transaction, so no other connection can index the same
+    rows before this one commits.
+    Returns:
+        The number of messages indexed.
+    """
+    rows = conn.execute(
+        "SELECT rowid, content FROM messages WHERE rowid > ? ORDER BY rowid LIMIT ?",
+        (last_indexed_rowid(conn), limit),
+    ).fetchall()
+    tokens, counts = tokenize_batch([content for _, content in rows])
+    conn.executemany(
+        "INSERT INTO messages_fts (rowid, content) VALUES (?, ?)",
+        [
+            (rowid, " ".join(words))
+            for (rowid, _), words in zip(rows, split_tokens(tokens, counts))
+        ],
+    )
+    return len(rows)
+
+
+def index_all_messages(
+    conn: sqlite3.Connection,
+    batch_size: int = FTS_BATCH_SIZE,
+    progress: Callable[[int, int], None] | None = None,
+) -> int:
+    """
+    Index every message missing from messages_fts, committing each batch.
+    Args:
+        conn: An open connection to the archive.
+        batch_size: Number of messages indexed per commit.
+        progress: Called as progress(indexed, total) after every commit.
+    Returns:
+        The number of messages indexed.
+    """
+    total = conn.execute(
+        "SELECT COUNT(*) FROM messages WHERE rowid > ?", (last_indexed_rowid(conn),)
+    ).fetchone()[0]
+    indexed = 0
+    while True:
+        with write_transaction(conn):
+            count = index_messages(conn, batch_size)
+        if not count:
+            return indexed
+        indexed += count
+        bump_data_version()
+        if progress:
+            progress(indexed, total)
+
+
+def update_stats(conn: sqlite3.Connection, limit: int = STATS_BATCH_SIZE) -> int:
+    """
+    Add up to limit messages that haven't been counted yet to
+    daily_author_stats. Like the search index this relies on messages only
+    ever being appended. Call it inside write_transaction, so no other
+    connection can count the same rows before this one moves the watermark.
+    Returns:
+        The number of messages counted.
+    """
+    last_rowid = conn.execute("SELECT last_rowid FROM stats_state").fetchone()[0]
+    rows = conn.execute(
+        """SELECT rowid, substr(created_at, 1, 10), guild_id, channel_id,
+                  author_id, author_name, content, attachments
+           FROM messages WHERE rowid > ? ORDER BY rowid LIMIT ?""",
+        (last_rowid, limit),
+    ).fetchall()
+    if not rows:
+        return 0
+
+    totals = {}
+    words = word_counts([row[6] for row in rows]).tolist()
+    for row, count in zip(rows, words):
+        _, day, guild_id, channel_id, author_id, name, _, attachments = row
+        key = (day, channel_id, author_id)
+        entry = totals.get(key)
+        if entry is None:
+            entry = totals[key] = [guild_id, name, 0, 0, 0]
+        entry[1] = name
+        entry[2] += 1
+        entry[3] += count
+        entry[4] += len(attachments.split(",")) if attachments else 0
+
+    conn.executemany(
+        """INSERT INTO daily_author_stats
+               (day, channel_id, author_id, guild_id, author_name,
+                message_count, word_count, attachment_count)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT (day, channel_id, author_id) DO UPDATE SET
+               author_name = excluded.author_name,
+               message_count = message_count + excluded.message_count,
+               word_count = word_count + excluded.word_count,
+               attachment_count = attachment_count + excluded.attachment_count""",
+        [(*key, *entry) for key, entry in totals.items()],
+    )
+    conn.execute("UPDATE stats_state SET last_rowid = ?", (rows[-1][0],))
+    return len(rows)
+
+
+def update_all_stats(
+    conn: sqlite3.Connection,
+    batch_size: int = STATS_BATCH_SIZE,
+    progress: Callable[[int, int], None] | None = None,
+) -> int:
+    """
+    Count every message missing from daily_author_stats, committing each batch.
+    Args:
+        conn: An open connection to the archive.
+        batch_size: Number of messages counted per commit.
+        progress: Called as progress(counted, total) after every commit.
+    Returns:
+        The number of messages counted.
+    """
+    total = conn.execute(
+        """SELECT COUNT(*) FROM messages
+           WHERE rowid > (SELECT last_rowid FROM stats_state)"""
+    ).fetchone()[0]
+    counted = 0
+    while True:
+        with write_transaction(conn):
+            count = update_stats(conn, batch_size)
+        if not count:
+            return counted
+        counted += count
+        bump_data_version()
+        if progress:
+            progress(counted, total)
+
+
+def fill_word_counts(
+    conn: sqlite3.Connection,
+    batch_size: int = STATS_BATCH_SIZE,
+    progress: Callable[[int], None] | None = None,
+) -> int:
+    """
+    Store the word count of every message that doesn't have one yet, such
+    as rows merged from per-run archives, committing each batch.
+    Returns:
+        The number of messages updated.
+    """
+    filled = 0
+    last_rowid = 0
+    while True:
+        rows = conn.execute(
+            """SELECT rowid, content FROM messages
+               WHERE rowid > ? AND words IS NULL ORDER BY rowid LIMIT ?""",
+            (last_rowid, batch_size),
+        ).fetchall()
+        if not rows:
+            return filled
+        words = word_counts([content for _, content in rows]).tolist()
+        with conn:
+            conn.executemany(
+                "UPDATE messages SET words = ? WHERE rowid = ?",
+                [(count, rowid) for (rowid, _), count in zip(rows, words)],
+            )
+        last_rowid = rows[-1][0]
+        filled += len(rows)
+        bump_data_version()
+        if progress:
+            progress(filled)
+
+
+def backfill_stats(
+    db_path: str = ARCHIVE_DB_PATH,
+    batch_size: int = STATS_BATCH_SIZE,
+    progress: Callable[[int, int], None] | None = None,
+) -> int:
+    """
+    Build daily_author_stats and the stored word counts for an existing
+    archive. Safe to stop and rerun; it resumes after the last counted
+    message.
+    Returns:
+        The number of messages counted.
+    """
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    apply_pragmas(conn)
+    ensure_schema(conn)
+    try:
+        fill_word_counts(conn, batch_size)
+        return update_all_stats(conn, batch_size, progress)
+    finally:
+        conn.close()
+
+
+def migrate_attachments(
+    conn: sqlite3.Connection,
+    batch_size: int = ATTACHMENT_BATCH_SIZE,
+    progress: Callable[[int], None] | None = None,
+) -> int:
+    """
+    Split the comma-joined attachment urls of messages that have no
+    attachments rows yet, committing each batch.
+    Args:
+        conn: An open connection to the archive.
+        batch_size: Number of messages split per commit.
+        progress: Called as progress(migrated) after every commit.
+    Returns:
+        The number of messages migrated.
+    """
+    migrated = 0
+    last_rowid = 0
+    while True:
+        rows = conn.execute(
+            """SELECT rowid, message_id, attachments FROM messages m
+               WHERE rowid > ? AND attachments != ''
+                 AND NOT EXISTS
+                     (SELECT 1 FROM attachments a WHERE a.message_id = m.message_id)
+               ORDER BY rowid LIMIT ?""",
+            (last_rowid, batch_size),
+        ).fetchall()
+        if not rows:
+            return migrated
+        with conn:
+            conn.executemany(
+                MessageWriter.ATTACHMENT_SQL,
+                [
+                    attachment
+                    for _, message_id, attachments in rows
+                    for attachment in split_attachment_urls(message_id, attachments)
+                ],
+            )
+        last_rowid = rows[-1][0]
+        migrated += len(rows)
+        bump_data_version()
+        if progress:
+            progress(migrated)
+
+
+def backfill_attachments(
+    db_path: str = ARCHIVE_DB_PATH,
+    batch_size: int = ATTACHMENT_BATCH_SIZE,
+    progress: Callable[[int], None] | None = None,
+) -> int:
+    """
+    Fill the attachments table from an existing archive's url strings.
+    Safe to stop and rerun; migrated messages are skipped.
+    Returns:
+        The number of messages migrated.
+    """
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    apply_pragmas(conn)
+    ensure_schema(conn)
+    try:
+        return migrate_attachments(conn, batch_size, progress)
+    finally:
+        conn.close()
+
+
+def backfill_fts(
+    db_path: str = ARCHIVE_DB_PATH,
+    batch_size: int = FTS_BATCH_SIZE,
+    progress: Callable[[int, int], None] | None = None,
+) -> int:
+    """
+    Build the full-text index for an existing archive.
+    Safe to stop and rerun; it resumes after the last indexed message.
+    Returns:
+        The number of messages indexed.
+    """
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    apply_pragmas(conn)
+    ensure_schema(conn)
+    try:
+        return index_all_messages(conn, batch_size, progress)
+    finally:
+        conn.close()
+
+
 def word_count(text: str) -> int:
     """Custom SQL function: Returns word count."""
     if not text:
@@ -135,10 +1321,192 @@ def word_count(text: str) -> int:
     return len(text.split())
 
 
+_authors_signature = {}
+
+
+def sync_authors(
+    db_path: str = ARCHIVE_DB_PATH,
+    mappings_path: str = USER_MAPPINGS_PATH,
+    force: bool = False,
+) -> bool:
+    """
+    Reload the user mappings and rewrite the authors table if the mappings
+    file changed since the last sync. Cheap enough to call before every
+    query: an unchanged file costs one stat.
+    Args:
+        db_path: The archive holding the authors table.
+        mappings_path: The user mappings file.
+        force: Sync even if the file looks unchanged.
+    Returns:
+        Whether the table was rewritten.
+    """
+    try:
+        stat = os.stat(mappings_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        signature = None
+    if not force and _authors_signature.get(db_path) == signature:
+        return False
+
+    if not os.path.exists(db_path):
+        return False
+
+    authors = load_user_mappings(mappings_path)
+    if authors is None:
+        # Keep the last good mappings; the next call will try again
+        return False
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    try:
+        apply_pragmas(conn)
+        ensure_schema(conn)
+        with conn:
+            conn.execute("DELETE FROM authors")
+            conn.executemany(
+                "INSERT OR REPLACE INTO authors VALUES (?, ?, ?, ?)", authors
+            )
+    finally:
+        conn.close()
+    bump_data_version()
+    _authors_signature[db_path] = signature
+    return True
+
+
+def has_authors(conn: sqlite3.Connection) -> bool:
+    """Whether the archive has a synced authors table."""
+    try:
+        return conn.execute("SELECT 1 FROM authors LIMIT 1").fetchone() is not None
+    except sqlite3.OperationalError:
+        return False
+
+
+def rewrite_author_calls(query: str) -> str:
+    """
+    Rewrite real_name/is_tracked calls on the author_id column into lookups
+    on the authors table, so they run inside SQLite instead of calling back
+    into Python for every row.
+    Example: WHERE is_tracked(m.author_id) = 1
+          -> WHERE m.author_id IN (SELECT account_id FROM authors)
+    The comparison is only folded into a bare IN when it is a predicate of
+    its own; inside a larger expression, as in x + is_tracked(author_id) = 1,
+    the call becomes a parenthesized IN and the "= 1" stays.
+    """
+
+    def replace(match: re.Match) -> str:
+        function = match.group(1).lower()
+        column = match.group(2)
+        if function == "is_tracked":
+            tracked = f"{column} IN (SELECT account_id FROM authors)"
+            comparison = match.group(3) or ""
+            text = match.string
+            if (
+                comparison
+                and PREDICATE_START_PATTERN.search(text, 0, match.start())
+                and PREDICATE_END_PATTERN.match(text, match.end())
+            ):
+                return tracked
+            return f"({tracked}){comparison}"
+        return (
+            "COALESCE((SELECT real_name FROM authors "
+            f"WHERE account_id = {column}), NULLIF({column}, ''), 'Unknown')"
+        )
+
+    return sub_unquoted(AUTHOR_CALL_PATTERN, replace, query)
+
+
+def compiles(
+    conn: sqlite3.Connection,
+    query: str,
+    columns: set[tuple[str, str]] | None = None,
+) -> bool:
+    """
+    Whether a query compiles as a single read-only statement on conn,
+    without running it. If given, columns collects the (table, column)
+    pairs it reads.
+    """
+    explain = EXPLAIN_PATTERN.match(query)
+    if explain:
+        query = query[explain.end() :]
+    try:
+        with sqlite_read_only(conn, columns=columns):
+            conn.execute(f"EXPLAIN QUERY PLAN {query}")
+    except (sqlite3.Error, sqlite3.Warning):
+        return False
+    return True
+
+
+def optimize_query(conn: sqlite3.Connection, query: str) -> str:
+    """
+    Apply the UDF rewrites that the archive's schema supports.
+    The rewrites match calls by name, so each is kept only if the query
+    reads the messages column its calls take and the rewritten query still
+    compiles. A CTE or subquery that exposes its own content column has no
+    polarity or words column beside it.
+    """
+    columns = message_columns(conn)
+    rewrites = []
+    if {"polarity", "subjectivity"} <= columns:
+        rewrites.append((rewrite_sentiment_calls, "content"))
+    if "words" in columns:
+        rewrites.append((rewrite_word_count_calls, "content"))
+    if has_authors(conn):
+        rewrites.append((rewrite_author_calls, "author_id"))
+
+    reads = None
+    for rewrite, column in rewrites:
+        rewritten = rewrite(query)
+        if rewritten == query:
+            continue
+        if reads is None:
+            reads = set()
+            if not compiles(conn, query, reads):
+                return query
+        if ("messages", column) in reads and compiles(conn, rewritten):
+            query = rewritten
+    return query
+
+
+def filled_columns(conn: sqlite3.Connection) -> set[str]:
+    """
+    The stored columns optimize_query reads instead of calling a UDF
+    (polarity, subjectivity, words) that have a value on every row. Each is
+    checked through its index, so this is cheap even on a large archive.
+    """
+    columns = message_columns(conn) & {"polarity", "subjectivity", "words"}
+    return {
+        column
+        for column in columns
+        if conn.execute(
+            f"SELECT 1 FROM messages WHERE {column} IS NULL LIMIT 1"
+        ).fetchone()
+        is None
+    }
+
+
+def without_udf_fallbacks(
+    query: str, columns: Iterable[str] = ("polarity", "subjectivity", "words")
+) -> str:
+    """
+    Drop the UDF fallbacks optimize_query adds for the given stored columns.
+    Once those columns are filled in the fallbacks never run, so this is
+    the query whose function calls matter for its cost (see filled_columns).
+    Example: COALESCE(m.polarity, sentiment_polarity(m.content)) -> m.polarity
+    """
+    columns = set(columns)
+
+    def replace(match: re.Match) -> str:
+        if match.group(2) in columns:
+            return match.group(1) + match.group(2)
+        return match.group(0)
+
+    return sub_unquoted(UDF_FALLBACK_PATTERN, replace, query)
+
+
 def real_name(author_id: str) -> str:
     """
     Custom SQL function: Maps Discord author ID to real person name.
     If not found in mappings, returns the original author_id.
+    Kept for compatibility; queries on author_id are rewritten to read the
+    authors table instead.
     """
     if not author_id:
         return "Unknown"
@@ -150,12 +1518,25 @@ def is_tracked(author_id: str) -> int:
     Custom SQL function: Returns 1 if author is in the mappings, 0 otherwise.
     Use in WHERE clause to filter only tracked users.
     Example: WHERE is_tracked(author_id) = 1
+    Kept for compatibility; queries on author_id are rewritten to read the
+    authors table instead.
     """
     if not author_id:
         return 0
     return 1 if str(author_id) in USER_MAPPINGS else 0
 
 
+def register_functions(conn: sqlite3.Connection):
+    """Register the custom SQL functions on a connection."""
+    conn.create_function("sentiment_polarity", 1, sentiment_polarity)
+    conn.create_function("sentiment_subjectivity", 1, sentiment_subjectivity)
+    conn.create_function("sentiment_label", 1, sentiment_label)
+    conn.create_function("polarity_label", 1, polarity_label, deterministic=True)
+    conn.create_function("word_count", 1, word_count)
+    conn.create_function("real_name", 1, real_name)
+    conn.create_function("is_tracked", 1, is_tracked)
+
+
 async def run_sql_query(db_path: str, query: str):
     """
     Runs a SQL query on the specified database and returns the results.
@@ -165,29 +1546,19 @@ async def run_sql_query(db_path: str, query: str):
     Returns:
         The results of the query as a string to send in Discord.
     """
+    from .query import connection_pool
+
     if not os.path.exists(db_path):
         return "Database file not found."
 
-    conn = sqlite3.connect(db_path)
-
-    # Register custom SQL functions
-    conn.create_function("sentiment_polarity", 1, sentiment_polarity)
-    conn.create_function("sentiment_subjectivity", 1, sentiment_subjectivity)
-    conn.create_function("sentiment_label", 1, sentiment_label)
-    conn.create_function("word_count", 1, word_count)
-    conn.create_function("real_name", 1, real_name)
-    conn.create_function("is_tracked", 1, is_tracked)
-
-    c = conn.cursor()
     try:
-        c.execute(query)
-        results = c.fetchall()
-        conn.close()
+        with connection_pool.connection(db_path) as conn:
+            query = optimize_query(conn, query)
+            results = conn.execute(query).fetchall()
         if not results:
             return "Query executed successfully, but no results to display."
         # Format results as a string
         result_str = "\n".join([str(row) for row in results])
         return f"Query Results:\n{result_str}"
     except sqlite3.Error as e:
-        conn.close()
         return f"An error occurred: {e}"
@@ -0,0 +1,239 @@
+"""
+Compressed and columnar export formats for !runsql.
+Rows are streamed from the cursor into the output, which is split into
+several parts whenever a part would exceed Discord's upload limit.
+Parts are spooled to temporary files, so large extracts don't sit in memory.
+"""
+
+import abc
+import csv
+import gzip
+import io
+import json
+import tempfile
+import zipfile
+from typing import BinaryIO
+
+import numpy as np
+
+from .query import FETCH_SIZE, MAX_RESULT_BYTES, QueryResult, iter_rows
+
+# Discord allows 10 attachments per message; each part gets its own message
+MAX_EXPORT_PARTS = 10
+MAX_EXPORT_ROWS = 5_000_000
+# Compressors buffer internally, so start a new part this far below the limit
+PART_MARGIN = 1024 * 1024
+# Rows per columnar row group, and the uncompressed size that ends one early
+ROW_GROUP_ROWS = 10_000
+ROW_GROUP_BYTES = 512 * 1024
+
+
+def unique_columns(columns: list[str]) -> list[str]:
+    """
+    Column names with repeats numbered (id, id_1, id_2, ...), as in
+    SELECT a.id, b.id. JSON keys and npz entries would otherwise collide.
+    """
+    seen = set(columns)
+    names = []
+    for column in columns:
+        if column in names:
+            suffix = 1
+            while f"{column}_{suffix}" in seen:
+                suffix += 1
+            column = f"{column}_{suffix}"
+            seen.add(column)
+        names.append(column)
+    return names
+
+
+class PartWriter(abc.ABC):
+    """Writes rows into one output part. Subclasses implement a format."""
+
+    extension = ""
+
+    def __init__(self, columns: list[str]):
+        self.columns = unique_columns(columns)
+        self.raw = tempfile.SpooledTemporaryFile(max_size=MAX_RESULT_BYTES)
+
+    @abc.abstractmethod
+    def write(self, row: tuple):
+        """Add one row to the part."""
+
+    def size(self) -> int:
+        """Compressed bytes written so far (lags slightly behind the input)."""
+        return self.raw.tell()
+
+    def close(self) -> BinaryIO:
+        """Finish the part and return its file, rewound."""
+        self.raw.seek(0)
+        return self.raw
+
+
+class CSVGzipWriter(PartWriter):
+    extension = "csv.gz"
+
+    def __init__(self, columns: list[str]):
+        super().__init__(columns)
+        self._gzip = gzip.GzipFile(fileobj=self.raw, mode="wb")
+        self._text = io.TextIOWrapper(self._gzip, encoding="utf-8", newline="")
+        self._csv = csv.writer(self._text)
+        self._csv.writerow(self.columns)
+
+    def write(self, row: tuple):
+        self._csv.writerow(row)
+
+    def close(self) -> BinaryIO:
+        self._text.flush()
+        self._text.detach()
+        self._gzip.close()
+        return super().close()
+
+
+class JSONLGzipWriter(PartWriter):
+    extension = "jsonl.gz"
+
+    def __init__(self, columns: list[str]):
+        super().__init__(columns)
+        self._gzip = gzip.GzipFile(fileobj=self.raw, mode="wb")
+
+    def write(self, row: tuple):
+        record = dict(zip(self.columns, row))
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        self._gzip.write(line.encode("utf-8"))
+
+    def close(self) -> BinaryIO:
+        self._gzip.close()
+        return super().close()
+
+
+class ColumnarWriter(PartWriter):
+    """
+    NumPy .npz archive laid out like Parquet row groups.
+    Each group of rows is stored column by column as "rg0000.<column>"
+    arrays (int64, float64 or str), plus a "rg0000.<column>.null" mask when
+    a column has NULLs. "columns" lists the column names in order, with
+    repeated names numbered by unique_columns.
+    Load with np.load(path); no pickling is needed.
+    """
+
+    extension = "npz"
+
+    def __init__(self, columns: list[str]):
+        super().__init__(columns)
+        self._zip = zipfile.ZipFile(
+            self.raw, mode="w", compression=zipfile.ZIP_DEFLATED
+        )
+        self._save("columns", np.array(self.columns, dtype=str))
+        self._group: list[tuple] = []
+        self._group_bytes = 0
+        self._group_index = 0
+
+    def _save(self, name: str, array: np.ndarray):
+        with self._zip.open(f"{name}.npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, array, allow_pickle=False)
+
+    @staticmethod
+    def _column_array(values: list) -> tuple[np.ndarray, np.ndarray | None]:
+        nulls = np.array([value is None for value in values])
+        present = [value for value in values if value is not None]
+        if all(isinstance(value, int) for value in present):
+            array = np.array([0 if v is None else v for v in values], dtype=np.int64)
+        elif all(isinstance(value, (int, float)) for value in present):
+            array = np.array(
+                [np.nan if v is None else v for v in values], dtype=np.float64
+            )
+        else:
+            array = np.array(["" if v is None else str(v) for v in values], dtype=str)
+        return array, nulls if nulls.any() else None
+
+    def _flush_group(self):
+        if not self._group:
+            return
+        prefix = f"rg{self._group_index:04d}"
+        for column, values in zip(self.columns, zip(*self._group)):
+            array, nulls = self._column_array(list(values))
+            self._save(f"{prefix}.{column}", array)
+            if nulls is not None:
+                self._save(f"{prefix}.{column}.null", nulls)
+        self._group.clear()
+        self._group_bytes = 0
+        self._group_index += 1
+
+    def write(self, row: tuple):
+        self._group.append(row)
+        self._group_bytes += sum(len(str(value)) for value in row)
+        if len(self._group) >= ROW_GROUP_ROWS or self._group_bytes >= ROW_GROUP_BYTES:
+            self._flush_group()
+
+    def size(self) -> int:
+        # Buffered rows are at most ROW_GROUP_BYTES before compression
+        return self.raw.tell() + self._group_bytes
+
+    def close(self) -> BinaryIO:
+        self._flush_group()
+        self._zip.close()
+        return super().close()
+
+
+EXPORT_FORMATS: dict[str, type[PartWriter]] = {
+    "csv.gz": CSVGzipWriter,
+    "jsonl.gz": JSONLGzipWriter,
+    "npz": ColumnarWriter,
+}
+FORMAT_ALIASES = {"csv": "csv.gz", "jsonl": "jsonl.gz", "columnar": "npz"}
+
+
+def resolve_format(name: str) -> str | None:
+    """Return the canonical export format for a name or alias, or None."""
+    name = name.lower()
+    name = FORMAT_ALIASES.get(name, name)
+    return name if name in EXPORT_FORMATS else None
+
+
+def export_results(
+    cursor,
+    query: str,
+    fmt: str,
+    part_limit: int = MAX_RESULT_BYTES,
+    max_parts: int = MAX_EXPORT_PARTS,
+    max_rows: int = MAX_EXPORT_ROWS,
+) -> QueryResult:
+    """
+    Stream a query's rows into one or more files in the given format.
+    A new part is started whenever the current one gets within
+    PART_MARGIN of part_limit. Export stops (and is marked truncated) after
+    max_rows rows or once max_parts parts are full.
+    """
+    writer_class = EXPORT_FORMATS[fmt]
+    columns = [description[0] for description in cursor.description or []]
+
+    parts: list[BinaryIO] = []
+    writer = writer_class(columns)
+    row_count = 0
+    truncated = False
+
+    for row in iter_rows(cursor, FETCH_SIZE):
+        if row_count >= max_rows:
+            truncated = True
+            break
+        if writer.size() >= part_limit - PART_MARGIN:
+            parts.append(writer.close())
+            if len(parts) >= max_parts:
+                writer = None
+                truncated = True
+                break
+            writer = writer_class(columns)
+        writer.write(row)
+        row_count += 1
+
+    if writer is not None:
+        parts.append(writer.close())
+
+    if len(parts) == 1:
+        files = [(f"query_results.{fmt}", parts[0])]
+    else:
+        files = [
+            (f"query_results.part{i:02d}.{fmt}", part)
+            for i, part in enumerate(parts, 1)
+        ]
+    return QueryResult(files, row_count, truncated)
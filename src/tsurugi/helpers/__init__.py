@@ -1,5 +1,6 @@
 """Helper modules for the Tsurugi Discord bot."""
 
+from .cache import CacheStats, DiskLRUCache, LRUCache
 from .permissions import (
     get_anshu_user_ids,
     get_user_permissions,
@@ -20,11 +21,17 @@ from .safety import (
     get_safe_exec_globals,
     limit_query_results,
     rate_limit,
+    refund_rate_limit,
+    sqlite_read_only,
+    sqlite_timeout,
     timeout,
     validate_sql_query,
 )
 
 __all__ = [
+    "CacheStats",
+    "DiskLRUCache",
+    "LRUCache",
     "get_anshu_user_ids",
     "get_user_permissions",
     "grant_command",
@@ -42,6 +49,9 @@ __all__ = [
     "get_safe_exec_globals",
     "limit_query_results",
     "rate_limit",
+    "refund_rate_limit",
+    "sqlite_read_only",
+    "sqlite_timeout",
     "timeout",
     "validate_sql_query",
 ]
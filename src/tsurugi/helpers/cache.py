@@ -0,0 +1,250 @@
+"""
+Bounded in-memory and on-disk caches with hit-rate statistics.
+"""
+
+import contextlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable
+
+
+@dataclass
+class CacheStats:
+    """Snapshot of a cache's counters."""
+
+    hits: int
+    misses: int
+    size: int
+    maxsize: int
+    nbytes: int = 0
+    max_bytes: int | None = None
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache holding at most maxsize entries.
+    If max_bytes is set, entries are also evicted to keep the total of
+    sizeof(value) within that budget; values larger than the whole budget
+    aren't stored. Safe to share between query worker threads.
+    """
+
+    _MISSING = object()
+
+    def __init__(
+        self,
+        maxsize: int,
+        max_bytes: int | None = None,
+        sizeof: Callable[[Any], int] | None = None,
+    ):
+        if maxsize < 0:
+            raise ValueError("maxsize must not be negative")
+        if max_bytes is not None and sizeof is None:
+            raise ValueError("max_bytes requires a sizeof function")
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data: OrderedDict[Hashable, Any] = OrderedDict()
+        self._sizes: dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value for key, or default on a miss."""
+        with self._lock:
+            value = self._data.get(key, self._MISSING)
+            if value is self._MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        """Store a value, evicting the least recently used entries if full."""
+        size = self.sizeof(value) if self.sizeof else 0
+        with self._lock:
+            if self.maxsize == 0:
+                return
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._remove(key)
+            self._data[key] = value
+            self._sizes[key] = size
+            self.nbytes += size
+            self._evict()
+
+    def _remove(self, key: Hashable):
+        if key in self._data:
+            del self._data[key]
+            self.nbytes -= self._sizes.pop(key)
+
+    def _evict(self):
+        while len(self._data) > self.maxsize or (
+            self.max_bytes is not None and self.nbytes > self.max_bytes
+        ):
+            key, _ = self._data.popitem(last=False)
+            self.nbytes -= self._sizes.pop(key)
+
+    def resize(self, maxsize: int):
+        """Change the capacity, evicting entries if it shrinks."""
+        if maxsize < 0:
+            raise ValueError("maxsize must not be negative")
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                self.hits,
+                self.misses,
+                len(self._data),
+                self.maxsize,
+                self.nbytes,
+                self.max_bytes,
+            )
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class DiskLRUCache:
+    """
+    Least-recently-used cache of byte strings, one file per entry in a
+    directory, within a total size budget and optionally an entry count.
+    The index is rebuilt from the directory on first use, ordered by each
+    file's modification time (refreshed on every hit), so entries and
+    their recency survive restarts. Keys must be safe file names, such as
+    hex digests. Values larger than the whole budget aren't stored.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        maxsize: int | None = None,
+        suffix: str = ".bin",
+    ):
+        if max_bytes < 0:
+            raise ValueError("max_bytes must not be negative")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.maxsize = maxsize
+        self.suffix = suffix
+        self._index: OrderedDict[str, int] | None = None  # key -> file size
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.suffix)
+
+    def _load(self) -> OrderedDict[str, int]:
+        if self._index is None:
+            os.makedirs(self.directory, exist_ok=True)
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.name.endswith(self.suffix):
+                    st = entry.stat()
+                    key = entry.name[: -len(self.suffix)]
+                    entries.append((st.st_mtime_ns, key, st.st_size))
+            entries.sort()
+            self._index = OrderedDict((key, size) for _, key, size in entries)
+            self.nbytes = sum(self._index.values())
+            self._evict()
+        return self._index
+
+    def get(self, key: str) -> bytes | None:
+        """Return the cached bytes for key, or None on a miss."""
+        with self._lock:
+            index = self._load()
+            if key not in index:
+                self.misses += 1
+                return None
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path)
+            except OSError:
+                # The file was removed from outside; forget it
+                self.nbytes -= index.pop(key)
+                self.misses += 1
+                return None
+            index.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: str, data: bytes):
+        """Store a value, evicting the least recently used entries if full."""
+        with self._lock:
+            index = self._load()
+            if len(data) > self.max_bytes or self.maxsize == 0:
+                return
+            # Write to a temporary name first, so a crash never leaves a
+            # partial entry behind
+            path = self._path(key)
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(data)
+            os.replace(f"{path}.tmp", path)
+            if key in index:
+                self.nbytes -= index.pop(key)
+            index[key] = len(data)
+            self.nbytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        index = self._index
+        while (self.maxsize is not None and len(index) > self.maxsize) or (
+            self.nbytes > self.max_bytes
+        ):
+            key, size = index.popitem(last=False)
+            self.nbytes -= size
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(key))
+
+    def clear(self):
+        """Delete every entry and reset the counters."""
+        with self._lock:
+            for key in self._load():
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._path(key))
+            self._index.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            size = len(self._index) if self._index is not None else 0
+            return CacheStats(
+                self.hits,
+                self.misses,
+                size,
+                self.maxsize if self.maxsize is not None else size,
+                self.nbytes,
+                self.max_bytes,
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._load())
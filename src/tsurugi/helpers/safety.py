@@ -3,11 +3,27 @@ Safety helpers for preventing resource exhaustion from user code execution.
 Includes timeouts, memory limits, and execution restrictions.
 """
 
+import ast
+import asyncio
+import contextlib
 import functools
+import importlib
+import inspect
+import itertools
+import math
+import pkgutil
 import signal
+import sqlite3
+import string
+import sys
+import threading
 import time
-from collections import defaultdict
-from typing import Any, Callable
+from collections import Counter, defaultdict
+from types import MappingProxyType, SimpleNamespace
+from typing import Any, Callable, Iterable
+
+# Longest SQL query accepted, in characters
+MAX_QUERY_LENGTH = 5000
 
 
 class TimeoutError(Exception):
@@ -26,10 +42,17 @@ class RateLimitError(Exception):
 _rate_limits = defaultdict(lambda: defaultdict(list))
 
 
-def timeout(seconds: int):
+def timeout(seconds: float):
     """
     Decorator to add execution timeout to a function.
-    Only works on Unix-like systems (Linux, macOS).
+    Works on the main thread, worker threads, worker processes and coroutines,
+    with sub-second budgets:
+    - coroutine functions are wrapped with asyncio.timeout
+    - on the main thread a real-time interval timer (SIGALRM) interrupts
+      the call, even inside most long-running C calls
+    - on other threads the deadline is checked from a trace function, so it
+      only fires while Python code is running. Use sqlite_timeout() for
+      SQLite calls.
 
     Args:
         seconds: Maximum execution time in seconds
@@ -39,29 +62,171 @@ def timeout(seconds: int):
     """
 
     def decorator(func: Callable) -> Callable:
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            def timeout_handler(signum, frame):
-                raise TimeoutError(f"Execution exceeded {seconds} second(s)")
+        if asyncio.iscoroutinefunction(func):
 
-            # Set the signal handler and alarm
-            old_handler = signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(seconds)
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                try:
+                    async with asyncio.timeout(seconds):
+                        return await func(*args, **kwargs)
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"Execution exceeded {seconds} second(s)")
 
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                # Restore the old signal handler and cancel alarm
-                signal.alarm(0)
-                signal.signal(signal.SIGALRM, old_handler)
+            return async_wrapper
 
-            return result
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if (
+                hasattr(signal, "setitimer")
+                and threading.current_thread() is threading.main_thread()
+            ):
+                return _run_with_alarm(seconds, func, *args, **kwargs)
+            return _run_with_trace(seconds, func, *args, **kwargs)
 
         return wrapper
 
     return decorator
 
 
+def _run_with_alarm(seconds: float, func: Callable, *args, **kwargs):
+    """Run func on the main thread, interrupted by SIGALRM after seconds."""
+
+    def timeout_handler(signum, frame):
+        raise TimeoutError(f"Execution exceeded {seconds} second(s)")
+
+    # Set the signal handler and timer
+    old_handler = signal.signal(signal.SIGALRM, timeout_handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # Cancel the timer and restore the old signal handler
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old_handler)
+
+
+def _run_with_trace(seconds: float, func: Callable, *args, **kwargs):
+    """
+    Run func on any thread, checking the deadline on every traced line.
+    The trace function is removed once it raises, so code that swallows
+    the TimeoutError will keep running.
+    """
+    deadline = time.monotonic() + seconds
+
+    def tracer(frame, event, arg):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Execution exceeded {seconds} second(s)")
+        return tracer
+
+    old_trace = sys.gettrace()
+    sys.settrace(tracer)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sys.settrace(old_trace)
+
+
+@contextlib.contextmanager
+def sqlite_timeout(conn: sqlite3.Connection, seconds: float, check_every: int = 1000):
+    """
+    Abort SQLite statements on conn that run past a deadline.
+    Uses a progress handler, called every check_every VM instructions, so
+    it works from any thread and cancels long C-level work (including
+    queries that keep calling slow UDFs). The handler is removed on exit.
+
+    Example:
+        with sqlite_timeout(conn, 2.5):
+            rows = conn.execute(query).fetchall()
+
+    Raises:
+        TimeoutError: If a statement is still running after seconds
+    """
+    deadline = time.monotonic() + seconds
+
+    def progress_handler():
+        # A non-zero return makes SQLite abort with "interrupted"
+        return 1 if time.monotonic() > deadline else 0
+
+    conn.set_progress_handler(progress_handler, check_every)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if str(e) == "interrupted" and time.monotonic() > deadline:
+            raise TimeoutError(f"Execution exceeded {seconds} second(s)") from e
+        raise
+    finally:
+        conn.set_progress_handler(None, check_every)
+
+
+# Authorizer actions a read-only query needs: the statement itself, column
+# reads, function calls and recursive CTEs. Everything else is denied.
+SQL_READ_ACTIONS = frozenset(
+    {
+        sqlite3.SQLITE_SELECT,
+        sqlite3.SQLITE_READ,
+        sqlite3.SQLITE_FUNCTION,
+        sqlite3.SQLITE_RECURSIVE,
+    }
+)
+# Pragmas that may be read (never assigned). FTS5 reads data_version
+# whenever a query opens the search index.
+SQL_READ_PRAGMAS = frozenset({"data_version"})
+
+
+@contextlib.contextmanager
+def sqlite_read_only(
+    conn: sqlite3.Connection,
+    functions: Counter | None = None,
+    columns: set[tuple[str, str]] | None = None,
+):
+    """
+    Deny everything but reads on conn while the block runs.
+    SQLite consults the authorizer as each statement is compiled, so writes,
+    schema changes, PRAGMA and ATTACH fail with "not authorized" however
+    they are spelled, and nothing is matched against the query text. Only
+    the pragmas in SQL_READ_PRAGMAS may be read. The authorizer is removed
+    on exit.
+
+    Example:
+        with sqlite_read_only(conn):
+            rows = conn.execute(query).fetchall()
+
+    Args:
+        conn: The connection to restrict
+        functions: If given, counts the SQL functions each statement calls
+        columns: If given, collects the (table, column) pairs statements read
+    """
+
+    def authorizer(action, arg1, arg2, db_name, source):
+        if action == sqlite3.SQLITE_PRAGMA:
+            if arg2 is None and arg1.lower() in SQL_READ_PRAGMAS:
+                return sqlite3.SQLITE_OK
+            return sqlite3.SQLITE_DENY
+        if action not in SQL_READ_ACTIONS:
+            return sqlite3.SQLITE_DENY
+        if action == sqlite3.SQLITE_FUNCTION and functions is not None:
+            functions[arg2.lower()] += 1
+        if action == sqlite3.SQLITE_READ and columns is not None:
+            columns.add((arg1.lower(), arg2.lower()))
+        return sqlite3.SQLITE_OK
+
+    # The first time a connection uses a virtual table, SQLite checks its
+    # schema as though it were updating sqlite_master, so connect them
+    # all before the authorizer is in place
+    for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master "
+        "WHERE type = 'table' AND sql LIKE 'CREATE VIRTUAL TABLE%'"
+    ).fetchall():
+        conn.execute(f'SELECT 1 FROM "{name}" LIMIT 0').fetchall()
+
+    conn.set_authorizer(authorizer)
+    try:
+        yield
+    finally:
+        conn.set_authorizer(None)
+
+
 def rate_limit(calls: int, period: int):
     """
     Decorator to rate limit command usage per user.
@@ -103,54 +268,114 @@ def rate_limit(calls: int, period: int):
     return decorator
 
 
-def get_safe_exec_globals() -> dict[str, Any]:
+def refund_rate_limit(ctx):
     """
-    Return a restricted set of globals for exec() to prevent dangerous operations.
-    Only includes safe matplotlib functionality.
+    Give back the call a rate-limited command just recorded, for work that
+    turned out to cost nothing (such as a cached result).
     """
+    user_id = str(ctx.author.id)
+    command_name = ctx.command.name if ctx.command else "unknown"
+    calls = _rate_limits[user_id][command_name]
+    if calls:
+        calls.pop()
+
+
+# Builtins available to !matplotlib code. Everything else, including
+# __import__, open, eval and exec, is missing from exec's globals.
+SAFE_BUILTINS = {
+    func.__name__: func
+    for func in (
+        abs,
+        all,
+        any,
+        bool,
+        dict,
+        enumerate,
+        filter,
+        float,
+        int,
+        len,
+        list,
+        map,
+        max,
+        min,
+        range,
+        reversed,
+        round,
+        set,
+        sorted,
+        str,
+        sum,
+        tuple,
+        zip,
+    )
+}
+
+
+# The parts of matplotlib !matplotlib code can reach as matplotlib.<name>.
+# The package itself stays out of reach: it has use(), rc_file() and the like.
+PLOT_SUBMODULES = (
+    "cm",
+    "colors",
+    "dates",
+    "gridspec",
+    "lines",
+    "markers",
+    "patches",
+    "ticker",
+    "transforms",
+)
+
+
+@functools.cache
+def plot_namespace() -> SimpleNamespace:
+    """The stand-in for matplotlib in !matplotlib code: PLOT_SUBMODULES and rcParams."""
+    import matplotlib
+
+    return SimpleNamespace(
+        rcParams=matplotlib.rcParams,
+        **{
+            name: importlib.import_module(f"matplotlib.{name}")
+            for name in PLOT_SUBMODULES
+        },
+    )
+
+
+@functools.cache
+def _safe_globals_template() -> MappingProxyType:
     import matplotlib.pyplot as plt
     import numpy as np
 
-    # Only allow safe functions
-    safe_globals = {
-        "plt": plt,
-        "np": np,
-        # Math functions
-        "abs": abs,
-        "min": min,
-        "max": max,
-        "sum": sum,
-        "len": len,
-        "range": range,
-        "zip": zip,
-        "enumerate": enumerate,
-        "list": list,
-        "dict": dict,
-        "tuple": tuple,
-        "set": set,
-        # Explicitly blocked
-        "__import__": None,
-        "exec": None,
-        "eval": None,
-        "compile": None,
-        "open": None,
-        "input": None,
-        "__builtins__": {
-            "abs": abs,
-            "min": min,
-            "max": max,
-            "sum": sum,
-            "len": len,
-            "range": range,
-        },
-    }
+    return MappingProxyType(
+        {
+            "plt": plt,
+            "np": np,
+            "matplotlib": plot_namespace(),
+            **SAFE_BUILTINS,
+            "__builtins__": SAFE_BUILTINS,
+        }
+    )
 
+
+def get_safe_exec_globals() -> dict[str, Any]:
+    """
+    Return a restricted set of globals for exec() to prevent dangerous operations.
+    Only includes numpy, pyplot, plot_namespace() as matplotlib and a few
+    harmless builtins. The template is built once and frozen; each call
+    returns a cheap shallow copy, so one job's assignments never leak into
+    the next.
+    """
+    safe_globals = dict(_safe_globals_template())
+    safe_globals["__builtins__"] = dict(SAFE_BUILTINS)
     return safe_globals
 
 
 def validate_sql_query(query: str) -> tuple[bool, str]:
     """
-    Validate SQL query to prevent dangerous operations.
+    Check a query's text before it is compiled.
+    Only the length is checked here: what the query may do is enforced by
+    sqlite_read_only when it is compiled, so column names and aliases such
+    as `updated` or `created` are fine.
 
     Args:
         query: The SQL query to validate
@@ -158,40 +383,18 @@ def validate_sql_query(query: str) -> tuple[bool, str]:
     Returns:
         Tuple of (is_valid, error_message)
     """
-    query_upper = query.upper().strip()
-
-    # Only allow SELECT statements
-    if not query_upper.startswith("SELECT"):
-        return False, "Only SELECT queries are allowed"
-
-    # Block dangerous keywords
-    dangerous_keywords = [
-        "DROP",
-        "DELETE",
-        "INSERT",
-        "UPDATE",
-        "ALTER",
-        "CREATE",
-        "TRUNCATE",
-        "EXEC",
-        "EXECUTE",
-        "PRAGMA",
-    ]
-
-    for keyword in dangerous_keywords:
-        if keyword in query_upper:
-            return False, f"Dangerous keyword '{keyword}' is not allowed"
-
-    # Check for multiple statements (SQL injection attempt)
-    if ";" in query.rstrip(";"):
-        return False, "Multiple statements are not allowed"
-
+    if not query.strip():
+        return False, "The query is empty"
+    if len(query) > MAX_QUERY_LENGTH:
+        return False, f"Queries are limited to {MAX_QUERY_LENGTH:,} characters"
     return True, ""
 
 
-def limit_query_results(results: list, max_rows: int = 1000) -> tuple[list, bool]:
+def limit_query_results(results: Iterable, max_rows: int = 1000) -> tuple[list, bool]:
     """
     Limit the number of rows returned from a query.
+    Accepts a list or any iterable (such as a cursor); at most max_rows + 1
+    rows are read, so the rest of a large result set is never fetched.
 
     Args:
         results: Query results
@@ -200,9 +403,10 @@ def limit_query_results(results: list, max_rows: int = 1000) -> tuple[list, bool
     Returns:
         Tuple of (limited_results, was_truncated)
     """
-    if len(results) > max_rows:
-        return results[:max_rows], True
-    return results, False
+    rows = list(itertools.islice(results, max_rows + 1))
+    if len(rows) > max_rows:
+        return rows[:max_rows], True
+    return rows, False
 
 
 def format_size(bytes: int) -> str:
@@ -214,9 +418,532 @@ def format_size(bytes: int) -> str:
     return f"{bytes:.1f} TB"
 
 
+# Syntax !matplotlib code may use. Imports, classes, try/except (which
+# could swallow the time limit), with, async code and generators are left out.
+ALLOWED_NODES = frozenset(
+    {
+        ast.Module,
+        ast.Expr,
+        ast.Assign,
+        ast.AugAssign,
+        ast.AnnAssign,
+        ast.Delete,
+        ast.Pass,
+        ast.Break,
+        ast.Continue,
+        ast.If,
+        ast.For,
+        ast.While,
+        ast.FunctionDef,
+        ast.Return,
+        ast.Lambda,
+        ast.arguments,
+        ast.arg,
+        ast.Assert,
+        ast.Name,
+        ast.Constant,
+        ast.Attribute,
+        ast.Subscript,
+        ast.Slice,
+        ast.Starred,
+        ast.Call,
+        ast.keyword,
+        ast.BinOp,
+        ast.UnaryOp,
+        ast.BoolOp,
+        ast.Compare,
+        ast.IfExp,
+        ast.NamedExpr,
+        ast.List,
+        ast.Tuple,
+        ast.Set,
+        ast.Dict,
+        ast.ListComp,
+        ast.SetComp,
+        ast.DictComp,
+        ast.GeneratorExp,
+        ast.comprehension,
+        ast.JoinedStr,
+        ast.FormattedValue,
+    }
+    | {
+        node
+        for base in (ast.operator, ast.unaryop, ast.cmpop, ast.boolop, ast.expr_context)
+        for node in base.__subclasses__()
+    }
+)
+BLOCKED_NODES = {
+    ast.Import: "Imports are not allowed; plt, np and matplotlib are already available",
+    ast.ImportFrom: "Imports are not allowed; plt, np and matplotlib are already available",
+    ast.Try: "try/except is not allowed",
+    ast.ClassDef: "Class definitions are not allowed",
+    ast.Global: "global is not allowed",
+    ast.Nonlocal: "nonlocal is not allowed",
+}
+BLOCKED_NAMES = {
+    "__import__": "Dynamic imports are not allowed",
+    "eval": "eval() is not allowed",
+    "exec": "exec() is not allowed",
+    "compile": "compile() is not allowed",
+    "open": "File operations are restricted",
+    "input": "Input is not allowed",
+    "globals": "globals() is not allowed",
+    "locals": "locals() is not allowed",
+    "vars": "vars() is not allowed",
+    "getattr": "getattr() is not allowed",
+    "setattr": "setattr() is not allowed",
+    "delattr": "delattr() is not allowed",
+    "breakpoint": "breakpoint() is not allowed",
+}
+# Objects !matplotlib code must not reach, by dotted name: they read or
+# write files, block, switch backends or hand out the matplotlib package.
+# Every print_* method of the Agg canvas, which write image files, is added
+# to these. An attribute name is refused if it names one of them anywhere.
+UNSAFE_OBJECTS = (
+    "matplotlib",
+    "matplotlib.pyplot.savefig",
+    "matplotlib.pyplot.imsave",
+    "matplotlib.pyplot.imread",
+    "matplotlib.pyplot.show",
+    "matplotlib.pyplot.pause",
+    "matplotlib.pyplot.ginput",
+    "matplotlib.pyplot.waitforbuttonpress",
+    "matplotlib.pyplot.switch_backend",
+    "matplotlib.figure.Figure.savefig",
+    "matplotlib.figure.Figure.show",
+    "matplotlib.figure.Figure.ginput",
+    "matplotlib.figure.Figure.waitforbuttonpress",
+    "matplotlib.backend_bases.FigureCanvasBase.start_event_loop",
+    "matplotlib.image.AxesImage.write_png",
+    "matplotlib.rc_params_from_file",
+    "matplotlib.style.read_style_directory",
+    "matplotlib.style.reload_library",
+    "matplotlib.style.update_user_library",
+    "matplotlib.style.USER_LIBRARY_PATHS",
+    "numpy.load",
+    "numpy.save",
+    "numpy.savez",
+    "numpy.savez_compressed",
+    "numpy.savetxt",
+    "numpy.loadtxt",
+    "numpy.genfromtxt",
+    "numpy.fromfile",
+    "numpy.fromregex",
+    "numpy.memmap",
+    "numpy.ndarray.tofile",
+    "numpy.ndarray.dump",
+    "numpy.ndarray.dumps",
+    "numpy.ndarray.ctypes",
+)
+# Modules refused in the same way, matched by name so that numpy's lazily
+# imported submodules are caught before they are loaded
+UNSAFE_MODULES = frozenset(
+    {
+        "matplotlib.cbook",
+        "numpy.lib",
+        "numpy.ctypeslib",
+        "numpy.core",
+        "numpy.f2py",
+        "numpy.testing",
+    }
+)
+# Attributes that are only safe in context: str.format and format_map on a
+# literal template without attribute or item lookups, and style.use and
+# style.context called with the names of built-in styles (anything else is
+# read as a path, URL or package to import)
+TEMPLATE_ATTRIBUTES = frozenset({"format", "format_map"})
+STYLE_ATTRIBUTES = frozenset({"use", "context"})
+# Static complexity bounds, checked before any code runs
+MAX_CODE_NODES = 5000
+MAX_LOOP_DEPTH = 3
+MAX_LOOP_ITERATIONS = 10_000_000
+MAX_INT_LITERAL = 10**8
+MAX_STR_LITERAL = 10_000
+MAX_COLLECTION_LITERAL = 10_000
+MAX_ARRAY_ELEMENTS = 10**8
+
+
+@functools.cache
+def _unsafe_object_ids() -> frozenset[int]:
+    """The ids of UNSAFE_OBJECTS and the Agg canvas's print_* methods."""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    objects = [pkgutil.resolve_name(name) for name in UNSAFE_OBJECTS]
+    objects += [
+        inspect.getattr_static(FigureCanvasAgg, name)
+        for name in dir(FigureCanvasAgg)
+        if name.startswith("print_")
+    ]
+    return frozenset(map(id, objects))
+
+
+def _is_unsafe(root: Any, name: str) -> bool:
+    """Whether root.name is one of UNSAFE_OBJECTS or UNSAFE_MODULES."""
+    if inspect.ismodule(root) and f"{root.__name__}.{name}" in UNSAFE_MODULES:
+        return True
+    value = inspect.getattr_static(root, name, None)
+    if inspect.ismodule(value) and value.__name__ in UNSAFE_MODULES:
+        return True
+    return id(getattr(value, "__func__", value)) in _unsafe_object_ids()
+
+
+@functools.cache
+def safe_attribute_names() -> frozenset[str]:
+    """
+    Attribute names !matplotlib code may use: the public names of numpy,
+    pyplot, plot_namespace() and the objects plots are built from. Objects
+    are real instances where attributes are set per instance (ax.spines,
+    ax.transAxes, fig.canvas). A name is left out if it names an unsafe
+    object or module on any of them; one naming a module outside numpy and
+    matplotlib (pyplot exposes sys and importlib, for example) only counts
+    where it names something else. Built once, on first use.
+    """
+    import matplotlib.pyplot as plt
+    import numpy as np
+    from matplotlib import (
+        axes,
+        axis,
+        collections,
+        colorbar,
+        colors,
+        container,
+        figure,
+        gridspec,
+        image,
+        legend,
+        lines,
+        patches,
+        spines,
+        text,
+        ticker,
+    )
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = figure.Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    namespace = plot_namespace()
+    roots = [
+        np,
+        np.random,
+        np.linalg,
+        np.fft,
+        np.polynomial,
+        np.emath,
+        plt,
+        plt.cm,
+        plt.style,
+        namespace,
+        *vars(namespace).values(),
+        np.ndarray,
+        np.generic,
+        np.dtype,
+        np.random.Generator,
+        fig,
+        fig.canvas,
+        ax,
+        ax.xaxis,
+        ax.yaxis,
+        ax.xaxis.get_major_ticks()[0],
+        ax.xaxis.get_major_formatter(),
+        ax.xaxis.get_major_locator(),
+        ax.spines,
+        ax.spines["left"],
+        ax.transAxes,
+        ax.transData,
+        figure.Figure,
+        axes.Axes,
+        axis.Axis,
+        axis.Tick,
+        lines.Line2D,
+        text.Text,
+        patches.Rectangle,
+        patches.Wedge,
+        collections.PathCollection,
+        collections.PolyCollection,
+        container.BarContainer,
+        legend.Legend,
+        colorbar.Colorbar,
+        image.AxesImage,
+        colors.Colormap,
+        colors.Normalize,
+        spines.Spine,
+        ticker.Formatter,
+        ticker.Locator,
+        gridspec.GridSpec,
+        gridspec.SubplotSpec,
+        list,
+        dict,
+        str,
+        tuple,
+        set,
+    ]
+    names, unsafe = set(), set()
+    for root in roots:
+        for name in dir(root):
+            if name.startswith("_"):
+                continue
+            if _is_unsafe(root, name):
+                unsafe.add(name)
+                continue
+            value = inspect.getattr_static(root, name, None)
+            if inspect.ismodule(value) and not value.__name__.startswith(
+                ("numpy", "matplotlib")
+            ):
+                continue
+            names.add(name)
+    return frozenset(names - unsafe)
+
+
+@functools.cache
+def _style_names() -> frozenset[str]:
+    """Styles plt.style.use accepts by name, without touching files."""
+    import matplotlib.pyplot as plt
+
+    return frozenset({*plt.style.available, "default", "classic", "mpl20", "mpl15"})
+
+
+def _check_template(template: str):
+    """Refuse format fields that look up attributes or items, like {0.__class__}."""
+    try:
+        fields = list(string.Formatter().parse(template))
+    except ValueError as e:
+        raise UnsafeCodeError(f"Invalid format string: {e}")
+    for _, field, spec, _ in fields:
+        if field and ("." in field or "[" in field):
+            raise UnsafeCodeError(
+                "Format fields can't look up attributes or items; use an f-string"
+            )
+        if spec:
+            _check_template(spec)
+
+
+class UnsafeCodeError(Exception):
+    """Raised when code fails the static safety checks."""
+
+    pass
+
+
+class _CodeChecker(ast.NodeVisitor):
+    """Walks a parsed program, raising UnsafeCodeError at the first problem."""
+
+    def __init__(self):
+        self.attributes = safe_attribute_names()
+        self.loop_depth = 0
+        self.iterations = 1  # product of the known trip counts of enclosing loops
+
+    def generic_visit(self, node: ast.AST):
+        node_type = type(node)
+        if node_type in BLOCKED_NODES:
+            raise UnsafeCodeError(BLOCKED_NODES[node_type])
+        if node_type not in ALLOWED_NODES:
+            raise UnsafeCodeError(f"{node_type.__name__} statements are not allowed")
+        super().generic_visit(node)
+
+    def visit_Name(self, node: ast.Name):
+        if node.id in BLOCKED_NAMES:
+            raise UnsafeCodeError(BLOCKED_NAMES[node.id])
+        if node.id.startswith("__"):
+            raise UnsafeCodeError(f"'{node.id}' is not allowed")
+        self.generic_visit(node)
+
+    def visit_Attribute(self, node: ast.Attribute):
+        if node.attr.startswith("_"):
+            raise UnsafeCodeError(f"Private attribute '{node.attr}' is not allowed")
+        if node.attr not in self.attributes:
+            raise UnsafeCodeError(f"Attribute '{node.attr}' is not allowed")
+        if node.attr in TEMPLATE_ATTRIBUTES:
+            if not (
+                isinstance(node.value, ast.Constant)
+                and isinstance(node.value.value, str)
+            ):
+                raise UnsafeCodeError(f"{node.attr}() needs a literal template string")
+            _check_template(node.value.value)
+        if node.attr in STYLE_ATTRIBUTES:
+            # visit_Call checks the arguments of the calls it allows
+            raise UnsafeCodeError(f"'{node.attr}' may only be called with style names")
+        self.generic_visit(node)
+
+    def visit_Constant(self, node: ast.Constant):
+        value = node.value
+        if isinstance(value, int) and abs(value) > MAX_INT_LITERAL:
+            raise UnsafeCodeError(f"Numbers are limited to {MAX_INT_LITERAL:,}")
+        if isinstance(value, (str, bytes)) and len(value) > MAX_STR_LITERAL:
+            raise UnsafeCodeError(
+                f"Strings are limited to {MAX_STR_LITERAL:,} characters"
+            )
+
+    def visit_BinOp(self, node: ast.BinOp):
+        # 10 ** 12 is two small literals but one huge number
+        if isinstance(node.op, ast.Pow):
+            value = _constant_int(node)
+            if value is not None and abs(value) > MAX_INT_LITERAL:
+                raise UnsafeCodeError(f"Numbers are limited to {MAX_INT_LITERAL:,}")
+        self.generic_visit(node)
+
+    def _check_collection(self, node: ast.AST, items: list):
+        if len(items) > MAX_COLLECTION_LITERAL:
+            raise UnsafeCodeError(
+                f"Literals are limited to {MAX_COLLECTION_LITERAL:,} items"
+            )
+        self.generic_visit(node)
+
+    def visit_List(self, node: ast.List):
+        self._check_collection(node, node.elts)
+
+    def visit_Tuple(self, node: ast.Tuple):
+        self._check_collection(node, node.elts)
+
+    def visit_Set(self, node: ast.Set):
+        self._check_collection(node, node.elts)
+
+    def visit_Dict(self, node: ast.Dict):
+        self._check_collection(node, node.keys)
+
+    def visit_Call(self, node: ast.Call):
+        func = node.func
+        if isinstance(func, ast.Attribute) and func.attr in STYLE_ATTRIBUTES:
+            names = node.args[0] if len(node.args) == 1 else None
+            if isinstance(names, (ast.List, ast.Tuple)):
+                names = names.elts
+            else:
+                names = [names]
+            if node.keywords or not all(
+                isinstance(name, ast.Constant) and name.value in _style_names()
+                for name in names
+            ):
+                raise UnsafeCodeError(
+                    f"{func.attr}() only takes built-in style names, such as 'ggplot'"
+                )
+            self.visit(func.value)
+            return
+        # Constant shapes and sizes, as in np.zeros((1000, 1000))
+        for arg in [
+            *node.args,
+            *(k.value for k in node.keywords if k.arg in ("shape", "size")),
+        ]:
+            if isinstance(arg, (ast.Tuple, ast.List)):
+                dims = [_constant_int(elt) for elt in arg.elts]
+                if dims and None not in dims and math.prod(dims) > MAX_ARRAY_ELEMENTS:
+                    raise UnsafeCodeError(
+                        f"Arrays are limited to {MAX_ARRAY_ELEMENTS:,} elements"
+                    )
+        self.generic_visit(node)
+
+    @contextlib.contextmanager
+    def _loop(self, trip_count: int | None):
+        if self.loop_depth >= MAX_LOOP_DEPTH:
+            raise UnsafeCodeError(f"Loops may be nested at most {MAX_LOOP_DEPTH} deep")
+        outer = self.iterations
+        self.loop_depth += 1
+        self.iterations *= trip_count or 1
+        if self.iterations > MAX_LOOP_ITERATIONS:
+            raise UnsafeCodeError(
+                f"Loops would run {self.iterations:,} times "
+                f"(limit {MAX_LOOP_ITERATIONS:,})"
+            )
+        try:
+            yield
+        finally:
+            self.loop_depth -= 1
+            self.iterations = outer
+
+    def visit_For(self, node: ast.For):
+        self.visit(node.target)
+        self.visit(node.iter)
+        with self._loop(_range_length(node.iter)):
+            for child in [*node.body, *node.orelse]:
+                self.visit(child)
+
+    def visit_While(self, node: ast.While):
+        if isinstance(node.test, ast.Constant) and node.test.value:
+            raise UnsafeCodeError("Infinite loops are not allowed")
+        with self._loop(None):
+            self.generic_visit(node)
+
+    def _visit_comprehension(self, node: ast.AST, results: list[ast.AST]):
+        with contextlib.ExitStack() as stack:
+            for generator in node.generators:
+                self.visit(generator.iter)
+                stack.enter_context(self._loop(_range_length(generator.iter)))
+                self.visit(generator.target)
+                for condition in generator.ifs:
+                    self.visit(condition)
+            for result in results:
+                self.visit(result)
+
+    def visit_ListComp(self, node: ast.ListComp):
+        self._visit_comprehension(node, [node.elt])
+
+    def visit_SetComp(self, node: ast.SetComp):
+        self._visit_comprehension(node, [node.elt])
+
+    def visit_GeneratorExp(self, node: ast.GeneratorExp):
+        self._visit_comprehension(node, [node.elt])
+
+    def visit_DictComp(self, node: ast.DictComp):
+        self._visit_comprehension(node, [node.key, node.value])
+
+
+def _constant_int(node: ast.AST) -> int | None:
+    """
+    The value of an integer literal or constant arithmetic on literals,
+    such as -1 or 10**4, or None. Powers past MAX_INT_LITERAL are clamped
+    rather than computed.
+    """
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = _constant_int(node.operand)
+        return -value if value is not None else None
+    if isinstance(node, ast.BinOp) and isinstance(
+        node.op, (ast.Add, ast.Sub, ast.Mult, ast.Pow)
+    ):
+        left, right = _constant_int(node.left), _constant_int(node.right)
+        if left is None or right is None:
+            return None
+        if isinstance(node.op, ast.Pow):
+            if right < 0:
+                return None
+            if abs(left) > 1 and right * math.log10(abs(left)) > math.log10(
+                MAX_INT_LITERAL
+            ):
+                return MAX_INT_LITERAL + 1
+            return left**right
+        if isinstance(node.op, ast.Mult):
+            return left * right
+        return left + right if isinstance(node.op, ast.Add) else left - right
+    if (
+        isinstance(node, ast.Constant)
+        and isinstance(node.value, int)
+        and not isinstance(node.value, bool)
+    ):
+        return node.value
+    return None
+
+
+def _range_length(node: ast.AST) -> int | None:
+    """How many values range(<literals>) yields, or None if unknown."""
+    if (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Name)
+        and node.func.id == "range"
+        and 1 <= len(node.args) <= 3
+        and not node.keywords
+    ):
+        args = [_constant_int(arg) for arg in node.args]
+        if None not in args and args[2:] != [0]:
+            return len(range(*args))
+    return None
+
+
+@functools.lru_cache(maxsize=256)
 def check_code_safety(code: str) -> tuple[bool, str]:
     """
-    Check if code contains obviously dangerous patterns.
+    Check code against the static rules for !matplotlib, without running it.
+    The code is parsed and every node is checked: only ALLOWED_NODES
+    syntax, no blocked builtins or dunder names, only attributes from
+    safe_attribute_names(), and literal sizes, loop nesting and known
+    loop trip counts within the MAX_* bounds. Results are cached, so
+    reposted snippets are checked once.
 
     Args:
         code: Python code to check
@@ -224,21 +951,23 @@ def check_code_safety(code: str) -> tuple[bool, str]:
     Returns:
         Tuple of (is_safe, warning_message)
     """
-    dangerous_patterns = [
-        ("import os", "OS operations are restricted"),
-        ("import sys", "System operations are restricted"),
-        ("import subprocess", "Subprocess operations are not allowed"),
-        ("import socket", "Network operations are not allowed"),
-        ("__import__", "Dynamic imports are not allowed"),
-        ("eval(", "eval() is not allowed"),
-        ("exec(", "exec() is not allowed"),
-        ("compile(", "compile() is not allowed"),
-        ("open(", "File operations are restricted"),
-        ("while True", "Infinite loops may cause timeout"),
-    ]
-
-    for pattern, message in dangerous_patterns:
-        if pattern in code:
-            return False, message
-
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return False, f"Syntax error on line {e.lineno}: {e.msg}"
+    except (ValueError, RecursionError, MemoryError):
+        return False, "Code is too complex to check"
+
+    nodes = sum(1 for _ in ast.walk(tree))
+    if nodes > MAX_CODE_NODES:
+        return (
+            False,
+            f"Code is too long ({nodes:,} syntax nodes, limit {MAX_CODE_NODES:,})",
+        )
+    try:
+        _CodeChecker().visit(tree)
+    except UnsafeCodeError as e:
+        return False, str(e)
+    except RecursionError:
+        return False, "Code is too complex to check"
     return True, ""
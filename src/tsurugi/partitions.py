@@ -0,0 +1,225 @@
+"""
+Optional per-month layout of the message archive.
+Every UTC calendar month (by created_ms) is copied into its own database
+file. open_partitions attaches only the months a range query needs and
+unions them behind a temporary messages view, so questions about recent
+months never open the rest of the archive.
+The consolidated archive stays the source of truth; partition_archive
+copies whatever was stored since its last run.
+"""
+
+import collections
+import datetime
+import json
+import os
+import re
+import sqlite3
+
+from .database import (
+    ARCHIVE_DB_PATH,
+    CREATED_MS_COLUMN,
+    DATA_DIR,
+    MESSAGE_COLUMNS,
+    apply_pragmas,
+    register_functions,
+)
+
+PARTITION_DIR = os.path.join(DATA_DIR, "partitions")
+PARTITION_PATTERN = re.compile(r"^messages_(\d{4})_(\d{2})\.db$")
+# Records the last archive rowid copied into the partitions
+PARTITION_STATE_FILE = "state.json"
+# Rows read from the archive per round of partition commits
+PARTITION_BATCH_SIZE = 50000
+# SQLite's default limit on attached databases
+MAX_ATTACHED_PARTITIONS = 10
+
+PARTITION_COLUMNS = (*MESSAGE_COLUMNS, "polarity", "subjectivity")
+
+
+def month_of(created_ms: int) -> str:
+    """Returns the "YYYY_MM" partition a unix time in milliseconds falls in."""
+    moment = datetime.datetime.fromtimestamp(created_ms / 1000, datetime.timezone.utc)
+    return f"{moment.year:04d}_{moment.month:02d}"
+
+
+def partition_path(directory: str, month: str) -> str:
+    return os.path.join(directory, f"messages_{month}.db")
+
+
+def ensure_partition_schema(conn: sqlite3.Connection):
+    """Create the messages table and indexes of one month's partition."""
+    conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS messages
+                 (message_id TEXT PRIMARY KEY,
+                 author_id TEXT, author_name TEXT,
+                 content TEXT,
+                 created_at TEXT,
+                 attachments TEXT,
+                 guild_id TEXT,
+                 channel_id TEXT,
+                 polarity REAL,
+                 subjectivity REAL,
+                 created_ms {CREATED_MS_COLUMN})"""
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_created_ms ON messages (created_ms)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_author_id ON messages (author_id)"
+    )
+    conn.execute(
+        """CREATE INDEX IF NOT EXISTS idx_messages_channel_created
+           ON messages (channel_id, created_ms)"""
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_polarity ON messages (polarity)"
+    )
+    conn.commit()
+
+
+def find_partitions(directory: str = PARTITION_DIR) -> list[str]:
+    """Returns the "YYYY_MM" months that have a partition, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    months = []
+    for name in os.listdir(directory):
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            months.append(f"{match.group(1)}_{match.group(2)}")
+    return sorted(months)
+
+
+def partition_archive(
+    db_path: str = ARCHIVE_DB_PATH,
+    directory: str = PARTITION_DIR,
+    batch_size: int = PARTITION_BATCH_SIZE,
+) -> dict:
+    """
+    Copy newly archived messages into their monthly partitions.
+    Messages are only ever appended to the archive, so everything above the
+    last copied rowid is new. Sentiment scored after a message was copied is
+    carried over as well. Copies are idempotent, so an interrupted run can
+    simply be repeated.
+    Args:
+        db_path: The consolidated archive to read from.
+        directory: Where the monthly partition files live.
+        batch_size: Number of archive rows read per round of commits.
+    Returns:
+        A dict mapping each "YYYY_MM" month to the number of rows copied.
+    """
+    os.makedirs(directory, exist_ok=True)
+    state_path = os.path.join(directory, PARTITION_STATE_FILE)
+    last_rowid = 0
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            last_rowid = json.load(f).get("last_rowid", 0)
+
+    archive = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30.0)
+    partitions: dict[str, sqlite3.Connection] = {}
+    copied = collections.Counter()
+    columns = ", ".join(PARTITION_COLUMNS)
+    insert_sql = (
+        f"INSERT OR IGNORE INTO messages ({columns}) "
+        f"VALUES ({', '.join('?' for _ in PARTITION_COLUMNS)})"
+    )
+
+    def partition(month: str) -> sqlite3.Connection:
+        if month not in partitions:
+            path = os.path.abspath(partition_path(directory, month))
+            # URI filenames so the archive can be attached read-only below
+            conn = sqlite3.connect(f"file:{path}", uri=True)
+            apply_pragmas(conn)
+            ensure_partition_schema(conn)
+            partitions[month] = conn
+        return partitions[month]
+
+    try:
+        while True:
+            rows = archive.execute(
+                f"""SELECT rowid, created_ms, {columns} FROM messages
+                    WHERE rowid > ? ORDER BY rowid LIMIT ?""",
+                (last_rowid, batch_size),
+            ).fetchall()
+            if not rows:
+                break
+
+            by_month = collections.defaultdict(list)
+            for _, created_ms, *values in rows:
+                by_month[month_of(created_ms)].append(values)
+            for month, values in by_month.items():
+                conn = partition(month)
+                with conn:
+                    conn.executemany(insert_sql, values)
+                copied[month] += len(values)
+
+            last_rowid = rows[-1][0]
+            with open(state_path, "w") as f:
+                json.dump({"last_rowid": last_rowid}, f)
+
+        # Sentiment is scored in the background after archiving, so rows
+        # copied before then are still unscored in their partition
+        for month in find_partitions(directory):
+            conn = partition(month)
+            conn.execute("ATTACH DATABASE ? AS archive", (f"file:{db_path}?mode=ro",))
+            try:
+                with conn:
+                    conn.execute(
+                        """UPDATE messages
+                           SET polarity = a.polarity, subjectivity = a.subjectivity
+                           FROM archive.messages a
+                           WHERE messages.polarity IS NULL
+                             AND a.message_id = messages.message_id
+                             AND a.polarity IS NOT NULL"""
+                    )
+            finally:
+                conn.execute("DETACH DATABASE archive")
+    finally:
+        archive.close()
+        for conn in partitions.values():
+            conn.close()
+    return dict(copied)
+
+
+def open_partitions(
+    directory: str = PARTITION_DIR,
+    start: str | None = None,
+    end: str | None = None,
+) -> sqlite3.Connection:
+    """
+    Open a read-only connection over the partitions between start and end.
+    Only the months in range are attached, and a temporary messages view
+    unions them, so existing queries run unchanged. The custom SQL
+    functions are registered on the connection.
+    Args:
+        directory: Where the monthly partition files live.
+        start: First month to include, as an ISO date such as "2025-01" or
+            "2025-01-15". Defaults to the oldest partition.
+        end: Last month to include, in the same form. Defaults to the newest.
+    Returns:
+        The connection. The caller closes it.
+    """
+    months = [
+        month
+        for month in find_partitions(directory)
+        if (start is None or month >= start[:7].replace("-", "_"))
+        and (end is None or month <= end[:7].replace("-", "_"))
+    ]
+    if not months:
+        raise ValueError("No partitions found in that range.")
+    if len(months) > MAX_ATTACHED_PARTITIONS:
+        raise ValueError(
+            f"That range spans {len(months)} months; at most "
+            f"{MAX_ATTACHED_PARTITIONS} partitions can be opened at once."
+        )
+
+    # The main database is in memory, which lets ATTACH take URI filenames
+    conn = sqlite3.connect("file::memory:", uri=True)
+    for month in months:
+        path = os.path.abspath(partition_path(directory, month))
+        conn.execute(f"ATTACH DATABASE ? AS m{month}", (f"file:{path}?mode=ro",))
+    conn.execute(
+        "CREATE TEMP VIEW messages AS "
+        + " UNION ALL ".join(f"SELECT * FROM m{month}.messages" for month in months)
+    )
+    register_functions(conn)
+    return conn
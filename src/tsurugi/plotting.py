@@ -0,0 +1,442 @@
+"""
+Out-of-process rendering for !matplotlib.
+User code runs in a pool of worker processes forked from a server that has
+already imported numpy and matplotlib, so the bot's own pyplot state is
+never touched, a slow plot doesn't block the gateway, and several plots can
+render at once. Each job runs under its own CPU, memory and wall-clock
+limits, draws into a fresh figure that is closed as soon as it has been
+encoded, and returns the image bytes.
+"""
+
+import ast
+import asyncio
+import contextlib
+import hashlib
+import importlib.metadata
+import io
+import multiprocessing
+import os
+import re
+import resource
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+
+from .database import DATA_DIR
+from .helpers.cache import DiskLRUCache
+from .helpers.safety import TimeoutError, get_safe_exec_globals, timeout
+from .query import QueueFullError
+
+# Plots rendering at once, and how many more may wait for a free worker
+PLOT_WORKERS = 2
+PLOT_QUEUE_SIZE = 8
+# Per-job budgets: wall-clock seconds for the user's code, CPU seconds for
+# the whole job, and address space the job may add to its worker
+PLOT_TIMEOUT = 5
+PLOT_CPU_SECONDS = 10
+PLOT_MEMORY_LIMIT = 512 * 1024 * 1024
+# Extra wall-clock time before a stuck worker is killed from outside
+PLOT_KILL_GRACE = 10
+# Workers are replaced after this many jobs, so leaks don't accumulate
+PLOT_JOBS_PER_WORKER = 100
+# Imported once in the fork server; every worker starts with them loaded
+PLOT_PRELOAD = [
+    "numpy",
+    "matplotlib",
+    "matplotlib.backends.backend_agg",
+    "PIL.Image",
+    __name__,
+]
+# Default output, and the bounds users can choose from
+PLOT_DPI = 100
+PLOT_SIZE = (6.4, 4.8)  # inches
+PLOT_DPI_RANGE = (50, 300)
+PLOT_MAX_INCHES = 20
+PLOT_MAX_PIXELS = 4000 * 3000
+# png: lossless, as matplotlib saves it
+# png8: 256-colour palette, usually a third of the size; plots rarely need more
+# webp: lossless WebP, usually under half the size
+PLOT_FORMATS = ("png", "png8", "webp")
+PLOT_OPTION_PATTERN = re.compile(
+    r"(?P<fmt>png8|png|webp)|dpi=(?P<dpi>\d+)"
+    r"|size=(?P<width>\d+(?:\.\d+)?)x(?P<height>\d+(?:\.\d+)?)",
+    re.IGNORECASE,
+)
+
+
+class PlotError(Exception):
+    """Raised when a plot worker dies before returning its result."""
+
+    pass
+
+
+# Rendered plots kept on disk, keyed by the code's syntax tree and settings
+PLOT_CACHE_DIR = os.path.join(DATA_DIR, "plot_cache")
+PLOT_CACHE_BYTES = 256 * 1024 * 1024
+PLOT_CACHE_ENTRIES = 10000
+# Code using these draws something different on every run
+UNCACHEABLE_NAMES = {"random"}
+MATPLOTLIB_VERSION = importlib.metadata.version("matplotlib")
+
+
+@dataclass(frozen=True)
+class PlotSettings:
+    """Resolution, size (in inches) and encoding of a rendered plot."""
+
+    dpi: int = PLOT_DPI
+    width: float = PLOT_SIZE[0]
+    height: float = PLOT_SIZE[1]
+    fmt: str = "png"
+
+    def __post_init__(self):
+        low, high = PLOT_DPI_RANGE
+        if not low <= self.dpi <= high:
+            raise ValueError(f"DPI must be between {low} and {high}")
+        if not (
+            0 < self.width <= PLOT_MAX_INCHES and 0 < self.height <= PLOT_MAX_INCHES
+        ):
+            raise ValueError(f"Size must be at most {PLOT_MAX_INCHES} inches per side")
+        check_pixels(self.width * self.dpi, self.height * self.dpi)
+        if self.fmt not in PLOT_FORMATS:
+            raise ValueError(f"Format must be one of: {', '.join(PLOT_FORMATS)}")
+
+    @property
+    def extension(self) -> str:
+        return "webp" if self.fmt == "webp" else "png"
+
+
+def check_pixels(width: float, height: float):
+    if width * height > PLOT_MAX_PIXELS:
+        raise ValueError(
+            f"Plot is too large ({width:.0f}x{height:.0f} pixels, "
+            f"at most {PLOT_MAX_PIXELS:,} in total)"
+        )
+
+
+def parse_plot_options(text: str) -> tuple[PlotSettings, str]:
+    """
+    Split leading output options off !matplotlib input, such as
+    "webp dpi=150 size=8x4 <code>".
+    Returns:
+        Tuple of (PlotSettings, remaining text)
+    Raises:
+        ValueError: If an option is out of range
+    """
+    options = {}
+    rest = text.strip()
+    while rest:
+        first, *remainder = rest.split(None, 1)
+        match = PLOT_OPTION_PATTERN.fullmatch(first)
+        if not match:
+            break
+        if match["fmt"]:
+            options["fmt"] = match["fmt"].lower()
+        elif match["dpi"]:
+            options["dpi"] = int(match["dpi"])
+        else:
+            options["width"] = float(match["width"])
+            options["height"] = float(match["height"])
+        rest = remainder[0].strip() if remainder else ""
+    return PlotSettings(**options), rest
+
+
+def plot_cache_key(code: str, settings: PlotSettings) -> str | None:
+    """
+    Cache key for a plot: a hash of the code's syntax tree, which ignores
+    formatting and comments, the output settings and the matplotlib
+    version. None if the code doesn't parse or uses random numbers.
+    """
+    try:
+        tree = ast.parse(code)
+        for node in ast.walk(tree):
+            name = getattr(node, "attr", None) or getattr(node, "id", None)
+            if name in UNCACHEABLE_NAMES:
+                return None
+        source = ast.dump(tree)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return None
+    digest = hashlib.sha256(source.encode("utf-8"))
+    digest.update(repr((settings, MATPLOTLIB_VERSION)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+plot_cache = DiskLRUCache(
+    PLOT_CACHE_DIR, PLOT_CACHE_BYTES, PLOT_CACHE_ENTRIES, suffix=".img"
+)
+
+
+def _cpu_exceeded(signum, frame):
+    raise TimeoutError("Plot exceeded its CPU time limit")
+
+
+def _init_worker():
+    """
+    Select the Agg backend, import pyplot and build the exec globals
+    template before any job arrives.
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401
+
+    get_safe_exec_globals()
+    signal.signal(signal.SIGXCPU, _cpu_exceeded)
+
+
+def _address_space() -> int:
+    """This process's current virtual memory size in bytes (Linux)."""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+
+
+@contextlib.contextmanager
+def job_limits(cpu_seconds: float, memory_bytes: int):
+    """
+    Lower this worker's soft CPU and address space limits for one job.
+    Both are relative to what the worker has already used, and restored on
+    exit. Going over the CPU limit raises TimeoutError (via SIGXCPU);
+    going over the memory limit makes allocations fail with MemoryError.
+    """
+    old_cpu = resource.getrlimit(resource.RLIMIT_CPU)
+    old_as = resource.getrlimit(resource.RLIMIT_AS)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_limit = int(usage.ru_utime + usage.ru_stime + cpu_seconds) + 1
+    memory_limit = _address_space() + memory_bytes
+
+    def capped(limit: int, hard: int) -> int:
+        return limit if hard == resource.RLIM_INFINITY else min(limit, hard)
+
+    resource.setrlimit(resource.RLIMIT_CPU, (capped(cpu_limit, old_cpu[1]), old_cpu[1]))
+    resource.setrlimit(resource.RLIMIT_AS, (capped(memory_limit, old_as[1]), old_as[1]))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_AS, old_as)
+        resource.setrlimit(resource.RLIMIT_CPU, old_cpu)
+
+
+def encode_figure(figure, fmt: str = "png") -> bytes:
+    """
+    Draw a figure with the Agg renderer and encode the pixels.
+    Args:
+        figure: A matplotlib Figure. It is given an Agg canvas if it has
+            none.
+        fmt: One of PLOT_FORMATS.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from PIL import Image
+
+    canvas = figure.canvas
+    if not isinstance(canvas, FigureCanvasAgg):
+        canvas = FigureCanvasAgg(figure)
+    width, height = canvas.get_width_height()
+    check_pixels(width, height)
+    canvas.draw()
+    image = Image.frombuffer("RGBA", (width, height), canvas.buffer_rgba())
+
+    buffer = io.BytesIO()
+    if fmt == "webp":
+        image.save(buffer, format="webp", lossless=True)
+    elif fmt == "png8":
+        palette = image.convert("RGB").quantize(256, method=Image.Quantize.FASTOCTREE)
+        palette.save(buffer, format="png", optimize=True)
+    else:
+        image.save(buffer, format="png")
+    return buffer.getvalue()
+
+
+@contextlib.contextmanager
+def _job_figure(settings: PlotSettings, cpu_seconds: float, memory_bytes: int):
+    """
+    Run one job under its limits, on a new figure of the requested size.
+    Every figure the job made is released afterwards, before the next job.
+    """
+    import matplotlib.pyplot as plt
+
+    try:
+        with job_limits(cpu_seconds, memory_bytes):
+            yield plt.figure(
+                figsize=(settings.width, settings.height), dpi=settings.dpi
+            )
+    finally:
+        plt.close("all")
+
+
+def render_plot(
+    code: str,
+    settings: PlotSettings = PlotSettings(),
+    time_limit: float = PLOT_TIMEOUT,
+    cpu_seconds: float = PLOT_CPU_SECONDS,
+    memory_bytes: int = PLOT_MEMORY_LIMIT,
+) -> bytes:
+    """
+    Run user plotting code and return the resulting figure as image bytes.
+    The code draws on a new figure of the requested size; if it starts
+    figures of its own, the current one is rendered at the requested DPI.
+    Runs inside a plot worker; exceptions raised by the code are sent back
+    to the caller.
+    """
+    import matplotlib.pyplot as plt
+
+    safe_globals = get_safe_exec_globals()
+    with _job_figure(settings, cpu_seconds, memory_bytes):
+        timeout(time_limit)(exec)(code, safe_globals, {})
+        figure = plt.gcf()
+        figure.set_dpi(settings.dpi)
+        return encode_figure(figure, settings.fmt)
+
+
+def render_chart(
+    spec,
+    data,
+    settings: PlotSettings = PlotSettings(),
+    time_limit: float = PLOT_TIMEOUT,
+    cpu_seconds: float = PLOT_CPU_SECONDS,
+    memory_bytes: int = PLOT_MEMORY_LIMIT,
+) -> bytes:
+    """
+    Draw a charts.ChartSpec of charts.ChartData and return image bytes.
+    Runs inside a plot worker under the same limits as render_plot.
+    """
+    from .charts import draw_chart
+
+    with _job_figure(settings, cpu_seconds, memory_bytes) as figure:
+        timeout(time_limit)(draw_chart)(figure, spec, data)
+        return encode_figure(figure, settings.fmt)
+
+
+def _warm_up() -> int:
+    return os.getpid()
+
+
+class PlotPool:
+    """
+    Process pool for plot jobs with a bounded queue.
+    Each worker is a one-process executor that serves a single job at a
+    time, so a job that has to be killed takes down only its own worker.
+    Workers start on first use (or warm_up) and are rebuilt if they crash
+    or are killed, so one bad job never takes the pool down for good.
+    """
+
+    def __init__(
+        self,
+        workers: int = PLOT_WORKERS,
+        max_queued: int = PLOT_QUEUE_SIZE,
+        time_limit: float = PLOT_TIMEOUT,
+    ):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.time_limit = time_limit
+        self._executors: list[ProcessPoolExecutor | None] = [None] * workers
+        self._lock = threading.Lock()
+        self._idle: asyncio.Queue[int] | None = None  # free worker slots
+        self.pending = 0  # submitted and not yet finished
+
+    def _pool(self, slot: int) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executors[slot] is None:
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(PLOT_PRELOAD)
+                self._executors[slot] = ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=context,
+                    initializer=_init_worker,
+                    max_tasks_per_child=PLOT_JOBS_PER_WORKER,
+                )
+            return self._executors[slot]
+
+    def restart(self, slot: int):
+        """Kill one worker; its next job starts a fresh one."""
+        with self._lock:
+            executor, self._executors[slot] = self._executors[slot], None
+        if executor is None:
+            return
+        # ProcessPoolExecutor can't stop a running job, so kill its worker
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self._lock:
+            executors, self._executors = self._executors, [None] * self.workers
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    async def warm_up(self):
+        """Start all workers now, so the first plots don't wait for them."""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(self._pool(slot), _warm_up)
+                for slot in range(self.workers)
+            )
+        )
+
+    async def render(
+        self, code: str, settings: PlotSettings = PlotSettings()
+    ) -> tuple[bytes, float]:
+        """
+        Render a plot on the pool without blocking the event loop.
+        Returns:
+            Tuple of (image bytes, seconds spent rendering)
+        Raises:
+            QueueFullError: If the queue is already full
+            TimeoutError: If the code runs past its time or CPU budget
+            ValueError: If the figure is larger than PLOT_MAX_PIXELS
+            MemoryError: If the code runs past its memory budget
+            PlotError: If the worker died
+            Exception: Whatever the user's code raised
+        """
+        return await self._run(render_plot, code, settings, self.time_limit)
+
+    async def chart(self, spec, data, settings: PlotSettings = PlotSettings()):
+        """
+        Draw query results (see charts.draw_chart) on the pool.
+        Returns and raises as render does.
+        """
+        return await self._run(render_chart, spec, data, settings, self.time_limit)
+
+    async def _run(self, job, *args) -> tuple[bytes, float]:
+        if self.pending >= self.workers + self.max_queued:
+            raise QueueFullError(
+                f"Plot queue is full ({self.max_queued} waiting). Try again shortly."
+            )
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for slot in range(self.workers):
+                self._idle.put_nowait(slot)
+
+        self.pending += 1
+        try:
+            # Only submit once a worker is free, so the kill deadline below
+            # measures running time rather than time spent queued. The
+            # worker is this job's alone until it is handed back.
+            slot = await self._idle.get()
+            try:
+                loop = asyncio.get_running_loop()
+                started = time.monotonic()
+                future = loop.run_in_executor(self._pool(slot), job, *args)
+                try:
+                    image = await asyncio.wait_for(
+                        future, self.time_limit + PLOT_KILL_GRACE
+                    )
+                except asyncio.TimeoutError:
+                    self.restart(slot)
+                    raise TimeoutError(
+                        f"Execution exceeded {self.time_limit} second(s)"
+                    )
+                except BrokenProcessPool:
+                    self.restart(slot)
+                    raise PlotError("The plot worker crashed; try a smaller plot.")
+                return image, time.monotonic() - started
+            finally:
+                self._idle.put_nowait(slot)
+        finally:
+            self.pending -= 1
+
+
+plot_pool = PlotPool()
@@ -0,0 +1,674 @@
+"""
+Off-event-loop execution for !runsql.
+Queries run on a small thread pool so a slow query doesn't block the
+gateway heartbeat or other commands. sqlite3 releases the GIL while SQLite
+is stepping, so the event loop keeps running alongside a query.
+"""
+
+import asyncio
+import collections
+import contextlib
+import functools
+import io
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import BinaryIO, Callable
+
+from .database import (
+    EXPLAIN_PATTERN,
+    UDF_COSTS,
+    data_version,
+    filled_columns,
+    optimize_query,
+    register_functions,
+    without_udf_fallbacks,
+)
+from .helpers.cache import LRUCache
+from .helpers.safety import (
+    TimeoutError,
+    limit_query_results,
+    sqlite_read_only,
+    sqlite_timeout,
+)
+
+# Queries executing at once, and how many more may wait for a free worker
+QUERY_WORKERS = 2
+QUERY_QUEUE_SIZE = 8
+# Results are streamed and cut off at whichever budget is hit first.
+# The byte budget keeps the rendered file under Discord's upload limit.
+MAX_RESULT_ROWS = 1000
+MAX_RESULT_BYTES = 8 * 1024 * 1024
+FETCH_SIZE = 500
+# Cached query results; each one holds the rendered files
+RESULT_CACHE_ENTRIES = 256
+RESULT_CACHE_BYTES = 64 * 1024 * 1024
+# Memory-map the archive for reads instead of copying pages through the cache
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+
+class QueueFullError(Exception):
+    """Raised when the query queue has no room for another job."""
+
+    pass
+
+
+@dataclass
+class QueryStats:
+    """How long a job spent waiting and running, for reporting to users."""
+
+    queued_behind: int
+    wait_time: float
+    run_time: float
+
+
+@dataclass
+class QueryResult:
+    """Rendered result files (name, file object) and what was left out."""
+
+    files: list[tuple[str, BinaryIO]]
+    row_count: int
+    truncated: bool
+
+
+def iter_rows(cursor: sqlite3.Cursor, fetch_size: int = FETCH_SIZE):
+    """Yield rows from a cursor, fetching fetch_size at a time."""
+    while rows := cursor.fetchmany(fetch_size):
+        yield from rows
+
+
+def render_text(
+    cursor: sqlite3.Cursor,
+    query: str,
+    max_rows: int = MAX_RESULT_ROWS,
+    max_bytes: int = MAX_RESULT_BYTES,
+) -> QueryResult:
+    """
+    Render a query's rows as the !runsql text file.
+    Rows are streamed from the cursor and rendering stops at max_rows rows
+    or max_bytes bytes, so memory use doesn't depend on the result size.
+    """
+    buffer = io.BytesIO()
+    buffer.write(f"SQL Query:\n{query}\n\n{'=' * 60}\n\nResults:\n".encode("utf-8"))
+
+    rows, truncated = limit_query_results(iter_rows(cursor), max_rows)
+    if not rows:
+        buffer.write(b"Query executed successfully, but no results to display.")
+        buffer.seek(0)
+        return QueryResult([("query_results.txt", buffer)], 0, False)
+
+    buffer.write(b"Query Results:\n")
+    row_count = 0
+    for row in rows:
+        line = f"{row}\n".encode("utf-8")
+        if buffer.tell() + len(line) > max_bytes:
+            truncated = True
+            break
+        buffer.write(line)
+        row_count += 1
+
+    buffer.seek(0)
+    return QueryResult([("query_results.txt", buffer)], row_count, truncated)
+
+
+# String literals and quoted identifiers are kept verbatim when normalizing
+SQL_TOKEN_PATTERN = re.compile(
+    r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|(\s+)|([^'\"\s]+)"
+)
+
+
+def normalize_sql(query: str) -> str:
+    """
+    Canonical form of a query for cache keys: whitespace collapsed,
+    keywords and identifiers lowercased, trailing semicolons dropped.
+    Quoted text is left untouched.
+    """
+    parts = []
+    for quoted, space, text in SQL_TOKEN_PATTERN.findall(query.strip().rstrip(";")):
+        if quoted:
+            parts.append(quoted)
+        elif space:
+            parts.append(" ")
+        else:
+            parts.append(text.lower())
+    return "".join(parts).strip()
+
+
+def database_identity(db_path: str) -> tuple:
+    """
+    Identifies the current contents of a database file. Under WAL, commits
+    land in the -wal file first, so its mtime and size are included too.
+    """
+    st = os.stat(db_path)
+    identity = (st.st_dev, st.st_ino, st.st_mtime_ns)
+    try:
+        wal = os.stat(f"{db_path}-wal")
+        identity += (wal.st_mtime_ns, wal.st_size)
+    except FileNotFoundError:
+        pass
+    return identity
+
+
+class ResultCache:
+    """
+    LRU cache of rendered query results within a memory budget.
+    Keys combine the normalized SQL, the output format, the database file's
+    identity and the in-process data version, so any committed archive
+    write makes older entries unreachable; they age out of the LRU.
+    """
+
+    def __init__(
+        self, maxsize: int = RESULT_CACHE_ENTRIES, max_bytes: int = RESULT_CACHE_BYTES
+    ):
+        self._cache = LRUCache(
+            maxsize,
+            max_bytes=max_bytes,
+            sizeof=lambda entry: sum(len(data) for _, data in entry[0]),
+        )
+
+    def key(self, db_path: str, query: str, fmt: str | None = None) -> tuple:
+        db_path = os.path.abspath(db_path)
+        return (
+            normalize_sql(query),
+            fmt,
+            db_path,
+            database_identity(db_path),
+            data_version(),
+        )
+
+    def get(self, key: tuple) -> QueryResult | None:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        files, row_count, truncated = entry
+        return QueryResult(
+            [(name, io.BytesIO(data)) for name, data in files], row_count, truncated
+        )
+
+    def put(self, key: tuple, result: QueryResult):
+        """Cache a result if it fits the budget. Its files are left rewound."""
+        max_bytes = self._cache.max_bytes or 0
+        total = 0
+        for _, f in result.files:
+            total += f.seek(0, os.SEEK_END)
+            f.seek(0)
+        if total > max_bytes:
+            return
+
+        files = []
+        for name, f in result.files:
+            files.append((name, f.read()))
+            f.seek(0)
+        self._cache.put(key, (files, result.row_count, result.truncated))
+
+    def stats(self):
+        return self._cache.stats()
+
+
+result_cache = ResultCache()
+
+
+class ConnectionPool:
+    """
+    Shared read-only connections, keyed by database path.
+    Each connection has the custom SQL functions registered and the
+    query_only/mmap_size pragmas applied once, when it is opened. Idle
+    connections are recycled when the database file is replaced or
+    modified, so queries never run against a stale handle.
+    """
+
+    def __init__(
+        self, max_idle: int = QUERY_WORKERS, mmap_size: int = SQLITE_MMAP_SIZE
+    ):
+        self.max_idle = max_idle
+        self.mmap_size = mmap_size
+        self._idle: dict[str, list[tuple[sqlite3.Connection, tuple]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _identity(db_path: str) -> tuple:
+        st = os.stat(db_path)
+        return (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+    def _open(self, db_path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            f"file:{db_path}?mode=ro", uri=True, timeout=5.0, check_same_thread=False
+        )
+        conn.execute("PRAGMA query_only=ON")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        register_functions(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self, db_path: str):
+        """Check out a connection for db_path, returning it to the pool after."""
+        db_path = os.path.abspath(db_path)
+        identity = self._identity(db_path)
+
+        conn = None
+        stale = []
+        with self._lock:
+            idle = self._idle.setdefault(db_path, [])
+            while idle:
+                candidate, candidate_identity = idle.pop()
+                if candidate_identity == identity:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+        for old in stale:
+            old.close()
+        if conn is None:
+            conn = self._open(db_path)
+
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                idle = self._idle.setdefault(db_path, [])
+                if len(idle) < self.max_idle and not conn.in_transaction:
+                    idle.append((conn, identity))
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            pools, self._idle = self._idle, {}
+        for idle in pools.values():
+            for conn, _ in idle:
+                conn.close()
+
+
+connection_pool = ConnectionPool()
+
+
+class QueryRejectedError(Exception):
+    """Raised when a query isn't read-only or is estimated to cost too much."""
+
+    pass
+
+
+@dataclass
+class QueryPlan:
+    """
+    A query's EXPLAIN QUERY PLAN and what running it is estimated to cost.
+    cost counts rows visited plus custom function calls weighted by
+    UDF_COSTS; warnings are worth showing before the query runs.
+    """
+
+    steps: list[str]
+    full_scans: list[str]
+    functions: list[str]
+    cost: int
+    warnings: list[str] = field(default_factory=list)
+
+
+# Loops in EXPLAIN QUERY PLAN output: a table (or alias) and how it is read
+PLAN_LOOP_PATTERN = re.compile(r"(SCAN|SEARCH) (\S+)(.*)")
+# Index constraints on a SEARCH, such as (author_id=? AND created_ms>?)
+PLAN_CONSTRAINT_PATTERN = re.compile(r"(\w+)([=<>])")
+# "FROM messages m", "JOIN authors AS a", ", messages b"
+TABLE_ALIAS_PATTERN = re.compile(
+    r"(?:\bFROM|\bJOIN|,)\s*([\w.]+)\s+(?:AS\s+)?(\w+)", re.IGNORECASE
+)
+# SQLite's own guesses without ANALYZE: an equality lookup on an index finds
+# about 10 rows, and each range bound keeps about a quarter of the table
+EQUALITY_ROWS = 10
+RANGE_FRACTION = 4
+# Estimated cost at which a query is refused, and at which users are warned
+# it may hit the time limit (about 150 ns per row visit)
+QUERY_COST_LIMIT = 500_000_000
+QUERY_COST_WARNING = 50_000_000
+
+
+class _TableSizes:
+    """
+    Row counts of a database's ordinary tables, looked up as needed.
+    Virtual tables, their shadow tables (such as messages_fts_data, whose
+    rowids are not row counts) and sqlite_ tables aren't sized. Counts come
+    from sqlite_stat1 when ANALYZE has been run, and COUNT(*) otherwise.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        tables = conn.execute(
+            "SELECT name, sql FROM sqlite_master "
+            "WHERE type = 'table' AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\'"
+        ).fetchall()
+        self.virtual = {
+            name.lower()
+            for name, sql in tables
+            if (sql or "").upper().startswith("CREATE VIRTUAL TABLE")
+        }
+        self.tables = {
+            name.lower(): name
+            for name, _ in tables
+            if name.lower() not in self.virtual
+            and not name.lower().startswith(tuple(f"{v}_" for v in self.virtual))
+        }
+        self.has_stats = bool(
+            conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+            ).fetchone()
+        )
+        self._counts: dict[str, int] = {}
+
+    def rows(self, name: str) -> int | None:
+        """The table's row count, or None if it isn't an ordinary table."""
+        table = self.tables.get(name.lower())
+        if table is None:
+            return None
+        if table not in self._counts:
+            stat = None
+            if self.has_stats:
+                stat = self.conn.execute(
+                    "SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1", (table,)
+                ).fetchone()
+            if stat:
+                self._counts[table] = int(stat[0].split()[0])
+            else:
+                self._counts[table] = self.conn.execute(
+                    f'SELECT COUNT(*) FROM "{table}"'
+                ).fetchone()[0]
+        return self._counts[table]
+
+    @functools.cached_property
+    def largest(self) -> int:
+        return max((self.rows(name) for name in self.tables), default=0)
+
+
+def estimate_cost(
+    conn: sqlite3.Connection, query: str, steps: list[tuple]
+) -> tuple[int, int, list[str]]:
+    """
+    Estimate how many rows a query plan visits.
+    Loops listed under the same parent are nested, so the rows each visits
+    multiply; correlated subqueries run once per row of the loops before
+    them. CTEs, subqueries and views are sized from their own plan nodes:
+    the rows they produce, or for a recursive CTE the rows its setup step
+    produces. Aliases are resolved from the query text. Virtual tables and
+    names that can't be resolved are assumed to be as big as the largest
+    ordinary table.
+    Args:
+        conn: The connection the query will run on
+        query: The query, for its table aliases
+        steps: Rows of its EXPLAIN QUERY PLAN
+    Returns:
+        Tuple of (rows visited, most rows any one loop visits, tables
+        scanned in full)
+    """
+    sizes = _TableSizes(conn)
+    aliases = {
+        alias.lower(): table
+        for table, alias in TABLE_ALIAS_PATTERN.findall(query)
+        if table.lower() in sizes.tables or table.lower() in sizes.virtual
+    }
+    children = collections.defaultdict(list)
+    for node_id, parent, _, detail in steps:
+        children[parent].append((node_id, detail))
+    built: dict[str, int] = {}  # CTEs, subqueries and views by name
+    full_scans: list[str] = []
+    peak = 0
+
+    def loop_rows(detail: str) -> int | None:
+        match = PLAN_LOOP_PATTERN.fullmatch(detail)
+        if not match:
+            return None
+        kind, name, how = match.groups()
+        if name == "CONSTANT":
+            return 1
+        if name in built:
+            return built[name]
+        table = aliases.get(name.lower(), name)
+        size = sizes.rows(table)
+        if table.lower() in sizes.virtual:
+            if "VIRTUAL TABLE INDEX" in how and not how.endswith(":"):
+                return sizes.largest // RANGE_FRACTION
+            full_scans.append(table)
+            return sizes.largest
+        if size is None:
+            return sizes.largest
+        if kind == "SCAN":
+            full_scans.append(table)
+            return size
+        constraints = PLAN_CONSTRAINT_PATTERN.findall(how.partition("(")[2])
+        if "INTEGER PRIMARY KEY" in how and ("rowid", "=") in constraints:
+            return 1
+        if any(op == "=" for _, op in constraints):
+            return EQUALITY_ROWS
+        return size // RANGE_FRACTION ** len(constraints)
+
+    def walk(parent: int, cte: str | None = None) -> tuple[int, int]:
+        """(rows visited, rows produced) by the steps under parent."""
+        nonlocal peak
+        visited, loops, produced = 0, 1, 0
+        for node_id, detail in children[parent]:
+            estimate = loop_rows(detail)
+            if estimate is not None:
+                loops *= max(estimate, 1)
+                visited += loops
+                peak = max(peak, loops)
+                continue
+            match = re.match(r"(?:MATERIALIZE|CO-ROUTINE) (\S+)", detail)
+            sub_visited, sub_rows = walk(node_id, match.group(1) if match else None)
+            if match:
+                built[match.group(1)] = sub_rows
+            # A recursive step reads back what the setup step produced
+            if detail == "SETUP" and cte:
+                built[cte] = sub_rows
+            if detail.startswith("CORRELATED"):
+                sub_visited *= loops
+            else:
+                produced += sub_rows
+            visited += sub_visited
+        return visited, max(loops, produced)
+
+    visited, _ = walk(0)
+    return visited, peak, full_scans
+
+
+def plan_query(conn: sqlite3.Connection, query: str) -> QueryPlan:
+    """
+    Compile a query read-only and estimate its cost, without running it.
+    The query is planned the way SQLJob will run it, after optimize_query;
+    an EXPLAIN query is only checked for being read-only, since it doesn't
+    run the statement it explains.
+    Rewritten sentiment and word count calls only count against it while
+    some rows of their stored column are still unfilled, as they are after
+    !archive or merge_archives until the backfill runs; then the UDF runs
+    for those rows, and is costed as running for every row.
+    Raises:
+        QueryRejectedError: If the query isn't a single read-only statement
+            or its estimated cost exceeds QUERY_COST_LIMIT
+    """
+    optimized = optimize_query(conn, query)
+    # EXPLAIN only compiles the statement it explains, so that is checked
+    explain = EXPLAIN_PATTERN.match(optimized)
+    if explain:
+        optimized = optimized[explain.end() :]
+    functions = collections.Counter()
+    filled = filled_columns(conn)
+    try:
+        with sqlite_read_only(conn):
+            steps = conn.execute(f"EXPLAIN QUERY PLAN {optimized}").fetchall()
+        with sqlite_read_only(conn, functions):
+            conn.execute(
+                f"EXPLAIN QUERY PLAN {without_udf_fallbacks(optimized, filled)}"
+            )
+    except sqlite3.ProgrammingError as e:
+        raise QueryRejectedError("Multiple statements are not allowed") from e
+    except sqlite3.DatabaseError as e:
+        if "not authorized" in str(e):
+            raise QueryRejectedError("Only read-only queries are allowed") from e
+        raise QueryRejectedError(str(e)) from e
+
+    if explain:
+        return QueryPlan([step[3] for step in steps], [], [], 0)
+
+    visited, peak, full_scans = estimate_cost(conn, optimized, steps)
+    called = [name for name in functions if name in UDF_COSTS]
+    # Without knowing which loop a call sits in, assume the busiest one
+    cost = visited + peak * sum(UDF_COSTS[name] * functions[name] for name in called)
+    plan = QueryPlan([step[3] for step in steps], full_scans, called, cost)
+
+    if cost > QUERY_COST_WARNING:
+        reason = (
+            f"full scan of {', '.join(dict.fromkeys(full_scans))}"
+            if full_scans
+            else "an index search that still reads many rows"
+        )
+        slow = [name for name in called if UDF_COSTS[name] >= 10]
+        if slow:
+            reason += f", calling {', '.join(slow)} on about {peak:,} rows"
+        advice = (
+            "Filter on an indexed column (created_ms, author_id, channel_id) "
+            "or add a LIMIT to a subquery"
+        )
+        if cost > QUERY_COST_LIMIT:
+            raise QueryRejectedError(
+                f"Query is too expensive: {reason} (about {cost:,} row visits, "
+                f"limit {QUERY_COST_LIMIT:,}). {advice}"
+            )
+        plan.warnings.append(
+            f"This query may hit the time limit: {reason} "
+            f"(about {cost:,} row visits). {advice}"
+        )
+    return plan
+
+
+def check_query(db_path: str, query: str) -> QueryPlan:
+    """plan_query on a pooled connection to db_path. Blocks; run it off the event loop."""
+    with connection_pool.connection(db_path) as conn:
+        return plan_query(conn, query)
+
+
+class SQLJob:
+    """
+    A single query against a database file.
+    Calling the job runs it (on a worker thread), read-only, and streams the
+    rows into render(cursor, query), aborting once it has run for timeout
+    seconds.
+    cancel() can be called from any thread to interrupt it early.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        query: str,
+        timeout: float | None = None,
+        render: Callable[[sqlite3.Cursor, str], QueryResult] = render_text,
+    ):
+        self.db_path = db_path
+        self.query = query
+        self.timeout = timeout
+        self.render = render
+        self._conn: sqlite3.Connection | None = None
+
+    def __call__(self) -> QueryResult:
+        with connection_pool.connection(self.db_path) as conn:
+            self._conn = conn
+            query = optimize_query(conn, self.query)
+            try:
+                with sqlite_read_only(conn):
+                    if self.timeout is None:
+                        return self.render(conn.execute(query), self.query)
+                    with sqlite_timeout(conn, self.timeout):
+                        return self.render(conn.execute(query), self.query)
+            finally:
+                self._conn = None
+
+    def cancel(self):
+        conn = self._conn
+        if conn is not None:
+            conn.interrupt()
+
+
+class QueryPool:
+    """
+    Thread pool with a bounded queue.
+    Jobs beyond workers + max_queued are rejected with QueueFullError
+    rather than piling up behind a slow query.
+    """
+
+    def __init__(
+        self, workers: int = QUERY_WORKERS, max_queued: int = QUERY_QUEUE_SIZE
+    ):
+        self.workers = workers
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="tsurugi-sql"
+        )
+        self._lock = threading.Lock()
+        self.pending = 0  # submitted and not yet finished
+        self.running = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of jobs waiting for a free worker."""
+        with self._lock:
+            return self.pending - self.running
+
+    async def run(self, job, timeout: float | None = None):
+        """
+        Run a job on the pool without blocking the event loop.
+        Args:
+            job: A callable; if it has cancel(), that is called on timeout.
+            timeout: Seconds allowed from when the job starts running. Jobs
+                that enforce their own deadline can leave this as None.
+        Returns:
+            Tuple of (result, QueryStats)
+        Raises:
+            QueueFullError: If the queue is already full
+            TimeoutError: If the job runs longer than timeout
+        """
+        with self._lock:
+            if self.pending >= self.workers + self.max_queued:
+                raise QueueFullError(
+                    f"Query queue is full ({self.max_queued} waiting). Try again shortly."
+                )
+            queued_behind = max(self.pending - self.workers, 0)
+            self.pending += 1
+
+        loop = asyncio.get_running_loop()
+        submitted = time.monotonic()
+        started = loop.create_future()
+
+        def run_job():
+            with self._lock:
+                self.running += 1
+            loop.call_soon_threadsafe(started.set_result, time.monotonic())
+            try:
+                return job()
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.pending -= 1
+
+        future = loop.run_in_executor(self._executor, run_job)
+        try:
+            start_time = await started
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                if hasattr(job, "cancel"):
+                    job.cancel()
+                raise TimeoutError(f"Execution exceeded {timeout} second(s)")
+        except BaseException:
+            # Don't leave the worker's eventual exception unretrieved
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            raise
+
+        finished = time.monotonic()
+        return result, QueryStats(
+            queued_behind=queued_behind,
+            wait_time=start_time - submitted,
+            run_time=finished - start_time,
+        )
+
+
+query_pool = QueryPool()
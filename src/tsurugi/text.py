@@ -0,0 +1,110 @@
+"""
+Tokenization and word counting for archived messages.
+tokenize_batch joins a chunk of messages around a separator and runs each
+precompiled regex once over the whole chunk, then uses NumPy to attribute
+the tokens back to their messages. That replaces several regex passes and
+a Python call per message with a handful of C-level calls per chunk.
+"""
+
+import re
+from typing import Sequence
+
+import numpy as np
+
+# Links, Discord mentions (users, channels, roles) and custom emoji are
+# stripped before words are extracted, all in one pass
+STRIP_PATTERN = re.compile(r"(?:https?://|www\.)\S+|<(?:@[!&]?\d+|#\d+|a?:\w+:\d+)>")
+
+# Lowercase words of two or more letters, keeping contractions whole.
+# Equivalent to \b[a-z]{2,}(?:'[a-z]+)?\b, but the lookarounds let the
+# regex engine reject non-letters faster than \b does.
+WORD_PATTERN = re.compile(r"(?<!\w)[a-z]{2,}(?:'[a-z]+)?(?!\w)")
+
+# Marks where one message ends in a joined chunk: a private-use character,
+# so it is neither a word character nor whitespace (and unlike NUL, NumPy
+# doesn't strip it). The surrounding spaces stop URL matches at the boundary
+# and keep word boundaries intact.
+SEPARATOR = "\ue000"
+JOINER = f" {SEPARATOR} "
+# Replaces SEPARATOR inside a message; equally non-word and non-whitespace
+SEPARATOR_STANDIN = "\ue001"
+TOKEN_PATTERN = re.compile(f"{SEPARATOR}|{WORD_PATTERN.pattern}")
+
+
+def clean_text(text: str) -> str:
+    """Remove URLs, mentions and custom emoji, and lowercase the rest."""
+    return STRIP_PATTERN.sub("", text).lower()
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Tokenize text into words.
+    - Converts to lowercase
+    - Removes URLs, mentions, emojis
+    - Splits on word boundaries
+    - Filters short words
+    """
+    if not text:
+        return []
+    return WORD_PATTERN.findall(clean_text(text))
+
+
+def _join(texts: Sequence[str | None]) -> str:
+    """Join a chunk of messages around SEPARATOR, replacing any it contains."""
+    joined = JOINER.join(text or "" for text in texts)
+    if joined.count(SEPARATOR) != len(texts) - 1:
+        joined = JOINER.join(
+            (text or "").replace(SEPARATOR, SEPARATOR_STANDIN) for text in texts
+        )
+    return joined
+
+
+def _per_message(parts: list[str], n: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Split the parts found in a joined chunk into real items and separators.
+    Returns:
+        (is_item, counts): a mask of the parts that aren't separators, and
+        how many of them each of the n messages has.
+    """
+    is_item = np.array(parts, dtype=object) != SEPARATOR
+    message = np.cumsum(~is_item)
+    counts = np.bincount(message[is_item], minlength=n)
+    return is_item, counts
+
+
+def tokenize_batch(texts: Sequence[str | None]) -> tuple[list[str], np.ndarray]:
+    """
+    Tokenize a chunk of messages the way tokenize does, in one pass.
+    Args:
+        texts: Message contents. None counts as empty.
+    Returns:
+        (tokens, counts): every token in message order, and the number of
+        tokens each message contributed. split_tokens regroups them.
+    """
+    if not texts:
+        return [], np.zeros(0, dtype=np.int64)
+    matches = TOKEN_PATTERN.findall(clean_text(_join(texts)))
+    if not matches:
+        return [], np.zeros(len(texts), dtype=np.int64)
+    is_item, counts = _per_message(matches, len(texts))
+    return np.array(matches, dtype=object)[is_item].tolist(), counts
+
+
+def split_tokens(tokens: list[str], counts: np.ndarray) -> list[list[str]]:
+    """Regroup tokenize_batch output into one token list per message."""
+    ends = np.cumsum(counts).tolist()
+    starts = [0, *ends[:-1]]
+    return [tokens[start:end] for start, end in zip(starts, ends)]
+
+
+def word_counts(texts: Sequence[str | None]) -> np.ndarray:
+    """
+    Whitespace-separated word counts for a chunk of messages, matching the
+    word_count SQL function. str.split is already a single C call per
+    message, which measured faster than splitting a joined chunk.
+    """
+    return np.fromiter(
+        (len(text.split()) if text else 0 for text in texts),
+        dtype=np.int64,
+        count=len(texts),
+    )
@@ -15,3 +15,696 @@ def test_bot_instantiation():
     assert bot is not None
     assert hasattr(bot, "run")
     assert hasattr(bot, "add_cog")
+
+
+# Test that the buffered writer commits each full batch on its own
+def test_message_writer_commits_batches():
+    import sqlite3
+
+    from tsurugi.database import MessageWriter, ensure_schema
+
+    conn = sqlite3.connect(":memory:")
+    ensure_schema(conn)
+    writer = MessageWriter(conn, batch_size=2)
+    for i in range(5):
+        writer.add((str(i), "1", "name", "hello", "2024-01-01T00:00:00", "", "1", "2"))
+
+    assert writer.batches_committed == 2
+    assert len(writer.buffer) == 1
+    writer.flush()
+    assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 5
+
+
+# Test that batch tokenizing matches tokenizing each message on its own
+def test_tokenize_batch_matches_tokenize():
+    from tsurugi.text import split_tokens, tokenize, tokenize_batch, word_counts
+
+    texts = [
+        "Hello <@123> WORLD https://example.com/x don't",
+        None,
+        "",
+        "café 12ab ok <:wave:42>ok",
+        "a\ue000b sep",
+    ]
+    tokens, counts = tokenize_batch(texts)
+    assert split_tokens(tokens, counts) == [tokenize(text) for text in texts]
+    assert word_counts(texts).tolist() == [len((t or "").split()) for t in texts]
+
+
+# Test that written messages are searchable with MATCH using the shared tokenizer
+def test_message_writer_indexes_content():
+    import sqlite3
+
+    from tsurugi.database import MessageWriter, ensure_schema
+
+    conn = sqlite3.connect(":memory:")
+    ensure_schema(conn)
+    with MessageWriter(conn, batch_size=10) as writer:
+        writer.add(
+            ("1", "1", "a", "Don't <@42> see https://zebra.com", "", "", "1", "2")
+        )
+        writer.add(("2", "1", "a", "A ZEBRA crossing", "", "", "1", "2"))
+        writer.flush()
+
+        def search(term):
+            return conn.execute(
+                """SELECT m.message_id FROM messages_fts
+                   JOIN messages m ON m.rowid = messages_fts.rowid
+                   WHERE messages_fts MATCH ? ORDER BY m.rowid""",
+                (term,),
+            ).fetchall()
+
+        assert search("zebra") == [("2",)]
+        assert search('"don\'t"') == [("1",)]
+
+
+# Test that the daily stats count each stored message once
+def test_message_writer_updates_daily_stats():
+    import sqlite3
+
+    from tsurugi.database import MessageWriter, ensure_schema
+
+    conn = sqlite3.connect(":memory:")
+    ensure_schema(conn)
+    with MessageWriter(conn, batch_size=2) as writer:
+        day = "2024-01-01T10:00:00+00:00"
+        writer.add(("1", "7", "a", "one two", day, "x,y", "1", "2"))
+        writer.add(("2", "7", "a", "three", day, "", "1", "2"))
+        writer.add(("1", "7", "a", "duplicate", day, "", "1", "2"))
+        writer.flush()
+
+        assert conn.execute(
+            """SELECT day, message_count, word_count, attachment_count
+               FROM daily_author_stats"""
+        ).fetchall() == [("2024-01-01", 2, 3, 2)]
+
+
+# Test that attachment urls are split into their own rows with a guessed type
+def test_split_attachment_urls():
+    from tsurugi.database import split_attachment_urls
+
+    rows = split_attachment_urls(
+        "1",
+        "https://cdn.example.com/a/my%20cat.png?ex=1,https://cdn.example.com/b/c.mp4",
+    )
+    assert rows == [
+        (
+            "1",
+            0,
+            "https://cdn.example.com/a/my%20cat.png?ex=1",
+            "my cat.png",
+            None,
+            "image/png",
+        ),
+        ("1", 1, "https://cdn.example.com/b/c.mp4", "c.mp4", None, "video/mp4"),
+    ]
+    assert split_attachment_urls("1", "") == []
+
+
+# Test that author UDF calls on author_id become authors table lookups
+def test_rewrite_author_calls():
+    from tsurugi.database import rewrite_author_calls
+
+    assert rewrite_author_calls("SELECT 1 WHERE is_tracked(m.author_id) = 1") == (
+        "SELECT 1 WHERE m.author_id IN (SELECT account_id FROM authors)"
+    )
+    assert rewrite_author_calls("SELECT is_tracked(author_id) = 10") == (
+        "SELECT (author_id IN (SELECT account_id FROM authors)) = 10"
+    )
+    assert rewrite_author_calls("SELECT real_name(author_id)") == (
+        "SELECT COALESCE((SELECT real_name FROM authors WHERE account_id = author_id),"
+        " NULLIF(author_id, ''), 'Unknown')"
+    )
+    # Inside a larger expression the comparison keeps its operand
+    assert rewrite_author_calls("SELECT 1 WHERE x + is_tracked(author_id) = 1") == (
+        "SELECT 1 WHERE x + (author_id IN (SELECT account_id FROM authors)) = 1"
+    )
+    # String literals are left alone
+    query = "SELECT 'is_tracked(author_id) = 1' AS s, author_id FROM messages"
+    assert rewrite_author_calls(query) == query
+
+
+# Test that created_ms is derived from the message id and upgraded in place
+def test_created_ms_from_snowflake():
+    import sqlite3
+
+    from tsurugi.database import ensure_schema
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute(
+        """CREATE TABLE messages (message_id TEXT PRIMARY KEY, author_id TEXT,
+           author_name TEXT, content TEXT, created_at TEXT, attachments TEXT)"""
+    )
+    conn.execute("INSERT INTO messages (message_id) VALUES ('175928847299117063')")
+    ensure_schema(conn)
+    ensure_schema(conn)
+
+    assert conn.execute("SELECT created_ms FROM messages").fetchone() == (
+        1462015105796,
+    )
+
+
+# Test that sentiment UDF calls on content read the stored scores first
+def test_rewrite_sentiment_calls():
+    from tsurugi.database import rewrite_sentiment_calls
+
+    query = "SELECT sentiment_polarity(m.content), word_count(content) FROM messages m"
+    assert rewrite_sentiment_calls(query) == (
+        "SELECT COALESCE(m.polarity, sentiment_polarity(m.content)),"
+        " word_count(content) FROM messages m"
+    )
+    # Calls on anything other than the content column are left alone
+    assert rewrite_sentiment_calls("SELECT sentiment_label('hi')") == (
+        "SELECT sentiment_label('hi')"
+    )
+    # Text inside string literals is left alone
+    assert rewrite_sentiment_calls("SELECT 'sentiment_label(content)'") == (
+        "SELECT 'sentiment_label(content)'"
+    )
+
+
+# Test that sentiment UDFs score numbers and blobs as neutral
+def test_sentiment_non_text():
+    import sqlite3
+
+    from tsurugi.database import register_functions
+
+    conn = sqlite3.connect(":memory:")
+    register_functions(conn)
+    row = conn.execute(
+        "SELECT sentiment_polarity(42), sentiment_subjectivity(x'00'),"
+        " sentiment_polarity(1.5), sentiment_polarity('I love this')"
+    ).fetchone()
+    assert row[:3] == (0.0, 0.0, 0.0) and row[3] > 0
+
+
+# Test that sentiment calls on a content column of a CTE aren't rewritten
+def test_optimize_query_sentiment_in_cte():
+    import sqlite3
+
+    from tsurugi.database import ensure_schema, optimize_query, register_functions
+
+    conn = sqlite3.connect(":memory:")
+    ensure_schema(conn)
+    register_functions(conn)
+    conn.execute(
+        "INSERT INTO messages (message_id, content, polarity, subjectivity) "
+        "VALUES ('175928847299117063', 'what a day', 0.5, 0.5)"
+    )
+
+    query = (
+        "WITH t AS (SELECT 'awful' AS content) "
+        "SELECT sentiment_polarity(content) FROM t"
+    )
+    assert optimize_query(conn, query) == query
+    assert conn.execute(optimize_query(conn, query)).fetchone() == (-1.0,)
+
+    query = "SELECT sentiment_polarity(content) FROM messages"
+    assert "COALESCE(polarity" in optimize_query(conn, query)
+    assert conn.execute(optimize_query(conn, query)).fetchone() == (0.5,)
+
+
+# Test that plot jobs return PNG bytes and stop at their memory limit
+def test_render_plot_limits():
+    import resource
+
+    from tsurugi.plotting import render_plot
+
+    before = resource.getrlimit(resource.RLIMIT_AS)
+    png = render_plot("plt.plot([1, 2, 3], [4, 5, 6])")
+    assert png.startswith(b"\x89PNG")
+
+    try:
+        render_plot("a = np.ones((20000, 20000))", memory_bytes=64 * 1024 * 1024)
+    except MemoryError:
+        pass
+    else:
+        raise AssertionError("Expected MemoryError")
+    # The limits only apply while the job runs
+    assert resource.getrlimit(resource.RLIMIT_AS) == before
+
+
+# Test that leading !matplotlib options pick the plot's size and encoding
+def test_parse_plot_options():
+    from tsurugi.plotting import PlotSettings, parse_plot_options, render_plot
+
+    settings, code = parse_plot_options("webp dpi=50 size=4x2\nplt.plot([1, 2])")
+    assert settings == PlotSettings(dpi=50, width=4.0, height=2.0, fmt="webp")
+    assert code == "plt.plot([1, 2])"
+    assert parse_plot_options("plt.plot([1])") == (PlotSettings(), "plt.plot([1])")
+
+    image = render_plot(code, settings)
+    assert image[:4] == b"RIFF" and image[8:12] == b"WEBP"
+
+    try:
+        parse_plot_options("dpi=1000 plt.plot([1])")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected ValueError")
+
+
+# Test that the disk cache evicts by size and reloads its entries in LRU order
+def test_disk_lru_cache():
+    import tempfile
+
+    from tsurugi.helpers.cache import DiskLRUCache
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = DiskLRUCache(directory, max_bytes=10)
+        cache.put("a", b"aaaa")
+        cache.put("b", b"bbbb")
+        assert cache.get("a") == b"aaaa"
+        cache.put("c", b"cccc")  # evicts b, the least recently used
+        assert cache.get("b") is None
+        assert cache.stats().nbytes == 8
+
+        reopened = DiskLRUCache(directory, max_bytes=10)
+        assert reopened.get("c") == b"cccc"
+        reopened.put("d", b"dddd")  # a is now the oldest
+        assert reopened.get("a") is None
+        assert len(reopened) == 2
+
+
+# Test that plot cache keys ignore formatting but not code or settings
+def test_plot_cache_key():
+    from tsurugi.plotting import PlotSettings, plot_cache_key
+
+    settings = PlotSettings()
+    key = plot_cache_key("plt.plot([1, 2])\nplt.title('a')", settings)
+    assert key == plot_cache_key('# demo\nplt.plot([1,2])\n\nplt.title("a")', settings)
+    assert key != plot_cache_key("plt.plot([1, 2])\nplt.title('b')", settings)
+    assert key != plot_cache_key(
+        "plt.plot([1, 2])\nplt.title('a')", PlotSettings(fmt="webp")
+    )
+    assert plot_cache_key("plt.plot(np.random.rand(5))", settings) is None
+    assert plot_cache_key("plt.plot(", settings) is None
+
+
+# Test that query results are read into typed columns and charted
+def test_fetch_columns_and_draw_chart():
+    import sqlite3
+
+    import numpy as np
+    from matplotlib.figure import Figure
+
+    from tsurugi.charts import ChartSpec, draw_chart, fetch_columns, parse_chart_spec
+
+    spec, settings, query = parse_chart_spec("bar bins=10 webp SELECT 1")
+    assert (spec, settings.fmt, query) == (
+        ChartSpec("bar", bins=10),
+        "webp",
+        "SELECT 1",
+    )
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE t (day TEXT, n INTEGER, half REAL, label TEXT)")
+    conn.executemany(
+        "INSERT INTO t VALUES (?, ?, ?, ?)",
+        [
+            ("2024-01-01 10:00:00+00:00", 1, None, "a"),
+            ("2024-01-02 10:00:00+00:00", 2, 1.0, "b"),
+            ("2024-01-03 10:00:00+00:00", 3, 1.5, "c"),
+        ],
+    )
+    data = fetch_columns(conn.execute("SELECT * FROM t"), "", max_rows=2)
+    assert data.columns == ["day", "n", "half", "label"]
+    assert data.row_count == 2 and data.truncated
+    assert [array.dtype.kind for array in data.arrays] == ["M", "i", "f", "U"]
+    assert np.isnan(data.arrays[2][0])
+
+    draw_chart(
+        Figure(),
+        ChartSpec("line"),
+        fetch_columns(conn.execute("SELECT day, n, half FROM t"), ""),
+    )
+    try:
+        draw_chart(Figure(), ChartSpec("bar"), data)
+    except ValueError as e:
+        assert "label" in str(e)
+    else:
+        raise AssertionError("Expected ValueError")
+
+
+# Test that the code checker rejects escapes and runaway code but not plots
+def test_check_code_safety():
+    from tsurugi.helpers.safety import check_code_safety
+
+    safe = [
+        "x = np.linspace(0, 10, 100)\nplt.plot(x, np.sin(x))\nplt.title('sine')",
+        "fig, ax = plt.subplots()\nfor i in range(10):\n    ax.bar(i, i * i)",
+        "plt.hist([n % 7 for n in range(1000)], bins=7)",
+        "fig, ax = plt.subplots()\nax.spines['top'].set_visible(False)\n"
+        "ax.xaxis.set_major_formatter(matplotlib.dates.DateFormatter('%b'))\n"
+        "ax.yaxis.grid(True)\nax.text(0, 1, 'x', transform=ax.transAxes)\n"
+        "fig.canvas.draw()",
+        "plt.style.use('ggplot')",
+        "plt.title('{} messages'.format(len([1, 2])))",
+    ]
+    for code in safe:
+        assert check_code_safety(code) == (True, ""), code
+
+    unsafe = [
+        "import os",
+        "plt.importlib.import_module('os')",
+        "().__class__.__base__",
+        "eval('1')",
+        "plt.savefig('/tmp/plot.png')",
+        "try:\n    pass\nexcept:\n    pass",
+        "while True:\n    pass",
+        "for i in range(10**4):\n    for j in range(10**4):\n        pass",
+        "x = 10**20",
+        "np.ones((100000, 100000))",
+        "plt.style.use('/etc/matplotlibrc')",
+        "use = plt.style.use",
+        "'{0.__class__}'.format(1)",
+        "template = '{}'\ntemplate.format(1)",
+        "matplotlib.use('TkAgg')",
+        "plt.matplotlib.use('TkAgg')",
+        "fig, ax = plt.subplots()\nfig.canvas.print_png('/tmp/plot.png')",
+        "np.arange(3).ctypes",
+    ]
+    for code in unsafe:
+        assert not check_code_safety(code)[0], code
+
+
+# Test that queries are checked read-only and by the cost of their plan
+def test_plan_query():
+    import sqlite3
+
+    from tsurugi.database import ensure_schema, register_functions
+    from tsurugi.query import QueryRejectedError, plan_query
+
+    conn = sqlite3.connect(":memory:")
+    ensure_schema(conn)
+    register_functions(conn)
+    conn.executemany(
+        "INSERT INTO messages (message_id) VALUES (?)",
+        ((str(i),) for i in range(30000)),
+    )
+
+    plan = plan_query(conn, "SELECT created_at AS updated FROM messages")
+    assert plan.full_scans == ["messages"] and plan.cost == 30000
+    assert plan_query(conn, "SELECT 1 FROM messages WHERE author_id = '1'").cost == 10
+    # Until every row is scored, the sentiment UDF runs and counts
+    query = "SELECT sentiment_polarity(content) FROM messages"
+    plan = plan_query(conn, query)
+    assert plan.functions == ["sentiment_polarity"] and plan.cost > 30000 * 1000
+    # Then stored scores replace it, so it doesn't
+    conn.execute("UPDATE messages SET polarity = 0, subjectivity = 0")
+    assert plan_query(conn, query).functions == []
+
+    for query in [
+        "DELETE FROM messages",
+        "PRAGMA query_only = OFF",
+        "SELECT 1; SELECT 2",
+        "SELECT COUNT(*) FROM messages a, messages b",
+    ]:
+        try:
+            plan_query(conn, query)
+        except QueryRejectedError:
+            pass
+        else:
+            raise AssertionError(f"Expected QueryRejectedError for {query}")
+
+
+# Test that CTEs are sized from their own plan, not the search index's tables
+def test_plan_query_recursive_cte_with_search_index():
+    import sqlite3
+
+    from tsurugi.database import ensure_schema, index_all_messages, register_functions
+    from tsurugi.query import plan_query
+
+    conn = sqlite3.connect(":memory:")
+    ensure_schema(conn)
+    register_functions(conn)
+    conn.executemany(
+        "INSERT INTO messages (message_id, content) VALUES (?, ?)",
+        ((str(175928847299117063 + i * 4194304000), f"hello {i}") for i in range(100)),
+    )
+    index_all_messages(conn)
+    # messages_fts_data's rowids run into the hundreds of billions
+    assert (
+        conn.execute("SELECT MAX(rowid) FROM messages_fts_data").fetchone()[0] > 10**9
+    )
+
+    plan = plan_query(
+        conn,
+        "WITH RECURSIVE numbers(n) AS "
+        "(SELECT 1 UNION ALL SELECT n + 1 FROM numbers WHERE n < 100) "
+        "SELECT n FROM numbers",
+    )
+    assert plan.cost < 1000 and not plan.warnings
+
+
+# Test that full-text search runs under the read-only authorizer
+def test_sqljob_full_text_search():
+    import os
+    import sqlite3
+    import tempfile
+
+    from tsurugi.database import ensure_schema, index_all_messages
+    from tsurugi.query import SQLJob, check_query
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "archive.db")
+        conn = sqlite3.connect(path)
+        ensure_schema(conn)
+        conn.executemany(
+            "INSERT INTO messages (message_id, content) VALUES (?, ?)",
+            [("175928847299117063", "hello there"), ("175928851493421056", "bye")],
+        )
+        conn.commit()
+        index_all_messages(conn)
+        conn.close()
+
+        query = "SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'hello'"
+        check_query(path, query)
+        assert SQLJob(path, query, timeout=5)().row_count == 1
+
+        try:
+            SQLJob(path, "PRAGMA data_version = 1")()
+        except sqlite3.DatabaseError:
+            pass
+        else:
+            raise AssertionError("Expected pragma writes to be denied")
+
+
+# Test that word_count calls are only rewritten on messages.content
+def test_optimize_query_word_count():
+    import sqlite3
+
+    from tsurugi.database import ensure_schema, optimize_query, register_functions
+
+    conn = sqlite3.connect(":memory:")
+    ensure_schema(conn)
+    register_functions(conn)
+    conn.execute(
+        "INSERT INTO messages (message_id, content, words) "
+        "VALUES ('175928847299117063', 'one two', 2)"
+    )
+
+    for query in [
+        "WITH t AS (SELECT 'a b c' AS content) SELECT word_count(content) FROM t",
+        "SELECT word_count(content) FROM (SELECT 'a b c' AS content)",
+    ]:
+        assert optimize_query(conn, query) == query
+        assert conn.execute(optimize_query(conn, query)).fetchone() == (3,)
+
+    query = "SELECT 'word_count(content)', word_count(m.content) FROM messages m"
+    assert optimize_query(conn, query) == (
+        "SELECT 'word_count(content)', COALESCE(m.words, word_count(m.content))"
+        " FROM messages m"
+    )
+
+
+# Test that a stats backfill racing a writer counts each message once
+def test_update_stats_concurrent_writers():
+    import os
+    import sqlite3
+    import tempfile
+    import threading
+    import time
+
+    from tsurugi.database import (
+        apply_pragmas,
+        ensure_schema,
+        update_all_stats,
+        update_stats,
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "archive.db")
+        conn = sqlite3.connect(path)
+        apply_pragmas(conn)
+        ensure_schema(conn)
+        conn.executemany(
+            "INSERT INTO messages (message_id, author_id, created_at) VALUES (?, '1', '2026-01-01')",
+            ((str(i),) for i in range(100)),
+        )
+        conn.commit()
+
+        writer = sqlite3.connect(path, timeout=10)
+        writer.execute("BEGIN IMMEDIATE")
+        update_stats(writer)
+        errors = []
+
+        def backfill():
+            try:
+                update_all_stats(sqlite3.connect(path, timeout=10))
+            except Exception as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=backfill)
+        thread.start()
+        time.sleep(0.2)
+        writer.commit()
+        thread.join()
+        assert not errors
+        total = conn.execute("SELECT SUM(message_count) FROM daily_author_stats")
+        assert total.fetchone() == (100,)
+
+
+# Test that a search index backfill racing a writer indexes each message once
+def test_index_messages_concurrent_writers():
+    import os
+    import sqlite3
+    import tempfile
+    import threading
+    import time
+
+    from tsurugi.database import (
+        apply_pragmas,
+        ensure_schema,
+        index_all_messages,
+        index_messages,
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "archive.db")
+        conn = sqlite3.connect(path)
+        apply_pragmas(conn)
+        ensure_schema(conn)
+        conn.executemany(
+            "INSERT INTO messages (message_id, author_id, content, created_at) VALUES (?, '1', 'hello', '2026-01-01')",
+            ((str(i),) for i in range(100)),
+        )
+        conn.commit()
+
+        writer = sqlite3.connect(path, timeout=10)
+        writer.execute("BEGIN IMMEDIATE")
+        index_messages(writer)
+        results = []
+
+        def backfill():
+            try:
+                results.append(index_all_messages(sqlite3.connect(path, timeout=10)))
+            except Exception as error:
+                results.append(error)
+
+        thread = threading.Thread(target=backfill)
+        thread.start()
+        time.sleep(0.2)
+        writer.commit()
+        thread.join()
+        # The writer indexed everything, so there's nothing left to backfill
+        assert results == [0]
+        hits = conn.execute(
+            "SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH 'hello'"
+        )
+        assert hits.fetchone() == (100,)
+
+
+# Test that every export format reads back with the same rows and unique columns
+def test_export_round_trip():
+    import csv
+    import gzip
+    import io
+    import json
+    import sqlite3
+
+    import numpy as np
+
+    from tsurugi.export import EXPORT_FORMATS, PartWriter, export_results
+
+    # A format without write() fails when it is built, not mid-export
+    class Unfinished(PartWriter):
+        pass
+
+    try:
+        Unfinished(["id"])
+    except TypeError:
+        pass
+    else:
+        raise AssertionError("Expected TypeError")
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE t (id INTEGER, name TEXT, score REAL)")
+    conn.executemany("INSERT INTO t VALUES (?, ?, ?)", [(1, "a", 0.5), (2, None, None)])
+    query = "SELECT a.id, b.id, a.name, a.score, 'x' AS id_1 FROM t a JOIN t b ON b.id = a.id ORDER BY a.id"
+    columns = ["id", "id_2", "name", "score", "id_1"]
+    rows = [(1, 1, "a", 0.5, "x"), (2, 2, None, None, "x")]
+
+    for fmt in EXPORT_FORMATS:
+        result = export_results(conn.execute(query), query, fmt)
+        assert result.row_count == 2 and not result.truncated
+        [(name, part)] = result.files
+        assert name == f"query_results.{fmt}"
+        data = part.read()
+        if fmt == "csv.gz":
+            lines = list(csv.reader(io.StringIO(gzip.decompress(data).decode())))
+            assert lines[0] == columns
+            assert lines[1:] == [["1", "1", "a", "0.5", "x"], ["2", "2", "", "", "x"]]
+        elif fmt == "jsonl.gz":
+            records = [json.loads(line) for line in gzip.decompress(data).splitlines()]
+            assert records == [dict(zip(columns, row)) for row in rows]
+        else:
+            archive = np.load(io.BytesIO(data))
+            assert archive["columns"].tolist() == columns
+            for i, column in enumerate(columns):
+                values = archive[f"rg0000.{column}"].tolist()
+                nulls = f"rg0000.{column}.null"
+                if nulls in archive:
+                    values = [
+                        None if null else value
+                        for value, null in zip(values, archive[nulls])
+                    ]
+                assert values == [row[i] for row in rows], column
+
+
+# Test that killing a stuck plot job leaves jobs on other workers running
+def test_plot_pool_kills_only_stuck_worker():
+    import asyncio
+    import time
+
+    from tsurugi import plotting
+    from tsurugi.helpers.safety import TimeoutError
+
+    async def run():
+        pool = plotting.PlotPool(workers=3, time_limit=0.5)
+        await pool.warm_up()
+
+        async def later(job):
+            # Still running when the stuck job is killed, 1s in
+            await asyncio.sleep(0.6)
+            return await job
+
+        try:
+            return await asyncio.gather(
+                pool._run(time.sleep, 30),
+                later(pool._run(time.sleep, 0.8)),
+                later(pool.render("plt.plot([1, 2, 3])")),
+                return_exceptions=True,
+            )
+        finally:
+            pool.shutdown()
+
+    grace = plotting.PLOT_KILL_GRACE
+    plotting.PLOT_KILL_GRACE = 0.5
+    try:
+        stuck, slow, plot = asyncio.run(run())
+    finally:
+        plotting.PLOT_KILL_GRACE = grace
+    assert isinstance(stuck, TimeoutError)
+    assert slow[0] is None
+    assert plot[0].startswith(b"\x89PNG")